@@ -1,10 +1,13 @@
+import hashlib
+import json
 import os
-import shutil
 import tempfile
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 
-from flask import (Flask, flash, jsonify, redirect, render_template, request,
-                   session, url_for)
+from flask import (Flask, Response, flash, jsonify, redirect, render_template,
+                   request, session, stream_with_context, url_for)
 from werkzeug.utils import secure_filename
 
 from config.init_config import init_environment
@@ -12,6 +15,8 @@ from services.document_service import DocumentService
 from services.gemini_service import GeminiService
 from services.vector_store_service import VectorStoreService
 from services.chapter_service import ChapterService
+from services.ingestion_queue import IngestionQueue
+from services.query_pipeline import QueryPipeline
 
 # Initialize environment before anything else
 init_environment()
@@ -27,6 +32,7 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Inicialización única de servicios
 print("Initializing services...")
+startup_begin = time.perf_counter()
 # Inicializamos primero los servicios base
 vector_store = VectorStoreService()
 document_service = DocumentService()
@@ -37,16 +43,113 @@ gemini_service = GeminiService(vector_store=vector_store, document_service=docum
 
 # Establecemos la referencia cruzada después de la creación
 gemini_service.set_chapter_service(chapter_service)
+query_pipeline = QueryPipeline(vector_store, gemini_service)
+ingestion_queue = IngestionQueue(vector_store, document_service,
+                                 max_workers=int(os.environ.get('INGEST_WORKERS', 2)))
 
-print("Services initialized successfully")
+# El modelo de embeddings y el índice se cargan al primer uso. Con FARO_PRELOAD=true se
+# cargan ya, para que un servidor que carga la app antes de hacer fork (gunicorn --preload)
+# comparta esas páginas entre workers en copy-on-write.
+# Solo un proceso escribe la biblioteca (subidas, borrados, reindexado): el primero que lo
+# necesita. Con varios workers, el resto son réplicas de solo lectura que siguen sus cambios;
+# lo recomendable es un servidor escritor con un solo worker y réplicas con FARO_READ_ONLY=true
+startup_timings = {'services_s': time.perf_counter() - startup_begin}
+if os.environ.get('FARO_PRELOAD', 'false').lower() in ('1', 'true', 'yes'):
+    preload_begin = time.perf_counter()
+    vector_store.preload()
+    startup_timings['preload_s'] = time.perf_counter() - preload_begin
+
+print(f"Services initialized successfully ({startup_timings['services_s']:.2f}s)")
+
+SUMMARY_LENGTHS = ('short', 'medium', 'long')
+
+# /query/batch runs the whole batch under one read lock, so its size is bounded
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 100))
+BATCH_MAX_TOP_K = int(os.environ.get('BATCH_MAX_TOP_K', 50))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def read_only_response():
+    """503 response for a write that reached a read-only replica, or None if this process can write"""
+    if vector_store.can_write():
+        return None
+    return jsonify({
+        'success': False,
+        'message': 'This server is a read-only replica; send uploads, deletes and reindexing to the writer'
+    }), 503
+
+def book_response(book, build):
+    """
+    JSON response for data derived from one indexed book, with ETag/Last-Modified validation
+    
+    The validators come from the book's version (its content and the index version), so a client
+    whose copy is still current gets a 304 before build() runs. build() returns the payload;
+    failed payloads carry no validators, so they are generated again on the next request.
+    """
+    version, indexed = vector_store.book_version(book)
+    etag = hashlib.sha1(f"{version}\0{request.full_path}".encode('utf-8')).hexdigest()
+    # Books indexed before the manifest have no indexing time, only the ETag
+    last_modified = datetime.fromtimestamp(int(indexed), timezone.utc) if indexed is not None else None
+    
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and request.if_modified_since >= last_modified)
+    
+    if not_modified:
+        response = Response(status=304)
+    else:
+        payload = build()
+        response = jsonify(payload)
+        if not payload.get('success'):
+            return response
+    
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # El navegador guarda la respuesta pero la revalida siempre
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Startup timings and which lazily loaded components are already in memory"""
+    return jsonify({
+        'success': True,
+        'ready': True,
+        'pid': os.getpid(),
+        'startup': startup_timings,
+        'embedding_model': {
+            'loaded': vector_store.embedding_service.model_loaded,
+            'load_s': vector_store.embedding_service.model_load_seconds,
+            'throughput': vector_store.embedding_service.throughput_stats()
+        },
+        'index': {
+            'loaded': vector_store.index_loaded,
+            'load_s': vector_store.index_load_seconds,
+            'memory_mapped': vector_store.index_loaded and vector_store.index_readonly
+        }
+    })
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit rates of the embedding, answer/summary and OCR caches"""
+    answer_cache = vector_store.answer_cache
+    # OCR runs in the vector store's DocumentService, which extracts the books it indexes
+    ocr_cache = vector_store.document_service.ocr_cache
+    return jsonify({
+        'success': True,
+        'embeddings': vector_store.embedding_service.cache_stats(),
+        'answers': answer_cache.stats() if answer_cache is not None else None,
+        'ocr': ocr_cache.stats() if ocr_cache is not None else None
+    })
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -59,6 +162,9 @@ def upload_file():
         return redirect(request.url)
     
     if file and allowed_file(file.filename):
+        read_only = read_only_response()
+        if read_only is not None:
+            return read_only
         try:
             # Save file temporarily
             filename = secure_filename(file.filename)
@@ -66,20 +172,16 @@ def upload_file():
             temp_path = os.path.join(temp_dir, filename)
             file.save(temp_path)
             
-            # Process file
-            processed_path = document_service.process_file(temp_path)
-            
-            # Add to vector store
-            chunks_added = vector_store.add_document(processed_path)
-            
-            # Clean up temp file
-            shutil.rmtree(temp_dir)
+            # Extraction, embedding and indexing run in the background; poll /jobs/<id>
+            job = ingestion_queue.submit(temp_path, filename)
             
             return jsonify({
                 'success': True,
-                'message': f'File processed successfully. Added {chunks_added} chunks to the index.',
-                'filename': filename
-            })
+                'message': 'File received. Processing in the background.',
+                'filename': filename,
+                'job_id': job['id'],
+                'job': job
+            }), 202
         
         except Exception as e:
             return jsonify({
@@ -92,6 +194,20 @@ def upload_file():
         'message': 'Invalid file type. Allowed types: PDF, TXT, DOC, DOCX'
     }), 400
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Stage and progress of a background upload or reindex"""
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'message': 'Job not found'
+        }), 404
+    return jsonify({
+        'success': True,
+        'job': job
+    })
+
 @app.route('/query', methods=['POST'])
 def query():
     data = request.get_json()
@@ -104,64 +220,166 @@ def query():
         }), 400
     
     try:
-        # Ahora usamos directamente Gemini para detectar la intención
-        intent_detection = gemini_service._detect_intent_with_gemini(user_query)
-        
-        if intent_detection.get('is_special_request'):
-            # Si es una solicitud de resumen o comparación, manejarlo directamente
-            if intent_detection['intent'] == 'summarize_chapter':
-                answer = gemini_service._handle_chapter_summary_request(user_query, intent_detection)
-                return jsonify({
-                    'success': True,
-                    'answer': answer,
-                    'chunks': []
-                })
-            elif intent_detection['intent'] == 'compare_chapters':
-                answer = gemini_service._handle_chapter_comparison_request(user_query, intent_detection)
-                return jsonify({
-                    'success': True,
-                    'answer': answer,
-                    'chunks': []
-                })
-        
-        # Si no es una solicitud especial, continuar con el flujo normal
-        results = vector_store.search(user_query, top_k=5)
-        
-        if not results:
-            return jsonify({
-                'success': True,
-                'answer': 'No encontré información relevante para responder a tu pregunta. Por favor, intenta reformular la pregunta o asegúrate de que la información esté en los documentos subidos.',
-                'chunks': []
-            })
-        
-        # Build context from chunks
-        context = "\n\n".join([f"Fragmento de '{r['book']}'" + 
-                              (f", página {r['page']}" if r['page'] != '-1' else "") + 
-                              f": {r['text']}" for r in results])
-        # Generate response using Gemini
-        answer = gemini_service.generate_response(user_query, context, results)
-        
+        # La intención se detecta una sola vez y se reutiliza en todo el flujo
+        return jsonify(query_pipeline.run(user_query))
+    
+    except Exception as e:
+        print(f"Error processing query: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'Error processing query: {str(e)}'
+        }), 500
+
+@app.route('/query/stream', methods=['POST'])
+def query_stream():
+    """Same as /query, but answered as Server-Sent Events: sources first, then the text as it is generated"""
+    data = request.get_json() or {}
+    user_query = data.get('query', '')
+    
+    if not user_query:
+        return jsonify({
+            'success': False,
+            'message': 'Query cannot be empty'
+        }), 400
+    
+    def events():
+        try:
+            for event, payload in query_pipeline.stream(user_query):
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            print(f"Error processing query: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'message': f'Error processing query: {str(e)}'})}\n\n"
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # que un proxy (nginx) no acumule la respuesta
+    })
+
+@app.route('/query/batch', methods=['POST'])
+def query_batch():
+    """Retrieval only (no Gemini answer) for many queries, e.g. evaluation sets"""
+    data = request.get_json() or {}
+    queries = data.get('queries', [])
+    
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+        return jsonify({
+            'success': False,
+            'message': 'queries must be a non-empty list of strings'
+        }), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({
+            'success': False,
+            'message': f'At most {BATCH_MAX_QUERIES} queries per batch'
+        }), 400
+    
+    try:
+        top_k = int(data.get('top_k', 5))
+        similarity_threshold = float(data.get('similarity_threshold', 0.4))
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'top_k must be an integer and similarity_threshold a number'
+        }), 400
+    if not 1 <= top_k <= BATCH_MAX_TOP_K:
+        return jsonify({
+            'success': False,
+            'message': f'top_k must be between 1 and {BATCH_MAX_TOP_K}'
+        }), 400
+    filters = data.get('filters')
+    if filters is not None and not isinstance(filters, dict):
+        return jsonify({
+            'success': False,
+            'message': 'filters must be an object'
+        }), 400
+    
+    try:
+        results = vector_store.search_many(
+            queries,
+            top_k=top_k,
+            similarity_threshold=similarity_threshold,
+            filters=filters
+        )
         return jsonify({
             'success': True,
-            'answer': answer,
-            'chunks': results
+            'results': [{'query': q, 'chunks': chunks} for q, chunks in zip(queries, results)]
         })
     
     except Exception as e:
-        print(f"Error processing query: {str(e)}")
+        print(f"Error processing batch query: {str(e)}")
         return jsonify({
             'success': False,
-            'message': f'Error processing query: {str(e)}'
+            'message': f'Error processing batch query: {str(e)}'
+        }), 500
+
+@app.route('/books/<path:book_name>/chapters', methods=['GET'])
+def list_chapters(book_name):
+    """Chapters of a book, from the chapter index built at ingestion time"""
+    book = vector_store.resolve_book(book_name)
+    if book is None or vector_store.book_version(book) is None:
+        return jsonify({
+            'success': False,
+            'message': f'Libro no encontrado: {book_name}'
+        }), 404
+    return book_response(book, lambda: chapter_service.identify_chapters(book_name))
+
+@app.route('/books/<path:book_name>/chapters/<chapter>/summary', methods=['GET'])
+def chapter_summary(book_name, chapter):
+    """Summary of one chapter (?length=short|medium|long); generated once per book version"""
+    length = request.args.get('length', 'medium')
+    if length not in SUMMARY_LENGTHS:
+        return jsonify({
+            'success': False,
+            'message': f"length must be one of: {', '.join(SUMMARY_LENGTHS)}"
+        }), 400
+    
+    book = vector_store.resolve_book(book_name)
+    if book is None or vector_store.book_version(book) is None:
+        return jsonify({
+            'success': False,
+            'message': f'Libro no encontrado: {book_name}'
+        }), 404
+    return book_response(book, lambda: chapter_service.summarize_chapter(book_name, chapter, length))
+
+@app.route('/compare-chapters', methods=['POST'])
+def compare_chapters():
+    """Comparison of two or more chapters; cached server-side until one of their books changes"""
+    data = request.get_json() or {}
+    sources = data.get('sources', [])
+    
+    if (not isinstance(sources, list) or len(sources) < 2
+            or not all(isinstance(s, dict) and s.get('book') and s.get('chapter') for s in sources)):
+        return jsonify({
+            'success': False,
+            'message': 'sources must be a list of at least two {book, chapter} objects'
+        }), 400
+    
+    try:
+        sources = [{'book': s['book'], 'chapter': str(s['chapter'])} for s in sources]
+        return jsonify(chapter_service.compare_chapters(sources))
+    
+    except Exception as e:
+        print(f"Error comparing chapters: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'Error comparing chapters: {str(e)}'
         }), 500
 
 @app.route('/reindex', methods=['POST'])
 def reindex():
+    read_only = read_only_response()
+    if read_only is not None:
+        return read_only
     try:
-        total_chunks = vector_store.reindex_all_documents()
+        # ?full=true rebuilds every book; by default only changed files are processed.
+        # It runs in the background (searches and uploads keep going); poll /jobs/<id>
+        full = request.args.get('full', 'false').lower() in ('1', 'true', 'yes')
+        job = ingestion_queue.submit_reindex(full=full)
         return jsonify({
             'success': True,
-            'message': f'Reindexing complete. Total chunks: {total_chunks}'
-        })
+            'message': 'Reindexing started in the background.',
+            'job_id': job['id'],
+            'job': job
+        }), 202
     except Exception as e:
         return jsonify({
             'success': False,
@@ -191,6 +409,9 @@ def list_documents():
 
 @app.route('/documents/<filename>', methods=['DELETE'])
 def delete_document(filename):
+    read_only = read_only_response()
+    if read_only is not None:
+        return read_only
     try:
         file_path = os.path.join(document_service.books_dir, secure_filename(filename))
         if os.path.exists(file_path):
@@ -0,0 +1,202 @@
+"""
+Chunking time of DocumentService._create_chunks_with_metadata against the previous implementation
+
+Usage:
+    python benchmarks/chunking.py                # synthetic 2,000-page book
+    python benchmarks/chunking.py --pages 500
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.document_service import DocumentService
+
+WORDS = ("biblioteca faro lectura capitulo pagina texto autor historia libro memoria tiempo ciudad "
+         "palabra idea mundo vida camino puerta noche agua").split()
+
+
+def synthetic_book(pages, seed=0):
+    """Text shaped like _process_pdf output: one [PAGE n] marker and one whitespace-cleaned line per page"""
+    rng = random.Random(seed)
+    parts = []
+    for page in range(1, pages + 1):
+        sentences = []
+        for _ in range(rng.randint(8, 30)):
+            words = rng.choices(WORDS, k=rng.randint(6, 22))
+            sentences.append(" ".join(words).capitalize() + rng.choice(".!?"))
+        if page % 25 == 1:
+            # Chapter heading pages
+            sentences = [f"{page // 25 + 1}."]
+        parts.append(f"\n\n[PAGE {page}]\n" + " ".join(sentences))
+    return "".join(parts)
+
+
+def legacy_chunks(self, text, book_name):
+    """DocumentService._create_chunks_with_metadata before the rewrite (sorted scan per chunk)"""
+    chunks = []
+
+    page_pattern = r"(?:\[PAGE (\d+)\])|"
+
+    # Potenciales marcadores de sección (encabezados)
+    section_pattern = r"\n\s*(?:[A-Z0-9\s]{2,}:?|[IVX]+\.|\d+\.\d+\.|\d+\.)\s*\n"
+
+    # Track page numbers and their positions
+    page_positions = {}
+    for match in re.finditer(page_pattern, text, flags=re.IGNORECASE):
+        page_num = None
+        for g in match.groups():
+            if g:
+                page_num = g
+                break
+
+        if page_num:
+            position = match.start()
+            page_positions[position] = page_num
+
+    # Remove page markers from text
+    clean_text = re.sub(page_pattern, "", text, flags=re.IGNORECASE)
+
+    # Split text into paragraphs
+    paragraphs = re.split(r'\n\s*\n', clean_text)
+
+    current_chunk = ""
+    current_position = 0
+    processed_length = 0
+
+    for paragraph in paragraphs:
+        paragraph = paragraph.strip()
+        if not paragraph:
+            processed_length += 2  # Account for paragraph separators
+            continue
+
+        # Check if paragraph is a section heading
+        is_section_heading = bool(re.match(section_pattern, "\n" + paragraph + "\n"))
+
+        # If adding this paragraph would exceed chunk size or if it's a new section
+        if len(current_chunk) + len(paragraph) > self.chunk_size or is_section_heading:
+            # Save current chunk if not empty
+            if current_chunk.strip():
+                # Determine the page for this chunk
+                current_page = legacy_page_for_position(current_position, page_positions)
+                chunks.append({
+                    "text": current_chunk.strip(),
+                    "page": current_page,
+                    "book": book_name
+                })
+
+            # Start a new chunk
+            current_chunk = paragraph
+            current_position = processed_length
+        else:
+            # Add paragraph to current chunk
+            if current_chunk:
+                current_chunk += "\n\n" + paragraph
+            else:
+                current_chunk = paragraph
+                current_position = processed_length
+
+        processed_length += len(paragraph) + 2  # +2 for paragraph separators
+
+        # Handle paragraphs that are longer than chunk_size
+        if len(paragraph) > self.max_chunk_size:
+            # Try to split by sentences
+            sentences = re.split(r'(?<=[.!?])\s+', paragraph)
+            temp_chunk = ""
+            sentence_position = current_position
+
+            for sentence in sentences:
+                if len(temp_chunk) + len(sentence) > self.max_chunk_size:
+                    if temp_chunk:
+                        # Save the accumulated sentences
+                        current_page = legacy_page_for_position(sentence_position, page_positions)
+                        chunks.append({
+                            "text": temp_chunk.strip(),
+                            "page": current_page,
+                            "book": book_name
+                        })
+
+                        # Reset for new chunk
+                        sentence_position += len(temp_chunk)
+                        temp_chunk = sentence
+                    else:
+                        # Handle extremely long sentences by character splitting
+                        for i in range(0, len(sentence), self.max_chunk_size):
+                            sub_sentence = sentence[i:i + self.max_chunk_size]
+                            if sub_sentence.strip():
+                                sub_position = sentence_position + i
+                                current_page = legacy_page_for_position(sub_position, page_positions)
+                                chunks.append({
+                                    "text": sub_sentence.strip(),
+                                    "page": current_page,
+                                    "book": book_name
+                                })
+                else:
+                    if temp_chunk:
+                        temp_chunk += " " + sentence
+                    else:
+                        temp_chunk = sentence
+
+            # Add the last chunk if not empty
+            if temp_chunk.strip():
+                current_page = legacy_page_for_position(sentence_position, page_positions)
+                chunks.append({
+                    "text": temp_chunk.strip(),
+                    "page": current_page,
+                    "book": book_name
+                })
+
+            # Reset current chunk since we've handled this long paragraph
+            current_chunk = ""
+
+    # Don't forget the last chunk
+    if current_chunk.strip():
+        current_page = legacy_page_for_position(current_position, page_positions)
+        chunks.append({
+            "text": current_chunk.strip(),
+            "page": current_page,
+            "book": book_name
+        })
+
+    return chunks
+
+
+def legacy_page_for_position(position, page_positions):
+    """Determine the page number for a given position in the text"""
+    current_page = "0"
+    for pos, page in sorted(page_positions.items()):
+        if pos <= position:
+            current_page = page
+        else:
+            break
+    return current_page
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=2000)
+    args = parser.parse_args()
+
+    service = DocumentService()
+    print(f"{'pages':>6} {'chars':>10} {'chunks':>7} {'legacy s':>9} {'new s':>8} {'speedup':>8} {'same text':>10}")
+    for pages in sorted({max(1, args.pages // 4), max(1, args.pages // 2), args.pages}):
+        text = synthetic_book(pages)
+        old, old_seconds = timed(legacy_chunks, service, text, 'synthetic.pdf')
+        new, new_seconds = timed(service._create_chunks_with_metadata, text, 'synthetic.pdf')
+        same_text = [chunk['text'] for chunk in old] == [chunk['text'] for chunk in new]
+        print(f"{pages:>6} {len(text):>10} {len(new):>7} {old_seconds:>9.3f} {new_seconds:>8.3f} "
+              f"{old_seconds / new_seconds:>7.1f}x {str(same_text):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Agreement of the faster embedding backends with the fp32 reference, and their effect on retrieval
+
+For every backend: cosine similarity with the reference vectors of the same chunks, recall@k of
+the reference top-k (with the corpus embedded by the backend, and with the reference corpus,
+which is what switching EMBEDDING_BACKEND without re-embedding the library gives), hit@k of the
+chunk each query was taken from, single-query latency and corpus chunks/s.
+
+Usage:
+    python benchmarks/embedding_parity.py                       # sample of the library's chunks
+    python benchmarks/embedding_parity.py --synthetic --backends torch-int8,onnx-int8
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.chunk_store import ChunkStore
+from services.embedding_backends import BACKENDS
+from services.embedding_service import EmbeddingService
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+WORDS = ("biblioteca faro lectura capitulo pagina texto autor historia libro memoria tiempo ciudad "
+         "palabra idea mundo vida camino puerta noche agua mar luz barco puerto tormenta").split()
+
+
+def library_corpus(size, rng):
+    chunk_file = os.path.join(DATA_DIR, 'chunks.sqlite')
+    if not os.path.exists(chunk_file):
+        sys.exit("No chunk store in data/; index some books first or use --synthetic")
+    store = ChunkStore(chunk_file)
+    ids = store.all_ids()
+    chunks = store.get_many(rng.sample(ids, min(size, len(ids))))
+    return [chunk['text'] for chunk in chunks.values()]
+
+
+def synthetic_corpus(size, rng):
+    return [". ".join(" ".join(rng.choices(WORDS, k=rng.randint(6, 18))) for _ in range(rng.randint(3, 12))) + "."
+            for _ in range(size)]
+
+
+def sample_queries(corpus, count, rng):
+    """A sentence of a random chunk as the query, with that chunk as its known answer"""
+    queries = []
+    for source in rng.sample(range(len(corpus)), min(count, len(corpus))):
+        sentences = [s for s in re.split(r'(?<=[.!?])\s+', corpus[source]) if len(s.split()) >= 5]
+        if sentences:
+            queries.append((rng.choice(sentences), source))
+    return queries
+
+
+def top_k(corpus_vectors, query_vectors, k):
+    scores = query_vectors @ corpus_vectors.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall(found, expected):
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)]))
+
+
+def measure(backend, corpus, queries):
+    service = EmbeddingService(use_cache=False, backend=backend)
+    service.model  # load (and export) time is not part of the measurement
+
+    start = time.perf_counter()
+    corpus_vectors = np.asarray(service.get_embeddings(corpus), dtype='float32')
+    corpus_seconds = time.perf_counter() - start
+
+    latencies = []
+    query_vectors = []
+    for query, _ in queries:
+        start = time.perf_counter()
+        query_vectors.append(service.get_embedding(query))
+        latencies.append(time.perf_counter() - start)
+    return corpus_vectors, np.array(query_vectors, dtype='float32'), len(corpus) / corpus_seconds, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default=','.join(BACKENDS[1:]), help='comma-separated backends to compare')
+    parser.add_argument('--corpus', type=int, default=2000, help='chunks in the sample corpus')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--synthetic', action='store_true', help='generated text instead of the library')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    corpus = synthetic_corpus(args.corpus, rng) if args.synthetic else library_corpus(args.corpus, rng)
+    queries = sample_queries(corpus, args.queries, rng)
+    sources = np.array([source for _, source in queries])
+    print(f"{len(corpus)} chunks, {len(queries)} queries, k={args.k}\n")
+
+    ref_corpus, ref_queries, ref_rate, ref_latencies = measure('torch', corpus, queries)
+    ref_top = top_k(ref_corpus, ref_queries, args.k)
+
+    print(f"{'backend':<11} {'cos mean':>8} {'cos min':>8} {'recall':>7} {'recall*':>8} {'hit@k':>6} "
+          f"{'query ms':>9} {'p95 ms':>7} {'chunks/s':>9}")
+    rows = [('torch', ref_corpus, ref_queries, ref_rate, ref_latencies)]
+    rows += [(backend,) + measure(backend, corpus, queries)
+             for backend in args.backends.split(',') if backend != 'torch']
+    for backend, corpus_vectors, query_vectors, rate, latencies in rows:
+        cosines = np.sum(corpus_vectors * ref_corpus, axis=1)
+        own = top_k(corpus_vectors, query_vectors, args.k)
+        mixed = top_k(ref_corpus, query_vectors, args.k)
+        hits = float(np.mean([source in row for source, row in zip(sources, own)]))
+        print(f"{backend:<11} {cosines.mean():>8.4f} {cosines.min():>8.4f} {recall(own, ref_top):>7.3f} "
+              f"{recall(mixed, ref_top):>8.3f} {hits:>6.3f} {1000 * latencies.mean():>9.2f} "
+              f"{1000 * np.percentile(latencies, 95):>7.2f} {rate:>9.1f}")
+    print("\nrecall: reference top-k found with the backend's corpus and queries; "
+          "recall*: backend queries against the reference corpus")
+
+
+if __name__ == '__main__':
+    main()
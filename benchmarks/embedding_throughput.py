@@ -0,0 +1,65 @@
+"""
+Chunks per second of EmbeddingService for several process counts and batch sizes
+
+Usage:
+    python benchmarks/embedding_throughput.py
+    python benchmarks/embedding_throughput.py --chunks 20000 --processes 1,8,16,32 --batch-sizes 32,64
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.embedding_service import EmbeddingService
+
+WORDS = ("biblioteca faro lectura capitulo pagina texto autor historia libro memoria tiempo ciudad "
+         "palabra idea mundo vida camino puerta noche agua").split()
+
+
+def synthetic_chunks(count, seed=0):
+    """Chunk-sized texts (roughly 100 to 1,500 characters, like the chunker's output)"""
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(15, 220))) + f" {i}" for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=4096)
+    parser.add_argument('--processes', default=f"1,{os.cpu_count() or 1}",
+                        help='comma-separated process counts')
+    parser.add_argument('--batch-sizes', default='32', help='comma-separated batch sizes')
+    args = parser.parse_args()
+
+    texts = synthetic_chunks(args.chunks)
+    # No cache: every run has to encode every text
+    service = EmbeddingService(use_cache=False)
+    service.model  # load time is not part of the measurement
+
+    print(f"{len(texts)} chunks, {os.cpu_count()} CPUs\n")
+    print(f"{'processes':>9} {'batch':>6} {'seconds':>8} {'chunks/s':>9} {'speedup':>8}")
+    baseline = None
+    for processes in [int(p) for p in args.processes.split(',')]:
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            service.close()
+            service.processes = processes
+            service.batch_size = batch_size
+            if processes > 1:
+                # Start the pool outside the timed run
+                with service._pool_lock:
+                    service._get_pool()
+
+            start = time.perf_counter()
+            service.get_embeddings(texts)
+            seconds = time.perf_counter() - start
+
+            rate = len(texts) / seconds
+            baseline = baseline or rate
+            print(f"{processes:>9} {batch_size:>6} {seconds:>8.2f} {rate:>9.1f} {rate / baseline:>7.2f}x")
+    service.close()
+
+
+if __name__ == '__main__':
+    main()
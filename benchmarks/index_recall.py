@@ -0,0 +1,75 @@
+"""
+Recall vs. latency of the approximate index types against exact flat search
+
+Usage:
+    python benchmarks/index_recall.py                 # vectors from data/ (the indexed library)
+    python benchmarks/index_recall.py --synthetic 200000
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.embedding_store import EmbeddingStore
+from services.index_factory import recall_latency_report
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def load_library_vectors(limit):
+    """Read the stored chunk vectors without touching the store's files"""
+    info_file = os.path.join(DATA_DIR, 'embeddings.json')
+    if not os.path.exists(info_file):
+        sys.exit("No embedding store in data/; index some books first or use --synthetic")
+    with open(info_file) as f:
+        info = json.load(f)
+    store = EmbeddingStore(DATA_DIR, dimension=info['dimension'], model_name=info['model'])
+    rows = sorted(store.rows_by_id.values())[:limit]
+    return np.array(store.vectors[rows])
+
+
+def synthetic_vectors(count, dimension=768, clusters=256, seed=0):
+    """Clustered unit vectors, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype('float32')
+    vectors = centers[rng.integers(0, clusters, count)] + 0.6 * rng.standard_normal((count, dimension)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=0, help='use N synthetic vectors instead of data/')
+    parser.add_argument('--limit', type=int, default=1000000, help='maximum library vectors to load')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.synthetic) if args.synthetic else load_library_vectors(args.limit)
+
+    # Queries near stored chunks, as real questions land close to passages
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape).astype('float32') / np.sqrt(vectors.shape[1])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    configs = [{'type': 'flat'}]
+    configs += [{'type': 'hnsw', 'hnsw_m': 32, 'ef_search': ef} for ef in (16, 32, 64, 128, 256)]
+    configs += [{'type': 'ivf_flat', 'nprobe': nprobe} for nprobe in (1, 4, 16, 64)]
+    configs += [{'type': 'ivf_pq', 'ivf_pq_m': 48, 'nprobe': nprobe} for nprobe in (4, 16, 64)]
+
+    print(f"{len(vectors)} vectors, {len(queries)} queries, recall@{args.k}\n")
+    print(f"{'index':<10} {'param':<14} {'recall':>7} {'mean ms':>8} {'p95 ms':>8} {'build s':>8}")
+    for row in recall_latency_report(vectors, queries, configs, k=args.k):
+        config = row['config']
+        param = (f"efSearch={config['ef_search']}" if 'ef_search' in config
+                 else f"nprobe={config['nprobe']}" if 'nprobe' in config else '-')
+        print(f"{config['type']:<10} {param:<14} {row['recall']:>7.3f} {row['mean_ms']:>8.3f} "
+              f"{row['p95_ms']:>8.3f} {row['build_s']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
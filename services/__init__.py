@@ -5,3 +5,4 @@ from .embedding_service import EmbeddingService
 from .gemini_service import GeminiService
 from .vector_store_service import VectorStoreService
 from .chapter_service import ChapterService
+from .query_pipeline import QueryPipeline
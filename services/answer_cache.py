@@ -0,0 +1,294 @@
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+from .sqlite_connection import ProcessLocalConnection
+
+
+class AnswerCache:
+    """Cache of generated answers, chapter summaries (and their partial summaries) and comparisons, with TTL/LRU eviction and per-book invalidation"""
+    
+    def __init__(self, db_path, similarity_threshold=0.95, ttl_seconds=7 * 24 * 3600, max_entries=5000):
+        """
+        Args:
+            db_path: SQLite file
+            similarity_threshold: minimum cosine similarity between a new query and a cached one
+            ttl_seconds: entries older than this are never returned
+            max_entries: answers (and summaries, and comparisons) kept before evicting the least recently used
+        """
+        self.db_path = db_path
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        
+        self.counters = {'answer_hits': 0, 'answer_misses': 0, 'summary_hits': 0, 'summary_misses': 0,
+                         'comparison_hits': 0, 'comparison_misses': 0, 'partial_hits': 0, 'partial_misses': 0}
+        
+        self._lock = threading.Lock()
+        self._connection = ProcessLocalConnection(db_path, self._create_schema)
+    
+    @property
+    def _conn(self):
+        return self._connection.get()
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                context_key BLOB NOT NULL,
+                query_vector BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_answers_context ON answers(context_key);
+            CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used);
+            CREATE TABLE IF NOT EXISTS answer_books (
+                answer_id INTEGER NOT NULL,
+                book TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_answer_books_book ON answer_books(book);
+            CREATE TABLE IF NOT EXISTS summaries (
+                book TEXT NOT NULL,
+                chapter TEXT NOT NULL,
+                length TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (book, chapter, length)
+            );
+            CREATE TABLE IF NOT EXISTS comparisons (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS comparison_books (
+                key TEXT NOT NULL,
+                book TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_comparison_books_key ON comparison_books(key);
+            CREATE TABLE IF NOT EXISTS partial_summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+        """)
+        conn.commit()
+    
+    def _context_key(self, chunk_ids, index_version):
+        """The retrieved chunks and the index they came from; an answer is only reused for the same context"""
+        ids = ",".join(str(int(i)) for i in sorted(chunk_ids))
+        return hashlib.sha1(f"{index_version}\0{ids}".encode('utf-8')).digest()
+    
+    def get_answer(self, query_vector, chunk_ids, index_version):
+        """Return the cached answer of a similar query over the same chunks, or None"""
+        query_vector = np.asarray(query_vector, dtype='float32')
+        context_key = self._context_key(chunk_ids, index_version)
+        
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, query_vector, answer FROM answers WHERE context_key = ? AND created >= ?",
+                (context_key, time.time() - self.ttl_seconds)
+            ).fetchall()
+            
+            best = None
+            for answer_id, vector, answer in rows:
+                # Query vectors are normalized, so the inner product is the cosine similarity
+                similarity = float(np.dot(np.frombuffer(vector, dtype='float32'), query_vector))
+                if similarity >= self.similarity_threshold and (best is None or similarity > best[0]):
+                    best = (similarity, answer_id, answer)
+            
+            if best is None:
+                self.counters['answer_misses'] += 1
+                return None
+            
+            self.counters['answer_hits'] += 1
+            self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), best[1]))
+            self._conn.commit()
+            return best[2]
+    
+    def put_answer(self, query_vector, chunk_ids, index_version, books, answer):
+        now = time.time()
+        vector = np.asarray(query_vector, dtype='float32').tobytes()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (context_key, query_vector, answer, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (self._context_key(chunk_ids, index_version), vector, answer, now, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO answer_books (answer_id, book) VALUES (?, ?)",
+                [(cursor.lastrowid, book) for book in set(books)]
+            )
+            self._evict_answers(now)
+    
+    def _evict_answers(self, now):
+        """Drop expired answers, then the least recently used ones above max_entries"""
+        self._conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl_seconds,))
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self._conn.execute("DELETE FROM answer_books WHERE answer_id NOT IN (SELECT id FROM answers)")
+    
+    def get_summary(self, book, chapter, length):
+        """Return the cached summarize_chapter result for (book, chapter, length), or None"""
+        key = (book, str(chapter), length)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM summaries WHERE book = ? AND chapter = ? AND length = ? AND created >= ?",
+                key + (time.time() - self.ttl_seconds,)
+            ).fetchone()
+            if row is None:
+                self.counters['summary_misses'] += 1
+                return None
+            
+            self.counters['summary_hits'] += 1
+            self._conn.execute(
+                "UPDATE summaries SET last_used = ? WHERE book = ? AND chapter = ? AND length = ?",
+                (time.time(),) + key
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+    
+    def put_summary(self, book, chapter, length, result):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (book, chapter, length, result, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (book, str(chapter), length, json.dumps(result), now, now)
+            )
+            self._conn.execute("DELETE FROM summaries WHERE created < ?", (now - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM summaries WHERE rowid IN (SELECT rowid FROM summaries ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+    
+    def _comparison_key(self, sources):
+        """Sources in the order they were given: it is the order the comparison presents them in"""
+        payload = json.dumps([[source['book'], str(source['chapter'])] for source in sources])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+    
+    def get_comparison(self, sources):
+        """Return the cached compare_chapters result for these [{book, chapter}] sources, or None"""
+        key = self._comparison_key(sources)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM comparisons WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.counters['comparison_misses'] += 1
+                return None
+            
+            self.counters['comparison_hits'] += 1
+            self._conn.execute("UPDATE comparisons SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+    
+    def put_comparison(self, sources, result):
+        now = time.time()
+        key = self._comparison_key(sources)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO comparisons (key, result, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), now, now)
+            )
+            self._conn.execute("DELETE FROM comparison_books WHERE key = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO comparison_books (key, book) VALUES (?, ?)",
+                [(key, book) for book in set(source['book'] for source in sources)]
+            )
+            self._conn.execute("DELETE FROM comparisons WHERE created < ?", (now - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM comparisons").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM comparisons WHERE key IN (SELECT key FROM comparisons ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.execute("DELETE FROM comparison_books WHERE key NOT IN (SELECT key FROM comparisons)")
+    
+    def get_partials(self, keys):
+        """
+        Return a {key: summary} dict of the cached partial summaries among keys
+        
+        Partial summaries are keyed by the content of the text group they summarize, so they
+        never go stale and are shared by every summary length and comparison that uses the group.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        
+        with self._lock:
+            placeholders = ",".join("?" * len(keys))
+            rows = self._conn.execute(
+                f"SELECT key, summary FROM partial_summaries WHERE key IN ({placeholders}) AND created >= ?",
+                keys + [time.time() - self.ttl_seconds]
+            ).fetchall()
+            self.counters['partial_hits'] += len(rows)
+            self.counters['partial_misses'] += len(keys) - len(rows)
+            if rows:
+                self._conn.execute(
+                    f"UPDATE partial_summaries SET last_used = ? WHERE key IN ({','.join('?' * len(rows))})",
+                    [time.time()] + [key for key, _ in rows]
+                )
+                self._conn.commit()
+        return dict(rows)
+    
+    def put_partial(self, key, summary):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO partial_summaries (key, summary, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, summary, now, now)
+            )
+            self._conn.execute("DELETE FROM partial_summaries WHERE created < ?", (now - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM partial_summaries").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM partial_summaries WHERE key IN "
+                    "(SELECT key FROM partial_summaries ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+    
+    def invalidate_books(self, books):
+        """Forget every answer built from these book files and every summary and comparison of them"""
+        with self._lock, self._conn:
+            for book in books:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT answer_id FROM answer_books WHERE book = ?)", (book,)
+                )
+                self._conn.execute("DELETE FROM answer_books WHERE book = ?", (book,))
+                # Summaries may be keyed by a partial name (without the UUID suffix)
+                self._conn.execute("DELETE FROM summaries WHERE instr(?, book) > 0", (book,))
+                self._conn.execute(
+                    "DELETE FROM comparisons WHERE key IN (SELECT key FROM comparison_books WHERE instr(?, book) > 0)",
+                    (book,)
+                )
+            self._conn.execute("DELETE FROM comparison_books WHERE key NOT IN (SELECT key FROM comparisons)")
+    
+    def stats(self):
+        """Hit/miss counters, hit rates and current sizes"""
+        with self._lock:
+            answers = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            summaries = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            comparisons = self._conn.execute("SELECT COUNT(*) FROM comparisons").fetchone()[0]
+            partials = self._conn.execute("SELECT COUNT(*) FROM partial_summaries").fetchone()[0]
+        stats = dict(self.counters, answers=answers, summaries=summaries, comparisons=comparisons,
+                     partial_summaries=partials, max_entries=self.max_entries)
+        for kind in ('answer', 'summary', 'comparison', 'partial'):
+            lookups = self.counters[f'{kind}_hits'] + self.counters[f'{kind}_misses']
+            stats[f'{kind}_hit_rate'] = self.counters[f'{kind}_hits'] / lookups if lookups else 0.0
+        return stats
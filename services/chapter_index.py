@@ -0,0 +1,138 @@
+import re
+
+# Patrones para identificar capítulos en el texto
+CHAPTER_PATTERNS = [
+    re.compile(r'(?i)capítulo\s+(\d+|[IVX]+)'),
+    re.compile(r'(?i)capítulo\s+(\w+)'),
+    re.compile(r'(?i)chapter\s+(\d+|[IVX]+)'),
+    re.compile(r'^(\d+)\.\s+'),  # Formato: "1. Título del capítulo"
+    re.compile(r'\n(\d+)\.\s+'),  # Formato: después de salto de línea "1. Título"
+    re.compile(r'(?i)sección\s+(\d+|[IVX]+)'),
+    re.compile(r'(?i)section\s+(\d+|[IVX]+)')
+]
+
+# Bumped whenever detection changes, so chapter tables built by an older version are redone
+CHAPTER_INDEX_VERSION = 2
+# A chunk naming this many different chapters is a table of contents (or an index), not a chapter start
+TOC_MIN_CHAPTERS = 4
+# Largest jump between consecutive chapter numbers (a heading lost in extraction can be skipped)
+MAX_CHAPTER_GAP = 2
+
+NUMBER_WORDS = {
+    'uno': 1, 'primero': 1, 'one': 1, 'dos': 2, 'segundo': 2, 'two': 2, 'tres': 3, 'tercero': 3, 'three': 3,
+    'cuatro': 4, 'cuarto': 4, 'four': 4, 'cinco': 5, 'quinto': 5, 'five': 5, 'seis': 6, 'sexto': 6, 'six': 6,
+    'siete': 7, 'séptimo': 7, 'seven': 7, 'ocho': 8, 'octavo': 8, 'eight': 8, 'nueve': 9, 'noveno': 9,
+    'nine': 9, 'diez': 10, 'décimo': 10, 'ten': 10
+}
+ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100}
+
+
+def _chapter_number(chapter_id):
+    """Numeric value of a chapter id (digits, roman numeral or number word), or None"""
+    if chapter_id.isdigit():
+        return int(chapter_id)
+    word = chapter_id.lower()
+    if word in NUMBER_WORDS:
+        return NUMBER_WORDS[word]
+    roman = chapter_id.upper()
+    if roman and all(char in ROMAN_VALUES for char in roman):
+        values = [ROMAN_VALUES[char] for char in roman]
+        return sum(-value if value < next_value else value
+                   for value, next_value in zip(values, values[1:] + [0]))
+    return None
+
+
+def _chapter_mentions(text):
+    """(position, chapter_id, number, heading) of every chapter mention in a chunk, in text order"""
+    mentions = {}
+    for pattern in CHAPTER_PATTERNS:
+        for match in pattern.finditer(text):
+            chapter_id = match.group(1)
+            # "capítulo importante" is not chapter I
+            if text[match.end(1):match.end(1) + 1].isalnum():
+                continue
+            number = _chapter_number(chapter_id)
+            if number is None:
+                continue
+
+            position = match.start()
+            while position < len(text) and text[position].isspace():
+                position += 1
+            # A heading starts its line, or follows the end of a sentence (extracted PDF text has no line breaks)
+            before = text[text.rfind('\n', 0, position) + 1:position].strip()
+            heading = not before or before[-1] in '.!?:'
+            mentions.setdefault(position, (position, chapter_id, number, heading))
+    return sorted(mentions.values())
+
+
+def detect_chapters(chunks):
+    """
+    Find where each chapter of a book starts and the chunks it spans
+
+    Chapter numbers must increase through the book, so cross references ("ver capítulo 5")
+    and chunks that name many chapters (a table of contents) do not start chapters. Headings
+    are preferred; plain mentions are only used for books where no heading is found.
+    A chapter runs until the chunk before the next chapter starts.
+
+    Args:
+        chunks: the book's chunks in ingestion (text) order
+
+    Returns:
+        A list of {chapter_id, title, start_chunk, end_chunk, page_start, page_end} in book order,
+        start_chunk/end_chunk being chunk IDs
+    """
+    candidates = []  # (position in chunks, mention)
+    for position, chunk in enumerate(chunks):
+        mentions = _chapter_mentions(chunk['text'])
+        if len({number for _, _, number, _ in mentions}) >= TOC_MIN_CHAPTERS:
+            continue
+        candidates.extend((position, mention) for mention in mentions)
+
+    starts = _ordered_starts([c for c in candidates if c[1][3]]) or _ordered_starts(candidates)
+
+    chapters = []
+    for i, (position, (start_pos, chapter_id, _, _)) in enumerate(starts):
+        text = chunks[position]['text']
+        # Título: hasta 100 caracteres desde el patrón, sin pasar del salto de línea
+        title = re.sub(r'\n.*', '', text[start_pos:start_pos + 100].strip())
+        # Two chapters starting in the same chunk share it
+        last = max(position, starts[i + 1][0] - 1) if i + 1 < len(starts) else len(chunks) - 1
+        chapters.append({
+            'chapter_id': chapter_id,
+            'title': title,
+            'start_chunk': chunks[position]['index'],
+            'end_chunk': chunks[last]['index'],
+            'page_start': str(chunks[position]['page']),
+            'page_end': str(chunks[last]['page'])
+        })
+    return chapters
+
+
+def _ordered_starts(candidates):
+    """
+    Longest run of candidates, in book order, whose chapter numbers increase by at most MAX_CHAPTER_GAP
+
+    Taking the longest run rather than the first match keeps one stray mention (a preface
+    pointing at a later chapter) from blocking every chapter before it.
+    """
+    # best[number] = (length, index) of the longest run so far ending at that chapter number;
+    # on ties the earliest candidate is kept, so a chapter starts at its first heading
+    best = {}
+    previous = [None] * len(candidates)
+    for i, (_, mention) in enumerate(candidates):
+        number = mention[2]
+        length = 1
+        for earlier in range(number - MAX_CHAPTER_GAP, number):
+            if earlier in best and best[earlier][0] + 1 > length:
+                length, previous[i] = best[earlier][0] + 1, best[earlier][1]
+        if number not in best or length > best[number][0]:
+            best[number] = (length, i)
+    if not best:
+        return []
+
+    i = max(best.values(), key=lambda entry: (entry[0], -entry[1]))[1]
+    starts = []
+    while i is not None:
+        starts.append(candidates[i])
+        i = previous[i]
+    return starts[::-1]
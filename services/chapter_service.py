@@ -1,10 +1,13 @@
+import hashlib
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import google.generativeai as genai
+import numpy as np
 from dotenv import load_dotenv
 
+from . import llm_usage
 from .document_service import DocumentService
 from .vector_store_service import VectorStoreService
 from .embedding_service import EmbeddingService
@@ -12,6 +15,9 @@ from .embedding_service import EmbeddingService
 # Cargar variables de entorno
 load_dotenv()
 
+# Aproximación usada para repartir un capítulo en grupos con presupuesto de tokens
+CHARS_PER_TOKEN = 4
+
 class ChapterService:
     def __init__(self, vector_store=None):
         """
@@ -30,87 +36,48 @@ class ChapterService:
         else:
             self.embedding_service = EmbeddingService()
         
-        # Configurar el modelo Gemini para resúmenes y comparaciones
-        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-        self.model = genai.GenerativeModel(
-            'models/gemini-1.5-pro',
-            generation_config={'temperature': 0.3, 'top_p': 0.8}
-        )
-        
-        # Patrones para identificar capítulos en el texto
-        self.chapter_patterns = [
-            r'(?i)capítulo\s+(\d+|[IVX]+)',
-            r'(?i)capítulo\s+(\w+)',
-            r'(?i)chapter\s+(\d+|[IVX]+)',
-            r'^(\d+)\.\s+', # Formato: "1. Título del capítulo"
-            r'\n(\d+)\.\s+', # Formato: después de salto de línea "1. Título"
-            r'(?i)sección\s+(\d+|[IVX]+)',
-            r'(?i)section\s+(\d+|[IVX]+)'
-        ]
+        # El modelo Gemini para resúmenes y comparaciones se crea al primer uso
+        self._model = None
+        
+        # Capítulos largos: se resumen por grupos de chunks (en paralelo) y luego se reducen
+        self.summary_group_tokens = int(os.getenv('SUMMARY_GROUP_TOKENS', 8000))
+        self._summary_pool = ThreadPoolExecutor(max_workers=int(os.getenv('SUMMARY_WORKERS', 4)),
+                                                thread_name_prefix='summary')
+        
+        # Comparaciones: las fuentes se buscan en paralelo y cada una entra con su presupuesto de texto
+        self.compare_source_tokens = int(os.getenv('COMPARE_SOURCE_TOKENS', 6000))
+        self._compare_pool = ThreadPoolExecutor(max_workers=int(os.getenv('COMPARE_WORKERS', 5)),
+                                                thread_name_prefix='compare')
+    
+    @property
+    def model(self):
+        """Modelo Gemini para resúmenes y comparaciones"""
+        if self._model is None:
+            genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+            self._model = genai.GenerativeModel(
+                'models/gemini-1.5-pro',
+                generation_config={'temperature': 0.3, 'top_p': 0.8}
+            )
+        return self._model
     
     def identify_chapters(self, book_name):
         """Identifica los capítulos disponibles en un libro específico"""
         try:
-            # Obtener el path del libro
-            book_path = None
-            for file in self.document_service.get_all_books():
-                if book_name in os.path.basename(file):
-                    book_path = file
-                    break
-            
-            if not book_path:
+            book = self.vector_store.resolve_book(book_name)
+            if not book:
                 return {"success": False, "message": f"Libro no encontrado: {book_name}"}
             
-            # Obtener chunks del libro desde el vector store
-            query = f"book:{os.path.basename(book_path)}"
-            chunks = self._get_book_chunks(os.path.basename(book_path))
-            
-            if not chunks:
-                return {"success": False, "message": f"No se encontraron chunks para el libro: {book_name}"}
-            
-            # Identificar patrones de capítulos en el texto
-            chapters = {}
-            for chunk in chunks:
-                text = chunk['text']
-                page = chunk['page']
-                
-                # Buscar patrones de capítulo
-                for pattern in self.chapter_patterns:
-                    matches = re.finditer(pattern, text)
-                    for match in matches:
-                        chapter_num = match.group(1)
-                        start_pos = match.start()
-                        
-                        # Extraer título del capítulo (hasta 50 caracteres después del patrón)
-                        title_end = min(start_pos + 100, len(text))
-                        chapter_title = text[start_pos:title_end].strip()
-                        
-                        # Limpiar el título
-                        chapter_title = re.sub(r'\n.*', '', chapter_title)
-                        
-                        if chapter_num not in chapters:
-                            chapters[chapter_num] = {
-                                "title": chapter_title,
-                                "page": page,
-                                "chunks": [chunk['index']]
-                            }
-                        else:
-                            chapters[chapter_num]["chunks"].append(chunk['index'])
-            
-            # Ordenar capítulos
-            sorted_chapters = []
-            for chapter_num, data in chapters.items():
-                sorted_chapters.append({
-                    "chapter_number": chapter_num,
-                    "title": data["title"],
-                    "page": data["page"]
-                })
+            sorted_chapters = [{
+                "chapter_number": chapter['chapter_id'],
+                "title": chapter['title'],
+                "page": chapter['page_start'],
+                "page_end": chapter['page_end']
+            } for chapter in self.vector_store.get_chapters(book)]
             
-            # Ordenar por número de capítulo (si es posible)
+            # Ordenar por número de capítulo (si es posible); si no, quedan en el orden del libro
             try:
                 sorted_chapters.sort(key=lambda x: int(x["chapter_number"]))
             except (ValueError, TypeError):
-                # Si no se puede ordenar numéricamente, dejar como está
                 pass
             
             return {"success": True, "book": book_name, "chapters": sorted_chapters}
@@ -118,55 +85,57 @@ class ChapterService:
         except Exception as e:
             return {"success": False, "message": f"Error al identificar capítulos: {str(e)}"}
     
+    def _find_chapter_chunks(self, book_name, chapter_identifier):
+        """Chunks de un capítulo según la tabla de capítulos, o por búsqueda vectorial si no está"""
+        book = self.vector_store.resolve_book(book_name)
+        chapter_chunks = self.vector_store.get_chapter_chunks(book, chapter_identifier) if book else []
+        if chapter_chunks:
+            return chapter_chunks
+        
+        # Si no encontramos el capítulo en la tabla, buscar usando vector search
+        query = f"capítulo {chapter_identifier} {book_name}"
+        # Buscar solo dentro del libro en vez de filtrar los resultados globales
+        chapter_chunks = self.vector_store.search(query, top_k=10, filters={'books': [book or book_name]})
+        # Ordenar chunks por página
+        chapter_chunks.sort(key=lambda x: int(x['page']) if x['page'].isdigit() else 0)
+        return chapter_chunks
+    
     def summarize_chapter(self, book_name, chapter_identifier, summary_length="medium"):
         """Genera un resumen de un capítulo específico"""
+        # Los resúmenes se reutilizan por (libro, capítulo, longitud) hasta que el libro cambie
+        cache = self.vector_store.answer_cache
+        if cache is not None:
+            cached = cache.get_summary(book_name, chapter_identifier, summary_length)
+            if cached is not None:
+                return cached
+        
         try:
-            # Obtener los chunks del libro
-            chunks = self._get_book_chunks(book_name)
-            if not chunks:
+            if not self.vector_store.resolve_book(book_name):
                 return {"success": False, "message": f"No se encontraron chunks para el libro: {book_name}"}
             
-            # Buscar chunks relacionados con el capítulo
-            chapter_chunks = []
-            
-            # Buscar por título o número de capítulo
-            for chunk in chunks:
-                text = chunk['text']
-                for pattern in self.chapter_patterns:
-                    matches = re.search(pattern, text)
-                    if matches and matches.group(1) == str(chapter_identifier):
-                        chapter_chunks.append(chunk)
-                        break
-            
-            # Si no encontramos chunks por título, buscar usando vector search
-            if not chapter_chunks:
-                query = f"capítulo {chapter_identifier} {book_name}"
-                search_results = self.vector_store.search(query, top_k=10)
-                
-                # Filtrar por libro y similaridad
-                chapter_chunks = [r for r in search_results 
-                                  if book_name in r['book'] and r['score'] > 0.4]
-            
+            # Chunks del capítulo, en el orden del texto
+            chapter_chunks = self._find_chapter_chunks(book_name, chapter_identifier)
             if not chapter_chunks:
                 return {"success": False, "message": f"No se encontró el capítulo {chapter_identifier} en el libro {book_name}"}
             
-            # Ordenar chunks por página o índice
-            chapter_chunks.sort(key=lambda x: int(x['page']) if x['page'].isdigit() else 0)
-            
-            # Construir contexto con el contenido del capítulo
-            chapter_text = "\n\n".join([f"[Página {c['page']}] {c['text']}" for c in chapter_chunks])
+            # El capítulo completo si cabe en un grupo; si no, los resúmenes parciales de sus grupos
+            chapter_text, from_partials = self._chapter_digest(chapter_chunks)
             
             # Generar resumen
-            summary_prompt = self._create_summary_prompt(chapter_text, summary_length)
+            summary_prompt = self._create_summary_prompt(chapter_text, summary_length, from_partials)
+            llm_usage.record_call()
             response = self.model.generate_content(summary_prompt)
             
-            return {
+            result = {
                 "success": True,
                 "book": book_name,
                 "chapter": chapter_identifier,
                 "summary": response.text,
                 "pages": [c['page'] for c in chapter_chunks]
             }
+            if cache is not None:
+                cache.put_summary(book_name, chapter_identifier, summary_length, result)
+            return result
         
         except Exception as e:
             return {"success": False, "message": f"Error al resumir capítulo: {str(e)}"}
@@ -176,69 +145,175 @@ class ChapterService:
         Compara el contenido de múltiples capítulos
         sources = [{"book": "book1", "chapter": "1"}, {"book": "book2", "chapter": "2"}]
         """
+        # Igual que los resúmenes: se reutilizan hasta que alguno de los libros cambie
+        cache = self.vector_store.answer_cache
+        if cache is not None:
+            cached = cache.get_comparison(sources)
+            if cached is not None:
+                return cached
+        
         try:
-            # Preparar información de cada fuente
-            chapters_info = []
-            
-            for source in sources:
-                book_name = source["book"]
-                chapter = source["chapter"]
-                
-                # Buscar chunks de este capítulo
-                chunks = self._get_book_chunks(book_name)
-                chapter_chunks = []
-                
-                # Buscar por título o número de capítulo
-                for chunk in chunks:
-                    text = chunk['text']
-                    for pattern in self.chapter_patterns:
-                        matches = re.search(pattern, text)
-                        if matches and matches.group(1) == str(chapter):
-                            chapter_chunks.append(chunk)
-                            break
-                
-                # Si no encontramos chunks por título, buscar usando vector search
-                if not chapter_chunks:
-                    query = f"capítulo {chapter} {book_name}"
-                    search_results = self.vector_store.search(query, top_k=10)
-                    
-                    # Filtrar por libro y similaridad
-                    chapter_chunks = [r for r in search_results 
-                                      if book_name in r['book'] and r['score'] > 0.4]
-                
-                if chapter_chunks:
-                    # Ordenar chunks y extraer texto
-                    chapter_chunks.sort(key=lambda x: int(x['page']) if x['page'].isdigit() else 0)
-                    chapter_text = "\n\n".join([f"{c['text']}" for c in chapter_chunks])
-                    
-                    chapters_info.append({
-                        "book": book_name,
-                        "chapter": chapter,
-                        "text": chapter_text,
-                        "pages": [c['page'] for c in chapter_chunks]
-                    })
+            # Buscar los chunks de cada fuente en paralelo
+            found = list(self._compare_pool.map(
+                lambda source: self._find_chapter_chunks(source["book"], source["chapter"]), sources
+            ))
+            chapters_info = [{"book": source["book"], "chapter": source["chapter"], "chunks": chunks}
+                             for source, chunks in zip(sources, found) if chunks]
             
             if not chapters_info or len(chapters_info) < 2:
                 return {"success": False, "message": "No se encontraron suficientes capítulos para comparar"}
             
+            # Los capítulos largos ya resumidos entran con sus resúmenes parciales en caché (sin
+            # llamadas a Gemini); el resto, dentro de su presupuesto, recortados por relevancia
+            budget = self.compare_source_tokens * CHARS_PER_TOKEN
+            for info in chapters_info:
+                if sum(len(c['text']) for c in info["chunks"]) > budget:
+                    digest, from_partials = self._chapter_digest(info["chunks"], cached_only=True)
+                    if digest is not None and from_partials:
+                        info["text"], info["summarized"] = digest, True
+            self._fit_source_budgets(chapters_info)
+            for info in chapters_info:
+                chunks = info.pop("chunks")
+                if "text" not in info:
+                    info["text"] = "\n\n".join(f"[Página {c['page']}] {c['text']}" for c in chunks)
+                info["pages"] = [c['page'] for c in chunks]
+            
             # Construir prompt para comparación
             comparison_prompt = self._create_comparison_prompt(chapters_info)
+            llm_usage.record_call()
             response = self.model.generate_content(comparison_prompt)
             
-            return {
+            result = {
                 "success": True,
                 "comparison": response.text,
                 "sources": [{"book": info["book"], "chapter": info["chapter"]} for info in chapters_info]
             }
+            if cache is not None:
+                cache.put_comparison(sources, result)
+            return result
         
         except Exception as e:
             return {"success": False, "message": f"Error al comparar capítulos: {str(e)}"}
     
-    def _get_book_chunks(self, book_name):
-        """Obtiene todos los chunks de un libro desde los metadatos"""
-        return [chunk for chunk in self.vector_store.metadata if book_name in chunk['book']]
+    def _fit_source_budgets(self, chapters_info):
+        """
+        Recorta a compare_source_tokens los chunks de cada fuente que no quepan
+        
+        Se conservan los chunks más cercanos al centroide de todos los capítulos comparados
+        (lo que tienen en común, que es lo que se compara), en el orden del texto. Las fuentes
+        que ya entran como resúmenes parciales no se recortan.
+        """
+        budget = self.compare_source_tokens * CHARS_PER_TOKEN
+        if all(info.get("summarized") or sum(len(c['text']) for c in info["chunks"]) <= budget
+               for info in chapters_info):
+            return
+        
+        vectors = [self.vector_store.get_chunk_vectors(info["chunks"]) for info in chapters_info]
+        centroid = np.concatenate(vectors).mean(axis=0)
+        for info, chunk_vectors in zip(chapters_info, vectors):
+            chunks = info["chunks"]
+            if info.get("summarized") or sum(len(c['text']) for c in chunks) <= budget:
+                continue
+            
+            keep, size = [], 0
+            for position in np.argsort(-(chunk_vectors @ centroid)):
+                if keep and size + len(chunks[position]['text']) > budget:
+                    continue
+                keep.append(position)
+                size += len(chunks[position]['text'])
+            info["chunks"] = [chunks[position] for position in sorted(keep)]
+            info["trimmed"] = True
+    
+    def _chapter_digest(self, chapter_chunks, cached_only=False):
+        """
+        Texto que representa a un capítulo en un prompt, y si son resúmenes parciales
+        
+        Si el capítulo no cabe en un grupo de summary_group_tokens, cada grupo de chunks
+        consecutivos se resume por separado (map) y esos resúmenes se agrupan y resumen
+        otra vez hasta que caben en uno (reduce).
+        
+        Con cached_only=True solo se usan resúmenes parciales en caché; si falta alguno
+        el texto es None.
+        """
+        texts = [f"[Página {c['page']}] {c['text']}" for c in chapter_chunks]
+        from_partials = False
+        while True:
+            groups = self._group_texts(texts)
+            if len(groups) <= 1:
+                return "\n\n".join(texts), from_partials
+            partials = self._summarize_groups(groups, cached_only)
+            if partials is None:
+                return None, True
+            if sum(map(len, partials)) >= sum(map(len, texts)):
+                # Los resúmenes ya no acortan el texto
+                return "\n\n".join(partials), True
+            texts, from_partials = partials, True
+    
+    def _group_texts(self, texts):
+        """Textos consecutivos agrupados sin pasar de summary_group_tokens por grupo"""
+        budget = self.summary_group_tokens * CHARS_PER_TOKEN
+        groups = []
+        current, size = [], 0
+        for text in texts:
+            if current and size + len(text) > budget:
+                groups.append(current)
+                current, size = [], 0
+            current.append(text)
+            size += len(text) + 2
+        if current:
+            groups.append(current)
+        return groups
+    
+    def _summarize_groups(self, groups, cached_only=False):
+        """
+        Resumen parcial de cada grupo, en orden
+        
+        Los grupos que no están en caché se resumen en paralelo en el pool de resúmenes (con
+        cached_only=True se devuelve None en su lugar). La clave es el contenido del grupo, así
+        que sirven para cualquier longitud de resumen y para las comparaciones.
+        """
+        cache = self.vector_store.answer_cache
+        keys = [hashlib.sha1("\n\n".join(group).encode('utf-8')).hexdigest() for group in groups]
+        partials = cache.get_partials(keys) if cache is not None else {}
+        if cached_only and any(key not in partials for key in keys):
+            return None
+        
+        model = self.model
+        futures = {}
+        for key, group in zip(keys, groups):
+            if key not in partials and key not in futures:
+                # llm_usage cuenta por hilo: las llamadas se registran en el hilo de la petición
+                llm_usage.record_call()
+                futures[key] = self._summary_pool.submit(
+                    lambda group=group: model.generate_content(self._create_partial_summary_prompt(group)).text
+                )
+        
+        for key, future in futures.items():
+            partials[key] = future.result()
+            if cache is not None:
+                cache.put_partial(key, partials[key])
+        return [partials[key] for key in keys]
+    
+    def _create_partial_summary_prompt(self, texts):
+        """Prompt del resumen de un grupo de chunks (o de resúmenes parciales)"""
+        fragment = "\n\n".join(texts)
+        
+        prompt = f"""
+        Resume el siguiente fragmento de un capítulo. Este resumen se combinará con los de los
+        demás fragmentos para resumir el capítulo completo.
+        
+        FRAGMENTO:
+        {fragment}
+        
+        INSTRUCCIONES:
+        1. Conserva los conceptos clave, argumentos, ejemplos importantes y conclusiones, en el orden en que aparecen.
+        2. Mantén las referencias de página ([Página N]) de las ideas principales.
+        3. No añadas introducciones ni valoraciones: solo el contenido del fragmento.
+        """
+        
+        return prompt
     
-    def _create_summary_prompt(self, chapter_text, length="medium"):
+    def _create_summary_prompt(self, chapter_text, length="medium", from_partials=False):
         """Crea el prompt para generar el resumen"""
         length_instructions = {
             "short": "Resumen breve y conciso de los puntos más importantes (máximo 250 palabras).",
@@ -248,6 +323,21 @@ class ChapterService:
         
         instruction = length_instructions.get(length, length_instructions["medium"])
         
+        if from_partials:
+            return f"""
+        Necesito un resumen del siguiente capítulo. {instruction}
+        Por su extensión, el capítulo se presenta como resúmenes parciales de sus partes, en orden.
+        
+        RESÚMENES PARCIALES DEL CAPÍTULO:
+        {chapter_text}
+        
+        INSTRUCCIONES:
+        1. El resumen debe mantener la estructura lógica del capítulo.
+        2. Debe incluir los conceptos clave, argumentos principales y conclusiones.
+        3. Integra los resúmenes parciales en un único texto, sin repetir ideas.
+        4. El resumen debe ser comprensible por sí mismo.
+        """
+        
         prompt = f"""
         Necesito un resumen del siguiente capítulo. {instruction}
         
@@ -269,7 +359,7 @@ class ChapterService:
         
         for i, info in enumerate(chapters_info):
             sources_text += f"""
-            FUENTE {i+1} - Libro: {info['book']}, Capítulo: {info['chapter']}
+            FUENTE {i+1} - Libro: {info['book']}, Capítulo: {info['chapter']}{' (resúmenes parciales)' if info.get('summarized') else ' (extractos más relevantes)' if info.get('trimmed') else ''}
             {info['text']}
             
             """
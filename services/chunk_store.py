@@ -0,0 +1,274 @@
+import json
+import threading
+
+from .sqlite_connection import ProcessLocalConnection
+
+
+class ChunkStore:
+    """SQLite table of chunk metadata and text, indexed by chunk ID, book and page"""
+    
+    COLUMNS = ('id', 'book', 'page', 'text', 'chunk_start', 'chunk_end')
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = ProcessLocalConnection(db_path, self._create_schema)
+    
+    @property
+    def _conn(self):
+        return self._connection.get()
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                book TEXT NOT NULL,
+                page TEXT NOT NULL,
+                text TEXT NOT NULL,
+                chunk_start INTEGER NOT NULL DEFAULT 0,
+                chunk_end INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_book ON chunks(book, id);
+            CREATE INDEX IF NOT EXISTS idx_chunks_page ON chunks(book, page);
+            CREATE TABLE IF NOT EXISTS staged_chunks (
+                id INTEGER PRIMARY KEY,
+                book TEXT NOT NULL,
+                page TEXT NOT NULL,
+                text TEXT NOT NULL,
+                chunk_start INTEGER NOT NULL DEFAULT 0,
+                chunk_end INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_staged_chunks_book ON staged_chunks(book, id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chapters (
+                book TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                chapter_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                start_chunk INTEGER NOT NULL,
+                end_chunk INTEGER NOT NULL,
+                page_start TEXT NOT NULL,
+                page_end TEXT NOT NULL,
+                PRIMARY KEY (book, chapter_id)
+            );
+            CREATE TABLE IF NOT EXISTS chapter_scans (
+                book TEXT PRIMARY KEY
+            );
+        """)
+        conn.commit()
+    
+    def _row_to_chunk(self, row):
+        """Rows are exposed with the same keys the metadata list used"""
+        return {
+            'index': row[0],
+            'book': row[1],
+            'page': row[2],
+            'text': row[3],
+            'chunk_start': row[4],
+            'chunk_end': row[5]
+        }
+    
+    def add_chunks(self, chunks, next_id=None, staged=False):
+        """
+        Insert chunk dicts (keyed like the metadata list) in one transaction
+        
+        Staged chunks are a new version of a book that stays invisible until publish_staged.
+        """
+        rows = [(chunk['index'], chunk['book'], str(chunk['page']), chunk['text'],
+                 chunk.get('chunk_start', 0), chunk.get('chunk_end', 0)) for chunk in chunks]
+        table = 'staged_chunks' if staged else 'chunks'
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (id, book, page, text, chunk_start, chunk_end) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            if next_id is not None:
+                self._set_meta('next_id', next_id)
+    
+    def remove_ids(self, chunk_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(int(i),) for i in chunk_ids])
+    
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM chapters")
+            self._conn.execute("DELETE FROM chapter_scans")
+    
+    def get_staged_chunks(self, book):
+        """Staged chunks of a book in ingestion order"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM staged_chunks WHERE book = ? ORDER BY id", (book,)
+            ).fetchall()
+        return [self._row_to_chunk(row) for row in rows]
+    
+    def publish_staged(self, replaced_books, chapters):
+        """
+        Swap staged books in, in one transaction
+        
+        Args:
+            replaced_books: books whose current chunks and chapters are dropped
+            chapters: {book: detect_chapters output} of every staged book to publish
+        """
+        with self._lock, self._conn:
+            for book in set(replaced_books) | set(chapters):
+                self._conn.execute("DELETE FROM chunks WHERE book = ?", (book,))
+                self._conn.execute("DELETE FROM chapters WHERE book = ?", (book,))
+                self._conn.execute("DELETE FROM chapter_scans WHERE book = ?", (book,))
+            for book, book_chapters in chapters.items():
+                self._conn.execute(
+                    f"INSERT INTO chunks ({', '.join(self.COLUMNS)}) "
+                    f"SELECT {', '.join(self.COLUMNS)} FROM staged_chunks WHERE book = ?", (book,)
+                )
+                self._conn.execute("DELETE FROM staged_chunks WHERE book = ?", (book,))
+                self._insert_chapters(book, book_chapters)
+    
+    def clear_staged(self, books=None):
+        """Drop the staged chunks of these books, or every staged chunk (e.g. left by an interrupted rebuild); returns their IDs"""
+        where, params = "", []
+        if books is not None:
+            where = f"WHERE book IN ({','.join('?' * len(books))})"
+            params = list(books)
+        with self._lock, self._conn:
+            ids = [row[0] for row in self._conn.execute(f"SELECT id FROM staged_chunks {where}", params)]
+            self._conn.execute(f"DELETE FROM staged_chunks {where}", params)
+        return ids
+    
+    def get_many(self, chunk_ids):
+        """Return a {chunk_id: chunk} dict for the IDs that exist"""
+        chunk_ids = [int(i) for i in chunk_ids]
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for row in self._conn.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM chunks WHERE id IN ({placeholders})", batch
+                ):
+                    found[row[0]] = self._row_to_chunk(row)
+        return found
+    
+    def get_book_chunks(self, book):
+        """All chunks of a book in ingestion order"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM chunks WHERE book = ? ORDER BY id", (book,)
+            ).fetchall()
+        return [self._row_to_chunk(row) for row in rows]
+    
+    def get_chunk_range(self, book, start_id, end_id):
+        """A book's chunks with IDs between start_id and end_id (inclusive), in ingestion order"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM chunks WHERE book = ? AND id BETWEEN ? AND ? ORDER BY id",
+                (book, int(start_id), int(end_id))
+            ).fetchall()
+        return [self._row_to_chunk(row) for row in rows]
+    
+    def get_book_ids(self, book):
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM chunks WHERE book = ? ORDER BY id", (book,)).fetchall()
+        return [row[0] for row in rows]
+    
+    def filter_ids(self, books=None, page_from=None, page_to=None, chunk_ids=None):
+        """
+        IDs of the chunks matching every given condition, in ingestion order
+        
+        Args:
+            books: exact book filenames
+            page_from, page_to: inclusive numeric page range (non-numeric pages never match)
+            chunk_ids: restrict to these IDs, e.g. the chunks of a chapter
+        """
+        conditions, params = [], []
+        if books is not None:
+            conditions.append(f"book IN ({','.join('?' * len(books))})")
+            params.extend(books)
+        if page_from is not None or page_to is not None:
+            conditions.append("page GLOB '[0-9]*' AND CAST(page AS INTEGER) BETWEEN ? AND ?")
+            params.extend([int(page_from) if page_from is not None else 0,
+                           int(page_to) if page_to is not None else 2 ** 62])
+        if chunk_ids is not None:
+            # One JSON array parameter: a chapter can have more chunks than SQLite allows variables
+            conditions.append("id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([int(i) for i in chunk_ids]))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id FROM chunks {where} ORDER BY id", params).fetchall()
+        return [row[0] for row in rows]
+    
+    def get_books(self):
+        """Distinct book filenames with their chunk counts"""
+        with self._lock:
+            rows = self._conn.execute("SELECT book, COUNT(*) FROM chunks GROUP BY book ORDER BY book").fetchall()
+        return {book: count for book, count in rows}
+    
+    def all_ids(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM chunks ORDER BY id")]
+    
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    
+    def set_chapters(self, book, chapters):
+        """Replace a book's chapter table with detect_chapters output"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chapters WHERE book = ?", (book,))
+            self._insert_chapters(book, chapters)
+    
+    def _insert_chapters(self, book, chapters):
+        rows = [(book, position, chapter['chapter_id'], chapter['title'], chapter['start_chunk'],
+                 chapter['end_chunk'], chapter['page_start'], chapter['page_end'])
+                for position, chapter in enumerate(chapters)]
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO chapters (book, position, chapter_id, title, start_chunk, end_chunk, "
+            "page_start, page_end) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self._conn.execute("INSERT OR REPLACE INTO chapter_scans (book) VALUES (?)", (book,))
+    
+    def get_chapters(self, book):
+        """A book's chapters in book order, or None if the book was never scanned for chapters"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM chapter_scans WHERE book = ?", (book,)).fetchone() is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT chapter_id, title, start_chunk, end_chunk, page_start, page_end FROM chapters "
+                "WHERE book = ? ORDER BY position", (book,)
+            ).fetchall()
+        return [{'chapter_id': row[0], 'title': row[1], 'start_chunk': row[2], 'end_chunk': row[3],
+                 'page_start': row[4], 'page_end': row[5]} for row in rows]
+    
+    def clear_chapters(self):
+        """Forget every chapter table; each book is scanned again on its next chapter request"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chapters")
+            self._conn.execute("DELETE FROM chapter_scans")
+    
+    def remove_chapters(self, book):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chapters WHERE book = ?", (book,))
+            self._conn.execute("DELETE FROM chapter_scans WHERE book = ?", (book,))
+    
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+    
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._set_meta(key, value)
+    
+    def data_version(self):
+        """Changes whenever another connection (another process) commits to the store"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
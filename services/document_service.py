@@ -1,9 +1,14 @@
+import bisect
+import hashlib
 import io
 import os
 import re
 import shutil
 import tempfile
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import docx
@@ -11,6 +16,61 @@ import fitz  # PyMuPDF
 import pytesseract
 from PIL import Image
 
+from .ocr_cache import OCRCache
+
+# Marcador de página que _process_pdf inserta antes del texto de cada página
+PAGE_MARKER_PATTERN = re.compile(r"\[PAGE (\d+)\]", re.IGNORECASE)
+# Otros marcadores probados:
+#   r"(?:p[aá]gina\s+(\d+))"           # página número
+#   r"(?:\n\s*(\d+)\s*\n)"             # \n número \n
+#   r"(?:\n\s*(\d+)-\d+\s*\n)"         # \n número-numero \n
+
+# Potenciales marcadores de sección (encabezados)
+SECTION_HEADING_PATTERN = re.compile(r"\n\s*(?:[A-Z0-9\s]{2,}:?|[IVX]+\.|\d+\.\d+\.|\d+\.)\s*\n")
+
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\s*\n')
+SENTENCE_BREAK_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+
+def _extract_page_text(page, page_num, ocr_settings, cached_ocr=None):
+    """
+    Text of one PDF page, with OCR for pages that look scanned
+    
+    Returns (text, ocr) where ocr is None, 'ocr' (Tesseract ran) or 'cache' (cached_ocr was used)
+    """
+    # Try to get text directly
+    page_text = page.get_text()
+    ocr = None
+    
+    # If the page has very little text, it might be a scanned image
+    # Try OCR if the page text is too short
+    if len(page_text.strip()) < 100:
+        if cached_ocr is not None:
+            return cached_ocr, 'cache'
+        try:
+            # Convert page to image
+            pix = page.get_pixmap(dpi=ocr_settings['dpi'])
+            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+            # Use pytesseract for OCR
+            page_text = pytesseract.image_to_string(img, lang=ocr_settings['lang'])
+            ocr = 'ocr'
+        except Exception as e:
+            print(f"OCR failed for page {page_num+1}: {e}")
+    
+    # Clean text (remove excessive whitespace)
+    return re.sub(r'\s+', ' ', page_text).strip(), ocr
+
+
+def _extract_page_range(file_path, start, end, ocr_settings, cached_ocr):
+    """Process-pool worker: open the PDF and extract pages [start, end)"""
+    results = []
+    with fitz.open(file_path) as doc:
+        for page_num in range(start, end):
+            page_start = time.perf_counter()
+            text, ocr = _extract_page_text(doc[page_num], page_num, ocr_settings, cached_ocr.get(page_num))
+            results.append((page_num, text, time.perf_counter() - page_start, ocr))
+    return results
+
 
 class DocumentService:
     def __init__(self):
@@ -20,6 +80,25 @@ class DocumentService:
         self.chunk_overlap = 250  # overlap between chunks
         self.max_chunk_size = 1500  # absolute maximum size for any chunk
         
+        # PDF pages are extracted (and OCR'd) across this many processes; 1 = in-process.
+        # Each ingestion job forks its own pool from the threaded app, so this is opt-in
+        self.pdf_workers = max(1, int(os.getenv('PDF_WORKERS', 1)))
+        # Per-book page timing of the last extraction, see _page_stats
+        self.extraction_stats = {}
+        
+        # Tesseract language and render resolution; both are part of the OCR cache key
+        self.ocr_settings = {'lang': os.getenv('OCR_LANG', 'eng'), 'dpi': int(os.getenv('OCR_DPI', 72))}
+        
+        # OCR output survives reindexing, re-uploads under a new name and deletions
+        self.ocr_cache = None
+        if os.getenv('OCR_CACHE', 'true').lower() in ('1', 'true', 'yes'):
+            data_dir = os.path.join(self.base_dir, 'data')
+            os.makedirs(data_dir, exist_ok=True)
+            self.ocr_cache = OCRCache(
+                os.path.join(data_dir, 'ocr_cache.sqlite'),
+                max_entries=int(os.getenv('OCR_CACHE_MAX_ENTRIES', 50000))
+            )
+        
         # Create books directory if it doesn't exist
         os.makedirs(self.books_dir, exist_ok=True)
     
@@ -50,57 +129,169 @@ class DocumentService:
         
         return all_files
     
-    def extract_text_with_metadata(self, file_path):
-        """Extract text from file with metadata (page numbers, etc.)"""
+    def get_file_hash(self, file_path):
+        """Return the SHA-256 of a file's content"""
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+    
+    def extract_text_with_metadata(self, file_path, progress=None):
+        """
+        Extract text from file with metadata (page numbers, etc.)
+        
+        progress: optional callable(pages_done, pages_total), called as pages are extracted
+        """
         file_extension = os.path.splitext(file_path)[1].lower()
         book_name = os.path.basename(file_path)
         
         if file_extension == '.pdf':
-            return self._process_pdf(file_path, book_name)
+            return self._process_pdf(file_path, book_name, progress)
         elif file_extension == '.txt':
-            return self._process_txt(file_path, book_name)
+            chunks = self._process_txt(file_path, book_name)
         elif file_extension in ['.doc', '.docx']:
-            return self._process_docx(file_path, book_name)
+            chunks = self._process_docx(file_path, book_name)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
+        
+        # Text and Word files are read in one go: a single "page"
+        if progress:
+            progress(1, 1)
+        return chunks
+    
+    def iter_chunks(self, file_path, progress=None):
+        """
+        Same chunks as extract_text_with_metadata, yielded as they are produced
+        
+        PDFs are chunked page by page, so only a window of pages is ever held in memory.
+        Unlike extract_text_with_metadata, extraction errors are raised, not swallowed.
+        """
+        file_extension = os.path.splitext(file_path)[1].lower()
+        if file_extension == '.pdf':
+            yield from self._iter_pdf_chunks(file_path, os.path.basename(file_path), progress)
+        else:
+            yield from self.extract_text_with_metadata(file_path, progress)
     
-    def _process_pdf(self, file_path, book_name):
+    def _process_pdf(self, file_path, book_name, progress=None):
         """Extract text from PDF file with page numbers"""
-        chunks = []
         try:
-            doc = fitz.open(file_path)
-            full_text = ""
-            
-            for page_num, page in enumerate(doc):
-                # Try to get text directly
-                page_text = page.get_text()
-                
-                # If the page has very little text, it might be a scanned image
-                # Try OCR if the page text is too short
-                if len(page_text.strip()) < 100:
-                    try:
-                        # Convert page to image
-                        pix = page.get_pixmap()
-                        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                        # Use pytesseract for OCR
-                        page_text = pytesseract.image_to_string(img)
-                    except Exception as e:
-                        print(f"OCR failed for page {page_num+1}: {e}")
-                
-                # Clean text (remove excessive whitespace)
-                page_text = re.sub(r'\s+', ' ', page_text).strip()
-                
-                if page_text:
-                    # Add page metadata
-                    full_text += f"\n\n[PAGE {page_num+1}]\n{page_text}"
-            
-            # Create chunks with page information
-            chunks = self._create_chunks_with_metadata(full_text, book_name)
-            
+            return list(self._iter_pdf_chunks(file_path, book_name, progress))
         except Exception as e:
             print(f"Error processing PDF {file_path}: {e}")
+            return []
+    
+    def _iter_pdf_chunks(self, file_path, book_name, progress=None):
+        """Chunk a PDF as its pages are extracted, with the offsets _create_chunks_with_metadata would give"""
+        # Offsets in the text _process_pdf used to build: "\n\n[PAGE n]\n" + page text per page,
+        # with the markers removed
+        page_offsets = []
+        page_numbers = []
         
-        return chunks
+        def paragraphs():
+            offset = 0
+            for page_num, text in self._iter_pdf_pages(file_path, book_name, progress):
+                if not text:
+                    continue
+                page_offsets.append(offset + 2)
+                page_numbers.append(str(page_num + 1))
+                offset += 3
+                # Page text is whitespace-collapsed, so each page is a single paragraph
+                yield offset, text
+                offset += len(text)
+        
+        yield from self._chunk_paragraphs(paragraphs(), page_offsets, page_numbers, book_name)
+    
+    def _iter_pdf_pages(self, file_path, book_name, progress=None):
+        """Yield (page_num, text) in page order, recording timings in extraction_stats"""
+        wall_start = time.perf_counter()
+        
+        # OCR results already known for this exact file content
+        cached_ocr = {}
+        if self.ocr_cache is not None:
+            file_hash = self.get_file_hash(file_path)
+            settings_key = self._ocr_settings_key()
+            cached_ocr = self.ocr_cache.get_document(file_hash, settings_key)
+        
+        with fitz.open(file_path) as doc:
+            page_count = len(doc)
+        workers = max(1, min(self.pdf_workers, page_count))
+        if workers > 1:
+            page_results = self._extract_pages_parallel(file_path, page_count, workers, cached_ocr)
+        else:
+            page_results = self._extract_pages_serial(file_path, cached_ocr)
+        
+        # Only timings are kept for the stats; page text is handed on and forgotten
+        timings = []
+        new_ocr = {}
+        for page_num, text, seconds, ocr in page_results:
+            if progress:
+                progress(page_num + 1, page_count)
+            timings.append((page_num, seconds, ocr))
+            if self.ocr_cache is not None and ocr == 'ocr':
+                new_ocr[page_num] = text
+                if len(new_ocr) >= 64:
+                    self.ocr_cache.put_pages(file_hash, settings_key, new_ocr)
+                    new_ocr = {}
+            yield page_num, text
+        
+        if progress:
+            progress(page_count, page_count)
+        
+        if self.ocr_cache is not None:
+            self.ocr_cache.put_pages(file_hash, settings_key, new_ocr)
+            self.ocr_cache.record_lookups(
+                hits=sum(1 for timing in timings if timing[2] == 'cache'),
+                misses=sum(1 for timing in timings if timing[2] == 'ocr')
+            )
+        
+        self.extraction_stats[book_name] = self._page_stats(timings, workers, time.perf_counter() - wall_start)
+        print(f"Extracted {page_count} pages of {book_name}: {self.extraction_stats[book_name]}")
+    
+    def _ocr_settings_key(self):
+        return f"lang={self.ocr_settings['lang']};dpi={self.ocr_settings['dpi']}"
+    
+    def _extract_pages_serial(self, file_path, cached_ocr):
+        with fitz.open(file_path) as doc:
+            for page_num, page in enumerate(doc):
+                page_start = time.perf_counter()
+                text, ocr = _extract_page_text(page, page_num, self.ocr_settings, cached_ocr.get(page_num))
+                yield page_num, text, time.perf_counter() - page_start, ocr
+    
+    def _extract_pages_parallel(self, file_path, page_count, workers, cached_ocr):
+        """Fan page ranges out to a process pool (each worker opens the PDF itself) and yield pages in order"""
+        # Several small ranges per worker so a run of scanned pages does not stall one process
+        range_size = max(1, min(32, -(-page_count // (workers * 4))))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Only a window of ranges is in flight, so extracted text never piles up
+            pending = deque()
+            for start in range(0, page_count, range_size):
+                end = min(start + range_size, page_count)
+                range_cache = {page_num: text for page_num, text in cached_ocr.items() if start <= page_num < end}
+                pending.append(pool.submit(_extract_page_range, file_path, start, end, self.ocr_settings, range_cache))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+    
+    def _page_stats(self, timings, workers, wall_seconds):
+        """Timing summary of a PDF extraction from (page_num, seconds, ocr) tuples (seconds)"""
+        times = sorted(seconds for _, seconds, _ in timings)
+        if not times:
+            return {'pages': 0, 'workers': workers, 'wall_s': round(wall_seconds, 3)}
+        slowest = max(timings, key=lambda timing: timing[1])
+        return {
+            'pages': len(times),
+            'ocr_pages': sum(1 for timing in timings if timing[2] == 'ocr'),
+            'ocr_cached_pages': sum(1 for timing in timings if timing[2] == 'cache'),
+            'workers': workers,
+            'wall_s': round(wall_seconds, 3),
+            'page_total_s': round(sum(times), 3),
+            'page_mean_s': round(sum(times) / len(times), 4),
+            'page_p95_s': round(times[min(len(times) - 1, int(0.95 * len(times)))], 4),
+            'slowest_page': slowest[0] + 1,
+            'slowest_page_s': round(slowest[1], 4)
+        }
     
     def _process_txt(self, file_path, book_name):
         """Extract text from TXT file"""
@@ -123,151 +314,149 @@ class DocumentService:
             return []
     
     def _create_chunks_with_metadata(self, text, book_name):
+        """
+        Split text into chunks respecting paragraph boundaries when possible
+        
+        chunk_start/chunk_end are offsets into the text once the [PAGE n] markers are removed;
+        a chunk belongs to the last page marker at or before its start.
+        """
         print(f"Creating chunks for {book_name}")
-        """Split text into chunks respecting paragraph boundaries when possible"""
-        chunks = []
+        clean_text, page_offsets, page_numbers = self._strip_page_markers(text)
+        paragraphs = ((start, clean_text[start:end]) for start, end in self._paragraph_spans(clean_text))
+        return list(self._chunk_paragraphs(paragraphs, page_offsets, page_numbers, book_name))
+    
+    def _chunk_paragraphs(self, paragraphs, page_offsets, page_numbers, book_name):
+        """
+        Yield chunks from (offset, paragraph) pairs as soon as each one is complete
         
-        # Patrón para detectar marcadores de página
-        page_pattern = (
-            r"(?:\[PAGE (\d+)\])|"            # [PAGE número]
-            # r"(?:p[aá]gina\s+(\d+))|"         # página número
-            # r"(?:\n\s*(\d+)\s*\n)|"           # \n número \n
-            # r"(?:\s*(\d+)\s*\n)|"           #  número \n
-
-            # r"(?:\n\s*(\d+)-\d+\s*\n)|"       # \n número-numero \n
-            # r"(?:^(\d+)-\d+\n)|"              # número-numero\n (sin espacio a la izquierda)
-            # r"(?:^(\d+)-\d+\s*\n)"            # número-numero\n (con o sin espacio a la izquierda)
-        )
+        page_offsets/page_numbers may grow while paragraphs is consumed, as long as the
+        pages before a paragraph are there by the time it is yielded.
+        """
+        def make_chunk(chunk_text, start, end):
+            page_index = bisect.bisect_right(page_offsets, start) - 1
+            return {
+                "text": chunk_text.strip(),
+                "page": page_numbers[page_index] if page_index >= 0 else "0",
+                "book": book_name,
+                "chunk_start": start,
+                "chunk_end": end
+            }
         
-        # Potenciales marcadores de sección (encabezados)
-        section_pattern = r"\n\s*(?:[A-Z0-9\s]{2,}:?|[IVX]+\.|\d+\.\d+\.|\d+\.)\s*\n"
+        # Paragraphs of the chunk being built, their joined length and the span they cover
+        current = []
+        current_length = 0
+        current_start = current_end = 0
         
-        # Track page numbers and their positions
-        page_positions = {}
-        for match in re.finditer(page_pattern, text, flags=re.IGNORECASE):
-            page_num = None
-            for g in match.groups():
-                if g:
-                    page_num = g
-                    break
-                
+        for paragraph_start, paragraph in paragraphs:
+            paragraph_end = paragraph_start + len(paragraph)
             
-            if page_num:
-                position = match.start()
-                page_positions[position] = page_num
-        
-        # Remove page markers from text
-        clean_text = re.sub(page_pattern, "", text, flags=re.IGNORECASE)
-        
-        # Split text into paragraphs
-        paragraphs = re.split(r'\n\s*\n', clean_text)
-        
-        current_chunk = ""
-        current_position = 0
-        processed_length = 0
-        
-        for paragraph in paragraphs:
-            paragraph = paragraph.strip()
-            if not paragraph:
-                processed_length += 2  # Account for paragraph separators
-                continue
-                
             # Check if paragraph is a section heading
-            is_section_heading = bool(re.match(section_pattern, "\n" + paragraph + "\n"))
+            is_section_heading = bool(SECTION_HEADING_PATTERN.match("\n" + paragraph + "\n"))
             
             # If adding this paragraph would exceed chunk size or if it's a new section
-            if len(current_chunk) + len(paragraph) > self.chunk_size or is_section_heading:
+            if current_length + len(paragraph) > self.chunk_size or is_section_heading:
                 # Save current chunk if not empty
-                if current_chunk.strip():
-                    # Determine the page for this chunk
-                    current_page = self._get_page_for_position(current_position, page_positions)
-                    chunks.append({
-                        "text": current_chunk.strip(),
-                        "page": current_page,
-                        "book": book_name
-                    })
-                
+                if current:
+                    yield make_chunk("\n\n".join(current), current_start, current_end)
                 # Start a new chunk
-                current_chunk = paragraph
-                current_position = processed_length
+                current = [paragraph]
+                current_length = len(paragraph)
+                current_start = paragraph_start
             else:
                 # Add paragraph to current chunk
-                if current_chunk:
-                    current_chunk += "\n\n" + paragraph
+                if current:
+                    current_length += 2 + len(paragraph)
                 else:
-                    current_chunk = paragraph
-                    current_position = processed_length
+                    current_length = len(paragraph)
+                    current_start = paragraph_start
+                current.append(paragraph)
+            current_end = paragraph_end
             
-            processed_length += len(paragraph) + 2  # +2 for paragraph separators
-            
-            # Handle paragraphs that are longer than chunk_size
+            # Paragraphs longer than max_chunk_size are split by sentences and form their own chunks
             if len(paragraph) > self.max_chunk_size:
-                # Try to split by sentences
-                sentences = re.split(r'(?<=[.!?])\s+', paragraph)
-                temp_chunk = ""
-                sentence_position = current_position
-                
-                for sentence in sentences:
-                    if len(temp_chunk) + len(sentence) > self.max_chunk_size:
-                        if temp_chunk:
-                            # Save the accumulated sentences
-                            current_page = self._get_page_for_position(sentence_position, page_positions)
-                            chunks.append({
-                                "text": temp_chunk.strip(),
-                                "page": current_page,
-                                "book": book_name
-                            })
-                            
-                            # Reset for new chunk
-                            sentence_position += len(temp_chunk)
-                            temp_chunk = sentence
-                        else:
-                            # Handle extremely long sentences by character splitting
-                            for i in range(0, len(sentence), self.max_chunk_size):
-                                sub_sentence = sentence[i:i + self.max_chunk_size]
-                                if sub_sentence.strip():
-                                    sub_position = sentence_position + i
-                                    current_page = self._get_page_for_position(sub_position, page_positions)
-                                    chunks.append({
-                                        "text": sub_sentence.strip(),
-                                        "page": current_page,
-                                        "book": book_name
-                                    })
-                    else:
-                        if temp_chunk:
-                            temp_chunk += " " + sentence
-                        else:
-                            temp_chunk = sentence
-                
-                # Add the last chunk if not empty
-                if temp_chunk.strip():
-                    current_page = self._get_page_for_position(sentence_position, page_positions)
-                    chunks.append({
-                        "text": temp_chunk.strip(),
-                        "page": current_page,
-                        "book": book_name
-                    })
-                
-                # Reset current chunk since we've handled this long paragraph
-                current_chunk = ""
+                for chunk_text, start, end in self._split_long_paragraph(paragraph, paragraph_start):
+                    if chunk_text.strip():
+                        yield make_chunk(chunk_text, start, end)
+                current = []
+                current_length = 0
         
         # Don't forget the last chunk
-        if current_chunk.strip():
-            current_page = self._get_page_for_position(current_position, page_positions)
-            chunks.append({
-                "text": current_chunk.strip(),
-                "page": current_page,
-                "book": book_name
-            })
-        
-        return chunks
+        if current:
+            yield make_chunk("\n\n".join(current), current_start, current_end)
+    
+    def _strip_page_markers(self, text):
+        """Remove [PAGE n] markers; returns the clean text, the sorted marker offsets in it and their page numbers"""
+        pieces = []
+        page_offsets = []
+        page_numbers = []
+        removed = 0
+        last_end = 0
+        for match in PAGE_MARKER_PATTERN.finditer(text):
+            pieces.append(text[last_end:match.start()])
+            page_offsets.append(match.start() - removed)
+            page_numbers.append(match.group(1))
+            removed += match.end() - match.start()
+            last_end = match.end()
+        pieces.append(text[last_end:])
+        return "".join(pieces), page_offsets, page_numbers
     
-    def _get_page_for_position(self, position, page_positions):
-        """Determine the page number for a given position in the text"""
-        current_page = "0"
-        for pos, page in sorted(page_positions.items()):
-            if pos <= position:
-                current_page = page
+    def _paragraph_spans(self, text):
+        """(start, end) of every non-empty paragraph, with surrounding whitespace excluded"""
+        position = 0
+        for separator in PARAGRAPH_BREAK_PATTERN.finditer(text):
+            span = self._strip_span(text, position, separator.start())
+            if span:
+                yield span
+            position = separator.end()
+        span = self._strip_span(text, position, len(text))
+        if span:
+            yield span
+    
+    def _strip_span(self, text, start, end):
+        piece = text[start:end]
+        stripped = piece.lstrip()
+        if not stripped:
+            return None
+        start += len(piece) - len(stripped)
+        return start, start + len(stripped.rstrip())
+    
+    def _split_long_paragraph(self, paragraph, paragraph_start):
+        """Yield (text, start, end) groups of sentences of a long paragraph, each at most max_chunk_size characters"""
+        sentences = []
+        length = 0
+        start = end = paragraph_start
+        
+        position = 0
+        sentence_spans = []
+        for separator in SENTENCE_BREAK_PATTERN.finditer(paragraph):
+            sentence_spans.append((position, separator.start()))
+            position = separator.end()
+        sentence_spans.append((position, len(paragraph)))
+        
+        for sentence_start, sentence_end in sentence_spans:
+            sentence = paragraph[sentence_start:sentence_end]
+            if sentences and length + len(sentence) > self.max_chunk_size:
+                # Save the accumulated sentences
+                yield " ".join(sentences), start, end
+                sentences = []
+                length = 0
+            
+            if len(sentence) > self.max_chunk_size:
+                # Handle extremely long sentences by character splitting
+                for i in range(0, len(sentence), self.max_chunk_size):
+                    yield (sentence[i:i + self.max_chunk_size],
+                           paragraph_start + sentence_start + i,
+                           paragraph_start + min(sentence_start + i + self.max_chunk_size, sentence_end))
+                continue
+            
+            if sentences:
+                length += 1 + len(sentence)
             else:
-                break
-        return current_page
+                length = len(sentence)
+                start = paragraph_start + sentence_start
+            sentences.append(sentence)
+            end = paragraph_start + sentence_end
+        
+        # Add the last chunk if not empty
+        if sentences:
+            yield " ".join(sentences), start, end
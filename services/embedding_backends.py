@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+# 'torch' is the reference fp32 SentenceTransformer; the others trade a little accuracy for CPU speed
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+
+def load_model(model_name, backend, export_dir):
+    """
+    Load the embedding model for a backend
+    
+    Every backend returns an object with the SentenceTransformer methods EmbeddingService uses
+    (encode and get_sentence_embedding_dimension).
+    
+    Args:
+        model_name: sentence-transformers model name
+        backend: one of BACKENDS
+        export_dir: where ONNX exports are written, one subdirectory per model
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    
+    # The reference model also provides the tokenizer and pooling settings of the others
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device='cpu')
+    
+    if backend == 'torch':
+        return model
+    if backend == 'torch-int8':
+        import torch
+        # int8 weights for the Linear layers, activations quantized on the fly
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return OnnxEncoder(model, os.path.join(export_dir, model_name.replace('/', '__')),
+                       quantize=backend == 'onnx-int8')
+
+
+class OnnxEncoder:
+    """The transformer of a SentenceTransformer exported to ONNX and run with ONNX Runtime"""
+    
+    def __init__(self, model, model_dir, quantize=False):
+        """
+        Args:
+            model: the loaded SentenceTransformer (Transformer + Pooling [+ Normalize] modules)
+            model_dir: export directory; model.onnx (and model_int8.onnx) are created once
+            quantize: run the dynamically quantized int8 export
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx embedding backends need onnxruntime: pip install onnxruntime")
+        
+        transformer, pooling = model[0], model[1]
+        self.tokenizer = transformer.tokenizer
+        self.max_seq_length = transformer.max_seq_length
+        if pooling.pooling_mode_cls_token:
+            self.pooling = 'cls'
+        elif pooling.pooling_mode_mean_tokens:
+            self.pooling = 'mean'
+        else:
+            raise ValueError("Only CLS and mean pooling models can run on the onnx backend")
+        self.dimension = model.get_sentence_embedding_dimension()
+        # Models ending in a Normalize module always return unit vectors
+        self.always_normalize = any(type(module).__name__ == 'Normalize' for module in model)
+        
+        os.makedirs(model_dir, exist_ok=True)
+        path = os.path.join(model_dir, 'model.onnx')
+        if not os.path.exists(path):
+            self._export(transformer.auto_model, path)
+        if quantize:
+            quantized_path = os.path.join(model_dir, 'model_int8.onnx')
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantize_dynamic(path, quantized_path + '.tmp', weight_type=QuantType.QInt8)
+                os.replace(quantized_path + '.tmp', quantized_path)
+            path = quantized_path
+        
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        print(f"Loaded ONNX embedding model: {path}")
+    
+    def _export(self, auto_model, path):
+        import torch
+        sample = self.tokenizer(["Biblioteca Faro"], return_tensors='pt')
+        input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+        
+        auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                auto_model, tuple(sample[name] for name in input_names), path + '.tmp',
+                input_names=input_names, output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes, opset_version=14
+            )
+        os.replace(path + '.tmp', path)
+        print(f"Exported embedding model to {path}")
+    
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+    
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        """Same contract as SentenceTransformer.encode with convert_to_numpy=True"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        embeddings = np.zeros((len(texts), self.dimension), dtype='float32')
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            hidden = self.session.run(None, {name: tokens[name].astype('int64') for name in self.input_names})[0]
+            if self.pooling == 'cls':
+                pooled = hidden[:, 0]
+            else:
+                mask = tokens['attention_mask'][..., None].astype('float32')
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings[start:start + len(pooled)] = pooled
+        
+        if normalize_embeddings or self.always_normalize:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
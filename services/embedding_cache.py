@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+from .sqlite_connection import ProcessLocalConnection
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by model name and text hash, with LRU eviction
+    
+    Meant for query embeddings: chunk vectors are already kept in the embedding store.
+    """
+    
+    def __init__(self, db_path, model_name, max_entries=100000):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self._lock = threading.Lock()
+        self._connection = ProcessLocalConnection(db_path, self._create_schema)
+    
+    @property
+    def _conn(self):
+        return self._connection.get()
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        
+        # Number of entries, kept by triggers so no write has to count the table (in any process)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS embeddings_inserted AFTER INSERT ON embeddings
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'entries'; END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS embeddings_deleted AFTER DELETE ON embeddings
+            BEGIN UPDATE meta SET value = value - 1 WHERE key = 'entries'; END
+        """)
+        # Caches created before the counter: counted once
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'entries', COUNT(*) FROM embeddings")
+        conn.commit()
+    
+    def _key(self, text):
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode('utf-8')).digest()
+    
+    def get_many(self, texts):
+        """Return a {position: vector} dict for the cached texts"""
+        keys = [self._key(text) for text in texts]
+        found = {}
+        
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                vectors = {key: vector for key, vector in rows}
+                for offset, key in enumerate(batch):
+                    if key in vectors:
+                        found[start + offset] = np.frombuffer(vectors[key], dtype='float32')
+            
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, keys[i]) for i in found]
+                )
+                self._conn.commit()
+            
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        
+        return found
+    
+    def put_many(self, texts, embeddings):
+        """Store embeddings for texts and evict the least recently used entries"""
+        now = time.time()
+        rows = [(self._key(text), np.asarray(embedding, dtype='float32').tobytes(), now)
+                for text, embedding in zip(texts, embeddings)]
+        if not rows:
+            return
+        
+        with self._lock:
+            # An upsert, not INSERT OR REPLACE: a replaced row would fire the insert trigger only
+            self._conn.executemany(
+                "INSERT INTO embeddings (key, vector, last_used) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET vector = excluded.vector, last_used = excluded.last_used",
+                rows
+            )
+            count = self._entries()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+    
+    def _entries(self):
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'entries'").fetchone()[0]
+    
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries
+        }
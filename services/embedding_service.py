@@ -1,19 +1,152 @@
+import atexit
 import os
+import threading
+import time
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from .embedding_backends import BACKENDS, load_model
+from .embedding_cache import EmbeddingCache
 
 
 class EmbeddingService:
-    def __init__(self, model_name='multi-qa-mpnet-base-dot-v1'):
+    def __init__(self, model_name='multi-qa-mpnet-base-dot-v1', use_cache=True, backend=None):
         """Initialize the embedding service with the specified model"""
+        self.model_name = model_name
+        self.base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        
+        # EMBEDDING_BACKEND: 'torch' (fp32 reference), 'torch-int8', 'onnx' or 'onnx-int8'.
+        # Vectors already stored for the model are kept when the backend changes; see
+        # benchmarks/embedding_parity.py for how close each backend is to the reference
+        self.backend = backend or os.getenv('EMBEDDING_BACKEND', 'torch')
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {self.backend}")
+        
+        # The model is loaded on the first encode, not at import time
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.model_load_seconds = None
+        
+        # Texts per forward pass, and processes encoding large batches ('auto' = one per core).
+        # The process pool is only started for batches of at least batch_size * processes texts
+        self.batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+        processes = os.getenv('EMBEDDING_PROCESSES', '1')
+        self.processes = (os.cpu_count() or 1) if processes == 'auto' else max(1, int(processes))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        
+        # Texts encoded by the model and the time it took, for chunks/s
+        self.encoded_texts = 0
+        self.encode_seconds = 0.0
+        self._stats_lock = threading.Lock()
+        
+        # Persistent cache of query embeddings; chunk vectors are kept by the vector store's
+        # embedding store, so ingestion batches skip it
+        self.cache = None
+        if use_cache:
+            data_dir = os.path.join(self.base_dir, 'data')
+            os.makedirs(data_dir, exist_ok=True)
+            self.cache = EmbeddingCache(
+                os.path.join(data_dir, 'embedding_cache.sqlite'),
+                # Query vectors come from the active backend, so it is part of the key
+                model_name if self.backend == 'torch' else f"{model_name}:{self.backend}",
+                max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 100000))
+            )
+    
+    @property
+    def model(self):
+        """The SentenceTransformer (or the backend's equivalent), loaded on first use"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._load_model()
+        return self._model
+    
+    def _load_model(self):
         try:
-            self.model = SentenceTransformer(model_name)
-            print(f"Loaded embedding model: {model_name}")
+            # Importing sentence_transformers pulls in torch, so it is deferred too
+            start = time.perf_counter()
+            self._model = load_model(self.model_name, self.backend, os.path.join(self.base_dir, 'data', 'onnx'))
+            self.model_load_seconds = time.perf_counter() - start
+            print(f"Loaded embedding model: {self.model_name} [{self.backend}] ({self.model_load_seconds:.1f}s)")
         except Exception as e:
             print(f"Error loading embedding model: {e}")
             raise
     
+    @property
+    def model_loaded(self):
+        return self._model is not None
+    
+    def _get_pool(self):
+        """Start the multi-process encode pool on first use (callers hold _pool_lock)"""
+        if self._pool is None:
+            # Each worker gets its share of the cores instead of one torch thread per core each
+            threads = str(max(1, (os.cpu_count() or 1) // self.processes))
+            previous = os.environ.get('OMP_NUM_THREADS')
+            os.environ['OMP_NUM_THREADS'] = threads
+            try:
+                self._pool = self.model.start_multi_process_pool(target_devices=['cpu'] * self.processes)
+            finally:
+                if previous is None:
+                    del os.environ['OMP_NUM_THREADS']
+                else:
+                    os.environ['OMP_NUM_THREADS'] = previous
+            atexit.register(self.close)
+            print(f"Started embedding pool: {self.processes} processes, OMP_NUM_THREADS={threads}")
+        return self._pool
+    
+    def close(self):
+        """Stop the encode pool, if one was started"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self.model.stop_multi_process_pool(self._pool)
+                self._pool = None
+    
+    def _encode(self, texts):
+        """Encode normalized embeddings, longest texts first, on the process pool for large batches"""
+        start = time.perf_counter()
+        
+        # Texts of similar length share a batch, so less padding is computed; this also keeps
+        # the slices handed to each pool process homogeneous
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        sorted_texts = [texts[i] for i in order]
+        
+        # Only the reference model can be shipped to the pool processes
+        if self.backend == 'torch' and self.processes > 1 and len(texts) >= self.batch_size * self.processes:
+            # The pool's queues are shared, so one batch at a time
+            with self._pool_lock:
+                sorted_embeddings = self.model.encode_multi_process(
+                    sorted_texts, self._get_pool(), batch_size=self.batch_size
+                )
+            sorted_embeddings = sorted_embeddings / np.linalg.norm(sorted_embeddings, axis=1, keepdims=True)
+        else:
+            sorted_embeddings = self.model.encode(sorted_texts, batch_size=self.batch_size,
+                                                  normalize_embeddings=True)
+        
+        embeddings = np.empty_like(sorted_embeddings, dtype='float32')
+        embeddings[order] = sorted_embeddings
+        
+        seconds = time.perf_counter() - start
+        with self._stats_lock:
+            self.encoded_texts += len(texts)
+            self.encode_seconds += seconds
+        if len(texts) >= 1000:
+            print(f"Encoded {len(texts)} texts in {seconds:.1f}s ({len(texts) / seconds:.0f} chunks/s)")
+        return embeddings
+    
+    def throughput_stats(self):
+        """Encoding settings and the chunks/s achieved so far"""
+        with self._stats_lock:
+            encoded, seconds = self.encoded_texts, self.encode_seconds
+        return {
+            'backend': self.backend,
+            'batch_size': self.batch_size,
+            'processes': self.processes,
+            'encoded': encoded,
+            'encode_s': round(seconds, 3),
+            'chunks_per_s': round(encoded / seconds, 1) if seconds else None
+        }
+    
     def get_embedding(self, text):
         """Get embedding for a single text"""
         if not text or not text.strip():
@@ -22,15 +155,26 @@ class EmbeddingService:
         try:
             # Normalize text
             text = text.strip().replace('\n', ' ')
-            # Generate embedding
-            embedding = self.model.encode(text, normalize_embeddings=True)
+            if self.cache is not None:
+                cached = self.cache.get_many([text])
+                if cached:
+                    return cached[0]
+            
+            # Same path as batches: batch size, backend and throughput stats
+            embedding = self._encode([text])[0]
+            if self.cache is not None:
+                self.cache.put_many([text], [embedding])
             return embedding
         except Exception as e:
             print(f"Error generating embedding: {e}")
             return None
     
-    def get_embeddings(self, texts):
-        """Get embeddings for a list of texts"""
+    def get_embeddings(self, texts, use_cache=True):
+        """
+        Get embeddings for a list of texts
+        
+        use_cache=False skips the embedding cache (chunk texts, whose vectors are stored elsewhere).
+        """
         if not texts:
             return []
         
@@ -40,13 +184,37 @@ class EmbeddingService:
             return []
         
         try:
-            # Generate embeddings in batch with normalization
-            embeddings = self.model.encode(valid_texts, normalize_embeddings=True)
+            if self.cache is None or not use_cache:
+                # Generate embeddings in batch with normalization
+                return self._encode(valid_texts)
+            
+            # Only encode the texts the cache has not seen for this model
+            cached = self.cache.get_many(valid_texts)
+            missing = [i for i in range(len(valid_texts)) if i not in cached]
+            if not missing:
+                # Fully cached batches never need the model loaded
+                return np.array([cached[i] for i in range(len(valid_texts))], dtype='float32')
+            
+            dimension = self.model.get_sentence_embedding_dimension()
+            embeddings = np.zeros((len(valid_texts), dimension), dtype='float32')
+            for i, embedding in cached.items():
+                embeddings[i] = embedding
+            
+            if missing:
+                missing_texts = [valid_texts[i] for i in missing]
+                new_embeddings = self._encode(missing_texts)
+                embeddings[missing] = new_embeddings
+                self.cache.put_many(missing_texts, new_embeddings)
+            
             return embeddings
         except Exception as e:
             print(f"Error generating embeddings: {e}")
             return []
     
+    def cache_stats(self):
+        """Return the hit/miss counters of the embedding cache"""
+        return self.cache.stats() if self.cache is not None else None
+    
     def compute_similarity(self, embedding1, embedding2):
         """Compute cosine similarity between two embeddings"""
         if embedding1 is None or embedding2 is None:
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """Append-only on-disk store of chunk embeddings, read through np.memmap"""
+    
+    KEY_DTYPE = np.dtype([('chunk_id', '<i8'), ('hash', 'S20')])
+    
+    def __init__(self, data_dir, dimension=768, model_name=None):
+        self.vectors_file = os.path.join(data_dir, 'embeddings.f32')
+        self.keys_file = os.path.join(data_dir, 'embeddings.keys')
+        self.info_file = os.path.join(data_dir, 'embeddings.json')
+        self.dimension = dimension
+        self.model_name = model_name
+        
+        self.vectors = None
+        self.row_count = 0
+        self.rows_by_id = {}
+        self.rows_by_hash = {}
+        
+        self._load()
+    
+    @staticmethod
+    def content_hash(text):
+        """Hash of the chunk text used to recognise already-embedded content"""
+        return hashlib.sha1(text.encode('utf-8')).digest()
+    
+    @staticmethod
+    def _hashes(keys):
+        """Content hashes of key rows as bytes (read as raw bytes: 'S20' would strip trailing NULs)"""
+        return keys['hash'].astype('V20').tolist()
+    
+    def _load(self):
+        """Load the key table and memory-map the vector file"""
+        if not self._info_matches():
+            # Vectors from another model or dimension are useless, start over
+            self._reset()
+            return
+        
+        keys = np.array([], dtype=self.KEY_DTYPE)
+        if os.path.exists(self.keys_file):
+            keys = np.fromfile(self.keys_file, dtype=self.KEY_DTYPE)
+        
+        # A crash between the two appends can leave the files uneven; trust the shorter one
+        row_bytes = self.dimension * 4
+        vector_rows = os.path.getsize(self.vectors_file) // row_bytes if os.path.exists(self.vectors_file) else 0
+        self.row_count = min(len(keys), vector_rows)
+        
+        # Built from whole columns: a Python loop over every row made startup linear in the library size
+        keys = keys[:self.row_count]
+        self.rows_by_id = dict(zip(keys['chunk_id'].tolist(), range(self.row_count)))
+        self.rows_by_hash = dict(zip(self._hashes(keys), range(self.row_count)))
+        
+        self._map_vectors()
+    
+    def reload(self):
+        """Re-read the files after another process appended to or compacted them (never resets them)"""
+        if self._info_matches():
+            self._load()
+    
+    def _info_matches(self):
+        if not os.path.exists(self.info_file):
+            return False
+        try:
+            with open(self.info_file, 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return info.get('dimension') == self.dimension and info.get('model') == self.model_name
+    
+    def _reset(self):
+        """Start an empty store for the current model"""
+        for path in (self.vectors_file, self.keys_file):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(self.info_file, 'w') as f:
+            json.dump({'dimension': self.dimension, 'model': self.model_name}, f)
+        
+        self.vectors = None
+        self.row_count = 0
+        self.rows_by_id = {}
+        self.rows_by_hash = {}
+    
+    def _map_vectors(self):
+        if self.row_count == 0:
+            self.vectors = None
+            return
+        self.vectors = np.memmap(self.vectors_file, dtype='float32', mode='r',
+                                 shape=(self.row_count, self.dimension))
+    
+    def __len__(self):
+        return len(self.rows_by_id)
+    
+    def append(self, chunk_ids, texts, embeddings):
+        """Append embeddings for the given chunk IDs and texts"""
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32').reshape(-1, self.dimension)
+        if len(embeddings) == 0:
+            return
+        
+        keys = np.zeros(len(chunk_ids), dtype=self.KEY_DTYPE)
+        keys['chunk_id'] = chunk_ids
+        keys['hash'] = [self.content_hash(text) for text in texts]
+        
+        # Vectors first, keys last: a row only exists once its key is written
+        with open(self.vectors_file, 'ab') as f:
+            f.write(embeddings.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.keys_file, 'ab') as f:
+            f.write(keys.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        
+        # Map the grown file before publishing its rows, so lookups never see a row past the mapping
+        first_row = self.row_count
+        self.row_count += len(keys)
+        self._map_vectors()
+        rows = range(first_row, self.row_count)
+        self.rows_by_id.update(zip(keys['chunk_id'].tolist(), rows))
+        self.rows_by_hash.update(zip(self._hashes(keys), rows))
+    
+    def get(self, chunk_ids):
+        """Return the stored vectors for chunk_ids (in order), or None if any is missing"""
+        rows = [self.rows_by_id.get(int(chunk_id)) for chunk_id in chunk_ids]
+        if any(row is None for row in rows):
+            return None
+        if not rows:
+            return np.zeros((0, self.dimension), dtype='float32')
+        return np.array(self.vectors[rows])
+    
+    def get_by_text(self, texts):
+        """Return a {position: vector} dict for the texts whose embedding is already stored"""
+        found = {}
+        for i, text in enumerate(texts):
+            row = self.rows_by_hash.get(self.content_hash(text))
+            if row is not None:
+                found[i] = np.array(self.vectors[row])
+        return found
+    
+    def discard(self, chunk_ids):
+        """Forget chunk IDs; their rows stay on disk until the next compaction"""
+        for chunk_id in chunk_ids:
+            self.rows_by_id.pop(int(chunk_id), None)
+    
+    def dead_rows(self):
+        return self.row_count - len(self.rows_by_id)
+    
+    def prepare_compaction(self):
+        """
+        Write copies of the files keeping only the rows of live chunk IDs, next to the current ones
+        
+        The current files stay untouched and readable meanwhile; swap_compacted() puts the copies
+        in place. Nothing may be appended or discarded in between.
+        """
+        chunk_ids = np.fromiter(self.rows_by_id.keys(), dtype='int64', count=len(self.rows_by_id))
+        rows = np.fromiter(self.rows_by_id.values(), dtype='int64', count=len(self.rows_by_id))
+        # Live rows keep their relative order
+        order = np.argsort(rows, kind='stable')
+        chunk_ids, rows = chunk_ids[order], rows[order]
+        
+        keys = np.zeros(len(rows), dtype=self.KEY_DTYPE)
+        vectors = np.zeros((len(rows), self.dimension), dtype='float32')
+        if len(rows):
+            # One gather per file instead of a read and a write per row
+            keys = np.fromfile(self.keys_file, dtype=self.KEY_DTYPE)[:self.row_count][rows]
+            vectors = np.ascontiguousarray(self.vectors[rows], dtype='float32')
+        
+        tmp_vectors = self.vectors_file + '.tmp'
+        tmp_keys = self.keys_file + '.tmp'
+        with open(tmp_vectors, 'wb') as vf, open(tmp_keys, 'wb') as kf:
+            vf.write(vectors.tobytes())
+            kf.write(keys.tobytes())
+            vf.flush()
+            os.fsync(vf.fileno())
+            kf.flush()
+            os.fsync(kf.fileno())
+        
+        return {
+            'vectors_file': tmp_vectors,
+            'keys_file': tmp_keys,
+            'row_count': len(rows),
+            'rows_by_id': dict(zip(chunk_ids.tolist(), range(len(rows)))),
+            'rows_by_hash': dict(zip(self._hashes(keys), range(len(rows))))
+        }
+    
+    def swap_compacted(self, compacted):
+        """Put the files from prepare_compaction() in place of the current ones"""
+        # Release the old mapping before swapping the files in
+        self.vectors = None
+        os.replace(compacted['vectors_file'], self.vectors_file)
+        os.replace(compacted['keys_file'], self.keys_file)
+        self.row_count = compacted['row_count']
+        self.rows_by_id = compacted['rows_by_id']
+        self.rows_by_hash = compacted['rows_by_hash']
+        self._map_vectors()
@@ -6,6 +6,7 @@ from typing import Dict, List
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from . import llm_usage
 from .vector_store_service import VectorStoreService
 from .chapter_service import ChapterService
 
@@ -13,6 +14,11 @@ from .chapter_service import ChapterService
 load_dotenv()
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
+NO_RELEVANT_SOURCES_MESSAGE = "No encontré información suficientemente relevante para responder a tu pregunta específica. ¿Podrías reformularla o ser más específico?"
+
+# Longest text held back while streaming because it may be an unfinished "[Source N]"
+MAX_PENDING_CITATION = len('[Source 9999]')
+
 class GeminiService:
     def __init__(self, vector_store=None, chapter_service=None, document_service=None):
         """
@@ -23,18 +29,30 @@ class GeminiService:
             chapter_service: Instancia existente de ChapterService
             document_service: Instancia existente de DocumentService
         """
-        # Configure the Gemini API
-        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+        # Gemini clients are created on first use so importing the app stays fast
+        self._model = None
+        self._intent_model = None
+        
+        self.relevance_wall = 0.4
+        
+        # Usar servicios existentes o crear nuevos si no se proporcionan
+        self.vector_store = vector_store if vector_store is not None else VectorStoreService()
+        self.document_service = document_service
         
-        # Get available models
+        # La instancia de chapter_service se asignará más tarde desde app.py después de crear ambos servicios
+        self.chapter_service = chapter_service
+        
+    def _create_models(self):
+        """Configure the Gemini API and create both models"""
+        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
         try:
-            self.model = genai.GenerativeModel(
+            self._model = genai.GenerativeModel(
                 'models/gemini-1.5-pro',
                 generation_config={'temperature': 0.3, 'top_p': 0.7}
             )
             
             # Modelo específico para la detección de intenciones con temperatura más baja
-            self.intent_model = genai.GenerativeModel(
+            self._intent_model = genai.GenerativeModel(
                 'models/gemini-1.5-pro',
                 generation_config={'temperature': 0.1, 'top_p': 0.95}
             )
@@ -43,16 +61,19 @@ class GeminiService:
         except Exception as e:
             print(f"Error connecting to Gemini API: {e}")
             raise
-        
-        self.relevance_wall = 0.4
-        
-        # Usar servicios existentes o crear nuevos si no se proporcionan
-        self.vector_store = vector_store if vector_store is not None else VectorStoreService()
-        self.document_service = document_service
-        
-        # La instancia de chapter_service se asignará más tarde desde app.py después de crear ambos servicios
-        self.chapter_service = chapter_service
-        
+    
+    @property
+    def model(self):
+        if self._model is None:
+            self._create_models()
+        return self._model
+    
+    @property
+    def intent_model(self):
+        if self._intent_model is None:
+            self._create_models()
+        return self._intent_model
+    
     def set_chapter_service(self, chapter_service):
         """Establece el servicio de capítulos después de la inicialización"""
         self.chapter_service = chapter_service
@@ -61,7 +82,7 @@ class GeminiService:
         """Establece el servicio de documentos después de la inicialización"""
         self.document_service = document_service
         
-    def generate_response(self, query: str, context: str, sources: List[Dict]) -> str:
+    def generate_response(self, query: str, context: str, sources: List[Dict], intent_detection: Dict = None) -> str:
         """
         Generate a response using Gemini based on the query and context
         
@@ -69,13 +90,15 @@ class GeminiService:
             query: User's question
             context: Text content from relevant chunks
             sources: List of source metadata for citation
+            intent_detection: Intent already detected for this query (skips detecting it again)
         
         Returns:
             Generated response with citations
         """
-        # Primero detectamos si es una solicitud especial (resumen o comparación)
-        # Usamos detección basada en Gemini en lugar de expresiones regulares
-        intent_detection = self._detect_intent_with_gemini(query)
+        # Primero detectamos si es una solicitud especial (resumen o comparación),
+        # salvo que quien llama ya lo haya hecho
+        if intent_detection is None:
+            intent_detection = self._detect_intent_with_gemini(query)
         
         if intent_detection.get('is_special_request') and self.chapter_service is not None:
             if intent_detection['intent'] == 'summarize_chapter':
@@ -85,65 +108,135 @@ class GeminiService:
         
         try:
             if not sources or not any(source['score'] > self.relevance_wall for source in sources):
-                return "No encontré información suficientemente relevante para responder a tu pregunta específica. ¿Podrías reformularla o ser más específico?"
-
-            # Crear un diccionario para agrupar fuentes por libro y página
-            grouped_sources = {}
-            for i, source in enumerate(sources):
-                if source['score'] > self.relevance_wall:
-                    book_name = source["book"].split("_")[0]
-                    page_num = source["page"]
-                    key = f"{book_name}_{page_num}"
-                    print(f"\n {'-'*30}\n Source {i}: {source['score']}\n {'-'*30} \n - {source['text']}")
-                    if key not in grouped_sources:
-                        grouped_sources[key] = {
-                            'index': len(grouped_sources) + 1,
-                            'book': book_name,
-                            'page': page_num,
-                            'text': source['text'].strip()
-                        }
-
-            # Formatear el contexto usando las fuentes agrupadas
-            formatted_sources = []
-            for source_info in grouped_sources.values():
-                formatted_sources.append(
-                    f"[Source {source_info['index']}] From '{source_info['book']}', "
-                    f"page {int(source_info['page']) + 1}:\n{source_info['text']}"
-                )
+                return NO_RELEVANT_SOURCES_MESSAGE
             
-            formatted_context = "\n\n".join(formatted_sources)
-            print(f"Formatted context:\n{formatted_context}")
-            prompt = f"""
-            You are a technical assistant. Use ONLY the provided sources to answer the question.
-            
-            DOCUMENTATION CONTEXT:
-            {formatted_context}
-            
-            USER QUESTION:
-            {query}
-            
-            INSTRUCTIONS:
-            1. Answer in detail using ALL RELEVANT SOURCES.
-            2. For every claim, cite the source like [Source Number].
-            3. If sources conflict, explain differences clearly.
-            4. List all used sources with sources numbers, book name and page numbers at the end.
-            5. If there are differences between sources, explain them. in a special section.
+            # A near-identical question over the same chunks was already answered
+            cache_key = self._answer_cache_key(query, sources)
+            if cache_key is not None:
+                cached_answer = self.vector_store.answer_cache.get_answer(*cache_key)
+                if cached_answer is not None:
+                    return cached_answer
 
-            """
+            prompt, grouped_sources = self._build_answer_prompt(query, sources)
             
             # Generate response
+            llm_usage.record_call()
             response = self.model.generate_content(prompt)
             answer = response.text
             
             # Process the answer to add proper citation links
-            answer = self._format_citations(answer, list(grouped_sources.values()))
+            answer = self._format_citations(answer, grouped_sources)
             
+            if cache_key is not None:
+                self.vector_store.answer_cache.put_answer(*cache_key, {s['book'] for s in sources}, answer)
             return answer
             
         except Exception as e:
             print(f"Error generating response: {e}")
             return f"Lo siento, ocurrió un error al generar la respuesta: {str(e)}"
     
+    def _answer_cache_key(self, query, sources):
+        """(query embedding, chunk IDs, index version) for the answer cache, or None if it is off"""
+        if self.vector_store.answer_cache is None:
+            return None
+        query_vector = self.vector_store.embedding_service.get_embedding(query)
+        if query_vector is None:
+            return None
+        return query_vector, [source['index'] for source in sources], self.vector_store.index_version()
+    
+    def _build_answer_prompt(self, query, sources):
+        """Group the relevant sources and build the answer prompt; returns (prompt, grouped sources)"""
+        # Crear un diccionario para agrupar fuentes por libro y página
+        grouped_sources = {}
+        for i, source in enumerate(sources):
+            if source['score'] > self.relevance_wall:
+                book_name = source["book"].split("_")[0]
+                page_num = source["page"]
+                key = f"{book_name}_{page_num}"
+                print(f"\n {'-'*30}\n Source {i}: {source['score']}\n {'-'*30} \n - {source['text']}")
+                if key not in grouped_sources:
+                    grouped_sources[key] = {
+                        'index': len(grouped_sources) + 1,
+                        'book': book_name,
+                        'page': page_num,
+                        'text': source['text'].strip()
+                    }
+
+        # Formatear el contexto usando las fuentes agrupadas
+        formatted_sources = []
+        for source_info in grouped_sources.values():
+            formatted_sources.append(
+                f"[Source {source_info['index']}] From '{source_info['book']}', "
+                f"page {int(source_info['page']) + 1}:\n{source_info['text']}"
+            )
+        
+        formatted_context = "\n\n".join(formatted_sources)
+        print(f"Formatted context:\n{formatted_context}")
+        prompt = f"""
+        You are a technical assistant. Use ONLY the provided sources to answer the question.
+        
+        DOCUMENTATION CONTEXT:
+        {formatted_context}
+        
+        USER QUESTION:
+        {query}
+        
+        INSTRUCTIONS:
+        1. Answer in detail using ALL RELEVANT SOURCES.
+        2. For every claim, cite the source like [Source Number].
+        3. If sources conflict, explain differences clearly.
+        4. List all used sources with sources numbers, book name and page numbers at the end.
+        5. If there are differences between sources, explain them. in a special section.
+
+        """
+        
+        return prompt, list(grouped_sources.values())
+    
+    def generate_response_stream(self, query: str, sources: List[Dict]):
+        """
+        Stream the answer for a general query as Gemini produces it
+        
+        Yields text fragments with citations already formatted. A "[Source N]" split
+        across two Gemini chunks is held back until it is complete.
+        """
+        if not sources or not any(source['score'] > self.relevance_wall for source in sources):
+            yield NO_RELEVANT_SOURCES_MESSAGE
+            return
+        
+        cache_key = self._answer_cache_key(query, sources)
+        if cache_key is not None:
+            cached_answer = self.vector_store.answer_cache.get_answer(*cache_key)
+            if cached_answer is not None:
+                yield cached_answer
+                return
+        
+        prompt, grouped_sources = self._build_answer_prompt(query, sources)
+        try:
+            llm_usage.record_call()
+            response = self.model.generate_content(prompt, stream=True)
+            
+            parts = []
+            pending = ""
+            for chunk in response:
+                pending += chunk.text
+                cut = pending.rfind('[')
+                if cut == -1 or ']' in pending[cut:] or len(pending) - cut > MAX_PENDING_CITATION:
+                    cut = len(pending)
+                ready, pending = pending[:cut], pending[cut:]
+                if ready:
+                    parts.append(self._format_citations(ready, grouped_sources))
+                    yield parts[-1]
+            if pending:
+                parts.append(self._format_citations(pending, grouped_sources))
+                yield parts[-1]
+            
+            if cache_key is not None:
+                self.vector_store.answer_cache.put_answer(*cache_key, {s['book'] for s in sources}, "".join(parts))
+        
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            yield f"Lo siento, ocurrió un error al generar la respuesta: {str(e)}"
+    
     def _get_available_books(self):
         """Obtiene la lista de libros disponibles en el sistema"""
         available_books = []
@@ -165,17 +258,11 @@ class GeminiService:
         # Como respaldo, también revisamos los metadatos del vector_store
         if not available_books and self.vector_store:
             try:
-                books_set = set()
-                for item in self.vector_store.metadata:
-                    if 'book' in item:
-                        book_full = item['book']
-                        book_name = book_full.split("_")[0]
-                        if book_full not in books_set:
-                            books_set.add(book_full)
-                            available_books.append({
-                                "full_name": book_full,
-                                "name": book_name
-                            })
+                for book_full in self.vector_store.get_books():
+                    available_books.append({
+                        "full_name": book_full,
+                        "name": book_full.split("_")[0]
+                    })
             except Exception as e:
                 print(f"Error al obtener libros desde vector_store: {e}")
         
@@ -217,10 +304,10 @@ class GeminiService:
 
         Responde en formato JSON con este formato:
         ```json
-        {
+        {{
           "is_special_request": true|false,
           "intent": "summarize_chapter"|"compare_chapters"|"general_query",
-          "params": {
+          "params": {{
             // Para resumir:
             "book": "nombre_completo_del_archivo",
             "chapter": "número_o_id_del_capítulo",
@@ -228,11 +315,11 @@ class GeminiService:
             
             // Para comparar:
             "sources": [
-              {"book": "nombre_completo_del_archivo1", "chapter": "capítulo1"},
-              {"book": "nombre_completo_del_archivo2", "chapter": "capítulo2"}
+              {{"book": "nombre_completo_del_archivo1", "chapter": "capítulo1"}},
+              {{"book": "nombre_completo_del_archivo2", "chapter": "capítulo2"}}
             ]
-          }
-        }
+          }}
+        }}
         ```
         
         Devuelve SOLO el objeto JSON sin explicaciones adicionales.
@@ -240,6 +327,7 @@ class GeminiService:
         
         try:
             # Llamada a Gemini para determinar la intención
+            llm_usage.record_call()
             response = self.intent_model.generate_content(intent_prompt)
             response_text = response.text.strip()
             
@@ -281,11 +369,8 @@ class GeminiService:
         
         # Si no encontramos un libro exacto, buscamos por similitud en el vector store
         if not any(book['full_name'] == selected_book for book in self._get_available_books()):
-            matching_books = []
-            for file_path in self.vector_store.metadata:
-                if 'book' in file_path and book_name.lower() in file_path['book'].lower():
-                    if file_path['book'] not in matching_books:
-                        matching_books.append(file_path['book'])
+            matching_books = [book for book in self.vector_store.get_books()
+                              if book_name.lower() in book.lower()]
             
             if matching_books:
                 selected_book = matching_books[0]
@@ -0,0 +1,195 @@
+import math
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+
+# IVF training wants a few dozen points per centroid
+TRAINING_POINTS_PER_LIST = 39
+
+
+def default_nlist(num_vectors):
+    """Number of IVF lists for a collection of this size (about 4 * sqrt(n))"""
+    nlist = min(65536, int(4 * math.sqrt(max(num_vectors, 1))), num_vectors // TRAINING_POINTS_PER_LIST)
+    return max(1, nlist)
+
+
+def min_vectors_to_train(index_type, nlist, pq_nbits=8):
+    if index_type == 'ivf_flat':
+        return nlist * TRAINING_POINTS_PER_LIST
+    if index_type == 'ivf_pq':
+        # The PQ codebooks need the same density per centroid as the coarse quantizer
+        return max(nlist, 2 ** pq_nbits) * TRAINING_POINTS_PER_LIST
+    return 0
+
+
+def build_index(index_type, dimension, num_vectors=0, training_vectors=None, params=None):
+    """
+    Create an empty index of the given type that accepts add_with_ids
+
+    Args:
+        index_type: one of INDEX_TYPES
+        dimension: vector dimension
+        num_vectors: expected collection size, used to size the IVF lists
+        training_vectors: float32 sample used to train IVF indexes
+        params: dict with hnsw_m, hnsw_ef_construction, ivf_nlist, ivf_pq_m, ivf_pq_nbits
+    """
+    params = params or {}
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == 'flat':
+        return faiss.index_factory(dimension, "IDMap,Flat", metric)
+
+    if index_type == 'hnsw':
+        index = faiss.index_factory(dimension, f"IDMap,HNSW{params.get('hnsw_m', 32)},Flat", metric)
+        faiss.downcast_index(index.index).hnsw.efConstruction = params.get('hnsw_ef_construction', 200)
+        return index
+
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        nlist = params.get('ivf_nlist') or default_nlist(num_vectors)
+        if index_type == 'ivf_flat':
+            description = f"IVF{nlist},Flat"
+        else:
+            description = f"IVF{nlist},PQ{params.get('ivf_pq_m', 48)}x{params.get('ivf_pq_nbits', 8)}"
+        # IVF indexes store IDs natively, so no IDMap layer (and remove_ids works)
+        index = faiss.index_factory(dimension, description, metric)
+        needed = min_vectors_to_train(index_type, nlist, params.get('ivf_pq_nbits', 8))
+        if training_vectors is None or len(training_vectors) < needed:
+            raise ValueError(f"{index_type} needs at least {needed} training vectors")
+        index.train(np.ascontiguousarray(training_vectors, dtype='float32'))
+        return index
+
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def get_index_type(index):
+    """Return the INDEX_TYPES name of an index built by build_index"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf_flat'
+    if isinstance(index, faiss.IndexIDMap):
+        if isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+            return 'hnsw'
+        return 'flat'
+    return None
+
+
+def get_nlist(index):
+    """Number of lists of an IVF index, or None for other index types"""
+    if get_index_type(index) in ('ivf_flat', 'ivf_pq'):
+        return faiss.downcast_index(index).nlist
+    return None
+
+
+def supports_remove(index):
+    """HNSW graphs cannot delete vectors; the index has to be rebuilt instead"""
+    return get_index_type(index) != 'hnsw'
+
+
+def set_search_params(index, ef_search=None, nprobe=None):
+    """Apply the query-time knobs of HNSW (efSearch) and IVF (nprobe) indexes"""
+    index = faiss.downcast_index(index)
+    index_type = get_index_type(index)
+    if index_type == 'hnsw' and ef_search:
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search
+    elif index_type in ('ivf_flat', 'ivf_pq') and nprobe:
+        index.nprobe = min(nprobe, index.nlist)
+
+
+def search_parameters(index, allowed_ids):
+    """
+    Build SearchParameters that restrict a search to allowed_ids
+
+    IVF and HNSW reject generic parameters, so the type-specific class is used
+    and the index's own nprobe/efSearch are carried over.
+    """
+    selector = faiss.IDSelectorBatch(np.ascontiguousarray(allowed_ids, dtype='int64'))
+    index_type = get_index_type(index)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.downcast_index(index).nprobe)
+    elif index_type == 'hnsw':
+        hnsw = faiss.downcast_index(faiss.downcast_index(index).index).hnsw
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The selector is referenced from C++ only; keep it alive with the params
+    params.selector_ref = selector
+    return params
+
+
+def get_index_ids(index):
+    """Return the chunk IDs stored in an index as an int64 array"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+
+    if isinstance(index, faiss.IndexIVF):
+        invlists = index.invlists
+        parts = []
+        for list_no in range(index.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                parts.append(faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy())
+        return np.concatenate(parts) if parts else np.array([], dtype='int64')
+
+    raise ValueError("Index does not expose its IDs")
+
+
+def recall_latency_report(vectors, queries, configs, k=10):
+    """
+    Measure recall@k and latency of index configurations against exact flat search
+
+    Args:
+        vectors: float32 matrix of the indexed (normalized) vectors
+        queries: float32 matrix of query vectors
+        configs: list of dicts with 'type' plus build params and 'ef_search'/'nprobe'
+        k: neighbours compared per query
+
+    Returns:
+        One dict per configuration with recall, mean/p95 latency per query and build time
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    ids = np.arange(len(vectors), dtype='int64')
+    dimension = vectors.shape[1]
+
+    reference = build_index('flat', dimension)
+    reference.add_with_ids(vectors, ids)
+    _, truth = reference.search(queries, k)
+
+    # Configs that only differ in efSearch/nprobe share the same built index
+    built = {}
+    rows = []
+    for config in configs:
+        build_key = tuple(sorted((key, value) for key, value in config.items()
+                                 if key not in ('ef_search', 'nprobe')))
+        if build_key not in built:
+            start = time.perf_counter()
+            index = build_index(config['type'], dimension, num_vectors=len(vectors),
+                                training_vectors=vectors, params=config)
+            index.add_with_ids(vectors, ids)
+            built[build_key] = (index, time.perf_counter() - start)
+        index, build_seconds = built[build_key]
+        set_search_params(index, config.get('ef_search'), config.get('nprobe'))
+
+        # One query at a time, like the /query endpoint does
+        latencies = []
+        found = np.empty_like(truth)
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, found[i:i + 1] = index.search(queries[i:i + 1], k)
+            latencies.append(time.perf_counter() - start)
+
+        hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+        rows.append({
+            'config': config,
+            'recall': hits / (len(queries) * k),
+            'mean_ms': 1000 * float(np.mean(latencies)),
+            'p95_ms': 1000 * float(np.percentile(latencies, 95)),
+            'build_s': build_seconds
+        })
+    return rows
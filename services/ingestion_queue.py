@@ -0,0 +1,144 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IngestionQueue:
+    """Background ingestion of uploads and reindexing: a worker pool streams documents in, index writes take turns"""
+    
+    def __init__(self, vector_store, document_service, max_workers=2, max_finished_jobs=200):
+        """
+        Args:
+            vector_store: Instancia de VectorStoreService (it serializes the index writes)
+            document_service: Instancia de DocumentService
+            max_workers: uploads extracted/embedded at the same time
+            max_finished_jobs: finished jobs kept for /jobs/<id> before the oldest are forgotten
+        """
+        self.vector_store = vector_store
+        self.document_service = document_service
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        # Reindexing queues behind itself, never behind (or in place of) uploads
+        self._reindex_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reindex')
+    
+    def submit(self, temp_path, filename):
+        """Queue an uploaded file (temp_path is removed with its directory when done); returns the job"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'kind': 'upload',
+            'filename': filename,
+            'status': 'queued',  # queued, running, done, failed
+            'stage': 'queued',  # queued, copying, processing, done
+            'progress': {'pages_extracted': 0, 'pages_total': None, 'chunks_embedded': 0, 'chunks_indexed': 0},
+            'chunks_added': None,
+            'extraction': None,
+            'message': None,
+            'created': time.time(),
+            'finished': None
+        }
+        with self._lock:
+            self.jobs[job_id] = job
+            self._forget_old_jobs()
+        self._executor.submit(self._run, job_id, temp_path)
+        return self.get(job_id)
+    
+    def submit_reindex(self, full=False):
+        """Queue a reindex of the books directory (see VectorStoreService.reindex_all_documents); returns the job"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'kind': 'reindex',
+            'full': full,
+            'status': 'queued',  # queued, running, done, failed
+            'stage': 'queued',  # queued, reindexing, done
+            'progress': {'books_done': 0, 'books_total': None},
+            'report': None,
+            'message': None,
+            'created': time.time(),
+            'finished': None
+        }
+        with self._lock:
+            self.jobs[job_id] = job
+            self._forget_old_jobs()
+        self._reindex_executor.submit(self._run_reindex, job_id, full)
+        return self.get(job_id)
+    
+    def get(self, job_id):
+        """Snapshot of a job's state, or None if it is unknown"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, progress=dict(job['progress']))
+    
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+    
+    def _progress(self, job_id, stage, done, total):
+        # Extraction, embedding and indexing advance together, batch by batch
+        with self._lock:
+            job = self.jobs[job_id]
+            if stage == 'extracting':
+                job['progress'].update(pages_extracted=done, pages_total=total)
+            elif stage == 'embedding':
+                job['progress']['chunks_embedded'] = done
+            elif stage == 'indexing':
+                job['progress']['chunks_indexed'] = done
+    
+    def _run(self, job_id, temp_path):
+        try:
+            self._update(job_id, status='running', stage='copying')
+            processed_path = self.document_service.process_file(temp_path)
+            shutil.rmtree(os.path.dirname(temp_path), ignore_errors=True)
+            
+            # Extraction and embedding run in parallel with other uploads; the chunks are
+            # indexed in batches as they come
+            self._update(job_id, stage='processing')
+            chunks_added = self.vector_store.add_document(
+                processed_path,
+                progress=lambda stage, done, total: self._progress(job_id, stage, done, total)
+            )
+            
+            # Page timings of PDFs, see DocumentService._page_stats (the vector store extracts
+            # with its own DocumentService)
+            extraction = self.vector_store.document_service.extraction_stats.get(os.path.basename(processed_path))
+            if extraction:
+                self._update(job_id, extraction=extraction)
+            
+            self._update(job_id, status='done', stage='done', chunks_added=chunks_added, finished=time.time(),
+                         message=f'File processed successfully. Added {chunks_added} chunks to the index.')
+        except Exception as e:
+            print(f"Error processing upload {temp_path}: {e}")
+            shutil.rmtree(os.path.dirname(temp_path), ignore_errors=True)
+            self._update(job_id, status='failed', finished=time.time(), message=f'Error processing file: {str(e)}')
+    
+    def _run_reindex(self, job_id, full):
+        try:
+            self._update(job_id, status='running', stage='reindexing')
+            report = self.vector_store.reindex_all_documents(
+                full=full,
+                progress=lambda done, total: self._update_progress(job_id, books_done=done, books_total=total)
+            )
+            self._update(job_id, status='done', stage='done', report=report, finished=time.time(),
+                         message=(f"Reindexing complete. Added: {len(report['added'])}, "
+                                  f"updated: {len(report['updated'])}, removed: {len(report['removed'])}, "
+                                  f"skipped: {len(report['skipped'])}. Total chunks: {report['total_chunks']}"))
+        except Exception as e:
+            print(f"Error during reindexing: {e}")
+            self._update(job_id, status='failed', finished=time.time(), message=f'Error during reindexing: {str(e)}')
+    
+    def _update_progress(self, job_id, **progress):
+        with self._lock:
+            self.jobs[job_id]['progress'].update(progress)
+    
+    def _forget_old_jobs(self):
+        finished = sorted((job['finished'], job_id) for job_id, job in self.jobs.items() if job['finished'])
+        for _, job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
@@ -0,0 +1,17 @@
+import threading
+
+# Gemini calls made while serving the current request (each Flask request runs in its own thread)
+_local = threading.local()
+
+
+def reset():
+    _local.calls = 0
+
+
+def record_call():
+    """Call once per generate_content request"""
+    _local.calls = getattr(_local, 'calls', 0) + 1
+
+
+def count():
+    return getattr(_local, 'calls', 0)
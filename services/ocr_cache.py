@@ -0,0 +1,93 @@
+import threading
+import time
+
+from .sqlite_connection import ProcessLocalConnection
+
+
+class OCRCache:
+    """Persistent cache of Tesseract output keyed by file content hash, page and OCR settings, with LRU eviction"""
+    
+    def __init__(self, db_path, max_entries=50000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self._lock = threading.Lock()
+        self._connection = ProcessLocalConnection(db_path, self._create_schema)
+    
+    @property
+    def _conn(self):
+        return self._connection.get()
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_pages (
+                file_hash TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (file_hash, settings, page)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_pages_last_used ON ocr_pages(last_used)")
+        conn.commit()
+    
+    def get_document(self, file_hash, settings):
+        """Return a {page_num: text} dict with every cached page of a file for these OCR settings"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page, text FROM ocr_pages WHERE file_hash = ? AND settings = ?", (file_hash, settings)
+            ).fetchall()
+            if rows:
+                self._conn.execute(
+                    "UPDATE ocr_pages SET last_used = ? WHERE file_hash = ? AND settings = ?",
+                    (time.time(), file_hash, settings)
+                )
+                self._conn.commit()
+        return dict(rows)
+    
+    def record_lookups(self, hits, misses):
+        """Hits and misses are only known once the pages have been looked at"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+    
+    def put_pages(self, file_hash, settings, pages):
+        """Store {page_num: text} OCR results and evict the least recently used pages"""
+        now = time.time()
+        rows = [(file_hash, settings, page_num, text, now) for page_num, text in pages.items()]
+        if not rows:
+            return
+        
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ocr_pages (file_hash, settings, page, text, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM ocr_pages").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM ocr_pages WHERE rowid IN "
+                    "(SELECT rowid FROM ocr_pages ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+    
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ocr_pages").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries
+        }
@@ -0,0 +1,131 @@
+import os
+import re
+import unicodedata
+
+from . import llm_usage
+
+# Palabras que indican una solicitud de resumen o comparación, o que nombran un capítulo o
+# sección; sin ninguna de ellas la consulta es claramente general y no hace falta preguntarle a Gemini.
+# Solo las formas de comparar/compare: "compartir" no es una comparación
+SPECIAL_REQUEST_PATTERN = re.compile(
+    r'\b(resum\w*|sintetiz\w*|sintesis|summar\w*|'
+    r'compar(?:a|an|ar|as|e|en|es|o|emos|ad\w*|ando|acion\w*|ativ\w*|ison\w*|ing|ed)|contrast\w*|'
+    r'diferencia\w*|similitud\w*|semejanza\w*|versus|vs|'
+    r'capitulo\w*|chapter\w*|seccion\w*|section\w*)\b'
+)
+
+NO_RESULTS_MESSAGE = 'No encontré información relevante para responder a tu pregunta. Por favor, intenta reformular la pregunta o asegúrate de que la información esté en los documentos subidos.'
+
+GENERAL_INTENT = {"is_special_request": False, "intent": "general_query", "params": {}}
+
+
+class QueryPipeline:
+    def __init__(self, vector_store, gemini_service, top_k=5):
+        """
+        Flujo completo de una consulta: intención (una sola vez), búsqueda y respuesta
+        
+        Args:
+            vector_store: Instancia de VectorStoreService
+            gemini_service: Instancia de GeminiService (con chapter_service asignado)
+            top_k: Cantidad de fragmentos usados como contexto
+        """
+        self.vector_store = vector_store
+        self.gemini_service = gemini_service
+        self.top_k = top_k
+        self.use_preclassifier = os.getenv('INTENT_PRECLASSIFIER', 'true').lower() in ('1', 'true', 'yes')
+    
+    def classify_locally(self, query):
+        """Return the general intent when keywords make it obvious, otherwise None"""
+        text = unicodedata.normalize('NFKD', query.lower())
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        if SPECIAL_REQUEST_PATTERN.search(text):
+            return None
+        return dict(GENERAL_INTENT, params={})
+    
+    def detect_intent(self, query):
+        """Detect the intent once: local keyword rules first, Gemini only when ambiguous"""
+        if self.use_preclassifier:
+            intent = self.classify_locally(query)
+            if intent is not None:
+                intent['source'] = 'keywords'
+                return intent
+        
+        intent = self.gemini_service._detect_intent_with_gemini(query)
+        intent['source'] = 'gemini'
+        return intent
+    
+    def run(self, query):
+        """Answer a query; returns the /query response body"""
+        llm_usage.reset()
+        intent = self.detect_intent(query)
+        
+        if intent.get('is_special_request'):
+            # Si es una solicitud de resumen o comparación, manejarlo directamente
+            if intent['intent'] == 'summarize_chapter':
+                answer = self.gemini_service._handle_chapter_summary_request(query, intent)
+                return self._response(answer, [], intent)
+            elif intent['intent'] == 'compare_chapters':
+                answer = self.gemini_service._handle_chapter_comparison_request(query, intent)
+                return self._response(answer, [], intent)
+        
+        # Si no es una solicitud especial, continuar con el flujo normal
+        results = self.vector_store.search(query, top_k=self.top_k)
+        
+        if not results:
+            answer = NO_RESULTS_MESSAGE
+            return self._response(answer, [], intent)
+        
+        # Build context from chunks
+        context = "\n\n".join([f"Fragmento de '{r['book']}'" +
+                              (f", página {r['page']}" if r['page'] != '-1' else "") +
+                              f": {r['text']}" for r in results])
+        # La intención ya detectada se pasa para no volver a consultarla
+        answer = self.gemini_service.generate_response(query, context, results, intent_detection=intent)
+        return self._response(answer, results, intent)
+    
+    def stream(self, query):
+        """
+        Answer a query as a sequence of (event, data) pairs for Server-Sent Events
+        
+        'sources' is sent as soon as retrieval finishes, then 'token' events with the
+        answer text as Gemini produces it, and finally 'done' with the metadata.
+        """
+        llm_usage.reset()
+        intent = self.detect_intent(query)
+        
+        if intent.get('is_special_request') and intent['intent'] in ('summarize_chapter', 'compare_chapters'):
+            # Resúmenes y comparaciones no se transmiten por partes: se envían completos
+            yield 'sources', {'chunks': [], 'intent': intent['intent']}
+            if intent['intent'] == 'summarize_chapter':
+                answer = self.gemini_service._handle_chapter_summary_request(query, intent)
+            else:
+                answer = self.gemini_service._handle_chapter_comparison_request(query, intent)
+            yield 'token', {'text': answer}
+            yield 'done', self._metadata(intent)
+            return
+        
+        results = self.vector_store.search(query, top_k=self.top_k)
+        yield 'sources', {'chunks': results, 'intent': intent.get('intent', 'general_query')}
+        
+        if not results:
+            yield 'token', {'text': NO_RESULTS_MESSAGE}
+        else:
+            for text in self.gemini_service.generate_response_stream(query, results):
+                yield 'token', {'text': text}
+        
+        yield 'done', self._metadata(intent)
+    
+    def _response(self, answer, chunks, intent):
+        return {
+            'success': True,
+            'answer': answer,
+            'chunks': chunks,
+            'metadata': self._metadata(intent)
+        }
+    
+    def _metadata(self, intent):
+        return {
+            'intent': intent.get('intent', 'general_query'),
+            'intent_source': intent.get('source'),
+            'llm_calls': llm_usage.count()
+        }
@@ -0,0 +1,70 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Many readers or one writer, with waiting writers served first so a stream of searches cannot starve them
+    
+    Both sides are reentrant, and the writer may also take the read side. A reader must not
+    ask for the write side (there is no upgrade).
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._local = threading.local()
+    
+    @contextmanager
+    def read_locked(self):
+        me = threading.get_ident()
+        depth = getattr(self._local, 'read_depth', 0)
+        if depth or self._writer == me:
+            # Already inside the lock in this thread
+            self._local.read_depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.read_depth -= 1
+            return
+        
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.read_depth = 1
+        try:
+            yield
+        finally:
+            self._local.read_depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write_locked(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+            else:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+                self._writer_depth = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
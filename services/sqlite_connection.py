@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+
+
+class ProcessLocalConnection:
+    """
+    A SQLite connection opened on first use, and again in every process that uses it
+    
+    A connection must not cross fork() (gunicorn --preload imports the app before forking
+    its workers), so a process that finds one opened by its parent opens its own.
+    """
+    
+    def __init__(self, db_path, setup):
+        """
+        Args:
+            db_path: SQLite file
+            setup: called with each new connection to set pragmas and create the schema
+        """
+        self.db_path = db_path
+        self._setup = setup
+        self._open_lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        # Closing the parent's connection in a child could disturb the parent's WAL, so it is kept open
+        self._inherited = []
+    
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._open_lock:
+                if self._pid != pid:
+                    if self._conn is not None:
+                        self._inherited.append(self._conn)
+                    conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                    self._setup(conn)
+                    self._conn, self._pid = conn, pid
+        return self._conn
@@ -1,12 +1,41 @@
+import functools
+import hashlib
+import json
 import os
 import pickle
+import threading
+import time
 from collections import defaultdict
 
 import faiss
 import numpy as np
 
+from .answer_cache import AnswerCache
+from .chapter_index import CHAPTER_INDEX_VERSION, detect_chapters
+from .chunk_store import ChunkStore
 from .document_service import DocumentService
 from .embedding_service import EmbeddingService
+from .embedding_store import EmbeddingStore
+from .index_factory import (build_index, default_nlist, get_index_ids,
+                            get_index_type, get_nlist, min_vectors_to_train,
+                            search_parameters, set_search_params,
+                            supports_remove)
+from .rwlock import ReadWriteLock
+
+try:
+    import fcntl
+except ImportError:  # Windows: there is no shared writer lock, run a single process
+    fcntl = None
+
+
+def _serialized(method):
+    """Run a method that modifies the index while holding the service's write lock (writer process only)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            self._require_writer()
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class VectorStoreService:
@@ -14,6 +43,7 @@ class VectorStoreService:
         self.base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         self.index_file = os.path.join(self.base_dir, 'data', 'faiss_index.pkl')
         self.metadata_file = os.path.join(self.base_dir, 'data', 'metadata.pkl')
+        self.manifest_file = os.path.join(self.base_dir, 'data', 'manifest.json')
         
         # Create data directory if it doesn't exist
         os.makedirs(os.path.join(self.base_dir, 'data'), exist_ok=True)
@@ -22,71 +52,905 @@ class VectorStoreService:
         self.document_service = DocumentService()
         self.embedding_service = EmbeddingService()
         
-        # Initialize index and metadata
-        self.index = None
-        self.metadata = []
+        # Raw chunk vectors, so index rebuilds never have to run the model again
+        self.dimension = 768  # Dimension for mpnet model
+        self.embedding_store = EmbeddingStore(
+            os.path.join(self.base_dir, 'data'),
+            dimension=self.dimension,
+            model_name=self.embedding_service.model_name
+        )
+        
+        # Chunk text and metadata live in SQLite; only the rows a caller needs are loaded
+        self.chunk_store = ChunkStore(os.path.join(self.base_dir, 'data', 'chunks.sqlite'))
+        
+        # Index type: 'auto' stays flat until INDEX_PROMOTE_AT vectors, then switches
+        # to INDEX_ANN_TYPE; 'flat', 'hnsw', 'ivf_flat' or 'ivf_pq' pin the type
+        self.index_type = os.getenv('INDEX_TYPE', 'auto')
+        self.ann_type = os.getenv('INDEX_ANN_TYPE', 'hnsw')
+        self.promote_at = int(os.getenv('INDEX_PROMOTE_AT', 100000))
+        self.index_params = {
+            'hnsw_m': int(os.getenv('HNSW_M', 32)),
+            'hnsw_ef_construction': int(os.getenv('HNSW_EF_CONSTRUCTION', 200)),
+            'ivf_nlist': int(os.getenv('IVF_NLIST', 0)),  # 0 = sized from the collection
+            'ivf_pq_m': int(os.getenv('IVF_PQ_M', 48)),
+            'ivf_pq_nbits': int(os.getenv('IVF_PQ_NBITS', 8))
+        }
+        # With a sized-from-the-collection nlist, IVF is retrained once the collection would
+        # get this many times more lists than the index was trained with
+        self.ivf_retrain_factor = float(os.getenv('IVF_RETRAIN_FACTOR', 2))
+        self.ef_search = int(os.getenv('HNSW_EF_SEARCH', 64))
+        self.nprobe = int(os.getenv('IVF_NPROBE', 16))
+        # Filtered searches over at most this many chunks are scored exactly from the store
+        self.exact_filter_max = int(os.getenv('FILTERED_EXACT_MAX', 10000))
+        
+        # The index is loaded on first use (see the index property)
+        self._index = None
+        self._index_lock = threading.Lock()
+        # Writers (uploads, deletes, reindexing) take turns; extraction and embedding do not need it
+        self.write_lock = threading.RLock()
+        # Searches hold the read side, so they always see the index and the chunk store in step;
+        # writers only hold the write side while they change or swap them, never while building
+        self.rw_lock = ReadWriteLock()
+        # Books an add_document in this process is writing right now (guarded by write_lock);
+        # their 'partial' manifest entry is not an interrupted run
+        self.ingesting = set()
+        # Books a full reindex has staged and not published yet (guarded by write_lock)
+        self.staging = set()
+        # Signalled when books leave ingesting or staging
+        self._books_released = threading.Condition(self.write_lock)
+        # Reindexing runs one at a time, but without the write lock while it extracts and embeds
+        self.reindex_lock = threading.Lock()
+        self.index_load_seconds = None
+        # INDEX_MMAP maps the snapshot read-only instead of reading it into memory;
+        # it is reloaded writable on the first add or delete
+        self.index_mmap = os.getenv('INDEX_MMAP', 'false').lower() in ('1', 'true', 'yes')
+        self.index_readonly = False
+        self.stale_vectors = 0  # removed chunks still inside an HNSW graph
+        self.next_id = int(self.chunk_store.get_meta('next_id', 0))
+        
+        # Chunk IDs, the embedding files and the index snapshot belong to a single writer process,
+        # the one holding writer.lock. Any other process (every one with FARO_READ_ONLY=true) is a
+        # read-only replica: it refuses writes and replays the writer's changes in memory, checking
+        # for them at most every REPLICA_REFRESH_SECONDS
+        self.read_only = os.getenv('FARO_READ_ONLY', 'false').lower() in ('1', 'true', 'yes')
+        self.writer_lock_file = os.path.join(self.base_dir, 'data', 'writer.lock')
+        self._writer_fd = None
+        self._writer_pid = None
+        self.replica_refresh_seconds = float(os.getenv('REPLICA_REFRESH_SECONDS', 2))
+        self._followed_at = 0
+        self._store_data_version = None
+        
+        # The chunk store and embedding store are written on every change; the FAISS
+        # file is only a snapshot, rewritten every few writes or on compact()
+        self.pending_writes = 0
+        self.snapshot_every = int(os.getenv('INDEX_SNAPSHOT_EVERY', 50))
+        # Chunks embedded and written per step while a document streams in; by default
+        # large enough to keep every embedding process busy
+        self.ingest_batch_size = int(os.getenv('INGEST_BATCH_SIZE', 0)) or max(
+            256, 4 * self.embedding_service.batch_size * self.embedding_service.processes
+        )
+        
+        # Older layouts kept the metadata in a pickled list; import it before anything reads chunks
+        try:
+            self.imported_legacy_metadata = self._import_legacy_metadata()
+        except Exception as e:
+            print(f"Error importing legacy metadata: {e}")
+            self.imported_legacy_metadata = False
+        
+        # Per-book file signature and chunk IDs, used by incremental reindexing
+        self.manifest = self._load_manifest()
         
-        # Load existing index and metadata if available
-        self._load_index()
+        # Generated answers and chapter summaries; entries of a book are dropped when it
+        # is deleted or reindexed
+        self.answer_cache = None
+        if os.getenv('ANSWER_CACHE', 'true').lower() in ('1', 'true', 'yes'):
+            self.answer_cache = AnswerCache(
+                os.path.join(self.base_dir, 'data', 'answer_cache.sqlite'),
+                similarity_threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95)),
+                ttl_seconds=int(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600)),
+                max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 5000))
+            )
+        
+        # Chapter tables from an older detect_chapters are rebuilt lazily, and what was
+        # generated from their chapter ranges is dropped
+        if int(self.chunk_store.get_meta('chapter_index_version', 1)) != CHAPTER_INDEX_VERSION:
+            self.chunk_store.clear_chapters()
+            self._invalidate_books(list(self.chunk_store.get_books()))
+            self.chunk_store.set_meta('chapter_index_version', CHAPTER_INDEX_VERSION)
+    
+    @property
+    def index(self):
+        """The FAISS index, loaded (and reconciled) on first use"""
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    start = time.perf_counter()
+                    self._load_index()
+                    self.index_load_seconds = time.perf_counter() - start
+        return self._index
+    
+    @index.setter
+    def index(self, index):
+        self._index = index
+        self.index_readonly = False
+    
+    @property
+    def index_loaded(self):
+        return self._index is not None
+    
+    def preload(self):
+        """Load the embedding model and the index now, e.g. in a server master before forking"""
+        self.embedding_service.model
+        self.index
+        # A lock held by the master would be shared by every forked worker; the first of
+        # them to write claims it instead
+        self._release_writer()
+    
+    def can_write(self):
+        """Whether this process is (or can become) the library's writer"""
+        with self.write_lock:
+            return self._claim_writer()
+    
+    def _claim_writer(self):
+        """Take the writer role unless this is a replica or another process holds it; True if this process is the writer"""
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return True
+        if self.read_only:
+            return False
+        
+        fd = os.open(self.writer_lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        self._writer_fd, self._writer_pid = fd, pid
+        
+        # Another process may have been the writer since this one read the stores
+        self.next_id = max(self.next_id, int(self.chunk_store.get_meta('next_id', 0)))
+        if self.index_loaded:
+            self._sync_from_stores()
+            # Staged chunks of a rebuild the previous writer never published
+            self._discard_staged()
+        return True
+    
+    def _release_writer(self):
+        if self._writer_pid != os.getpid():
+            return
+        if fcntl is not None:
+            fcntl.flock(self._writer_fd, fcntl.LOCK_UN)
+        os.close(self._writer_fd)
+        self._writer_fd = self._writer_pid = None
+    
+    def _require_writer(self):
+        if not self._claim_writer():
+            reason = 'it is a read-only replica' if self.read_only else 'another process is the writer'
+            raise RuntimeError(f"This process cannot modify the library: {reason}")
+    
+    def _follow_writer(self):
+        """On a replica, pick up whatever the writer changed since the last check"""
+        if not self.index_loaded or self._writer_pid == os.getpid():
+            return
+        now = time.monotonic()
+        if now - self._followed_at < self.replica_refresh_seconds:
+            return
+        self._followed_at = now
+        
+        # data_version only moves when another connection commits to the chunk store
+        data_version = self.chunk_store.data_version()
+        if data_version != self._store_data_version:
+            with self.write_lock:
+                self._sync_from_stores()
+                self._store_data_version = data_version
+    
+    def _sync_from_stores(self):
+        """
+        Bring the in-memory index, embedding rows and manifest in line with what is on disk
+        
+        Nothing is written: vectors for new chunks come from the embedding store, and a graph
+        that cannot drop vectors is rebuilt in memory.
+        """
+        self.manifest = self._load_manifest()
+        with self.rw_lock.write_locked():
+            self.embedding_store.reload()
+        
+        stored_ids = set(self.chunk_store.all_ids())
+        indexed_ids = set(self._indexed_ids().tolist())
+        stale_ids = sorted(indexed_ids - stored_ids)
+        missing_ids = sorted(i for i in stored_ids - indexed_ids if i in self.embedding_store.rows_by_id)
+        if not stale_ids and not missing_ids:
+            return
+        
+        if stale_ids and not supports_remove(self.index):
+            index = self._build_index(sorted(stored_ids), get_index_type(self.index))
+            if index is not None:
+                set_search_params(index, self.ef_search, self.nprobe)
+                with self.rw_lock.write_locked():
+                    self.index = index
+                    self.stale_vectors = 0
+                return
+        
+        self._ensure_writable()
+        with self.rw_lock.write_locked():
+            if stale_ids:
+                self._remove_vectors(stale_ids)
+            if missing_ids:
+                self.index.add_with_ids(self.embedding_store.get(missing_ids), np.array(missing_ids, dtype='int64'))
+        print(f"Synced index with the writer's changes: +{len(missing_ids)} / -{len(stale_ids)} vectors")
+    
+    def _read_index_file(self):
+        if not self.index_mmap:
+            return faiss.read_index(self.index_file)
+        
+        # IO_FLAG_MMAP_IFC (newer FAISS) also maps flat vector storage, not just IVF lists
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+        return faiss.read_index(self.index_file, flags)
+    
+    def _ensure_writable(self):
+        """Load the index, swapping a memory-mapped one for an in-memory copy, before modifying it"""
+        if not self.index_loaded:
+            # Loading reconciles with the chunk store, so it must happen before the next write
+            self.index
+        if not self.index_readonly:
+            return
+        index = faiss.read_index(self.index_file)
+        set_search_params(index, self.ef_search, self.nprobe)
+        with self.rw_lock.write_locked():
+            self.index = index
+        print("Reloaded memory-mapped index for writing")
     
     def _load_index(self):
-        """Load existing index and metadata if available"""
+        """Load existing index if available and bring it in line with the chunk store"""
+        if not self._claim_writer():
+            self._load_replica_index()
+            return
+        
         try:
-            if os.path.exists(self.index_file) and os.path.exists(self.metadata_file):
+            if os.path.exists(self.index_file):
                 # Load FAISS index
-                self.index = faiss.read_index(self.index_file)
+                self.index = self._read_index_file()
+                self.index_readonly = self.index_mmap
+                
+                # Older indexes stored vectors by position; wrap them with stable IDs
+                if get_index_type(self.index) is None:
+                    self._migrate_to_id_map()
                 
-                # Load metadata
-                with open(self.metadata_file, 'rb') as f:
-                    self.metadata = pickle.load(f)
+                self._backfill_embedding_store()
+                print(f"Loaded {get_index_type(self.index)} index with {self.index.ntotal} vectors")
                 
-                print(f"Loaded index with {self.index.ntotal} vectors")
+                # The configured type may have changed since the index was written
+                if self._needs_rebuild(self.index.ntotal):
+                    if self.rebuild_index():
+                        self._save_index()
+            elif self.chunk_store.count() and self.rebuild_index():
+                # Chunks were written before the first snapshot
+                self._save_index()
             else:
                 print("No existing index found, creating a new one")
                 self._create_empty_index()
+            
+            if self.imported_legacy_metadata:
+                self._save_index()
+                os.replace(self.metadata_file, self.metadata_file + '.migrated')
         except Exception as e:
             print(f"Error loading index: {e}")
-            self._create_empty_index()
+            # The chunk store is still usable: rebuild the index from the stored vectors
+            if not self.rebuild_index():
+                self._create_empty_index()
+        
+        # Writes after the last snapshot are already in the chunk and embedding stores
+        self._reconcile_index()
+        set_search_params(self.index, self.ef_search, self.nprobe)
+    
+    def _load_replica_index(self):
+        """Load the writer's snapshot without touching the files, then replay its later writes"""
+        index = None
+        try:
+            if os.path.exists(self.index_file):
+                index = self._read_index_file()
+                if get_index_type(index) is None:
+                    # Positional layouts are migrated by the writer
+                    index = None
+        except Exception as e:
+            print(f"Error loading index: {e}")
+        
+        if index is None:
+            self.index = self._build_index(self.chunk_store.all_ids()) or build_index('flat', self.dimension)
+        else:
+            self.index = index
+            self.index_readonly = self.index_mmap
+        
+        self._store_data_version = self.chunk_store.data_version()
+        self._sync_from_stores()
+        set_search_params(self.index, self.ef_search, self.nprobe)
+        print(f"Loaded {get_index_type(self.index)} index with {self.index.ntotal} vectors (read-only replica)")
+    
+    def _import_legacy_metadata(self):
+        """Move a pickled metadata list into the chunk store; returns True if it did"""
+        if not os.path.exists(self.metadata_file) or self.chunk_store.count():
+            return False
+        
+        with open(self.metadata_file, 'rb') as f:
+            snapshot = pickle.load(f)
+        metadata = snapshot['metadata'] if isinstance(snapshot, dict) else snapshot
+        
+        # Writes still sitting in the old index log belong to the metadata too
+        log_file = os.path.join(self.base_dir, 'data', 'index.log')
+        if isinstance(snapshot, dict) and os.path.exists(log_file):
+            metadata = self._apply_legacy_log(log_file, metadata, snapshot.get('log_seq', 0))
+            self.next_id = max(self.next_id, snapshot.get('next_id', 0))
+        
+        # Positional indexes are renumbered the same way _migrate_to_id_map will number them
+        if os.path.exists(self.index_file) and get_index_type(faiss.read_index(self.index_file)) is None:
+            for position, item in enumerate(metadata):
+                item['index'] = position
+        
+        self.next_id = max([self.next_id] + [item['index'] + 1 for item in metadata])
+        self.chunk_store.add_chunks(metadata, next_id=self.next_id)
+        print(f"Imported {len(metadata)} chunks into the chunk store")
+        return True
+    
+    def _apply_legacy_log(self, log_file, metadata, snapshot_seq):
+        """Apply the adds/removes of an old index.log that are newer than the snapshot"""
+        with open(log_file, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    break
+                if record['seq'] <= snapshot_seq:
+                    continue
+                if record['op'] == 'add':
+                    metadata.extend(record['metadata'])
+                elif record['op'] == 'remove':
+                    removed = set(record['ids'])
+                    metadata = [item for item in metadata if item['index'] not in removed]
+        os.remove(log_file)
+        return metadata
     
     def _create_empty_index(self):
         """Create an empty FAISS index"""
         # Using L2 distance for cosine similarity (after normalization)
-        dimension = 768  # Dimension for mpnet model
-        self.index = faiss.IndexFlatIP(dimension)
-        self.metadata = []
+        # IndexIDMap keeps a stable chunk ID per vector so deletes never re-embed
+        self.index = build_index('flat', self.dimension)
+        self.stale_vectors = 0
+    
+    def _desired_index_type(self, num_vectors):
+        """Index type to use for a collection of num_vectors under the current config"""
+        if self.index_type == 'auto':
+            if num_vectors < self.promote_at:
+                return 'flat'
+            target = self.ann_type
+        else:
+            target = self.index_type
+        
+        # IVF cannot be trained on too few vectors; stay exact until there are enough
+        nlist = self.index_params['ivf_nlist'] or default_nlist(num_vectors)
+        if num_vectors < min_vectors_to_train(target, nlist, self.index_params['ivf_pq_nbits']):
+            return 'flat'
+        return target
+    
+    def _needs_rebuild(self, num_vectors):
+        """Whether the index no longer suits a collection of num_vectors: wrong type, or IVF lists it has outgrown"""
+        if get_index_type(self.index) != self._desired_index_type(num_vectors):
+            return True
+        nlist = get_nlist(self.index)
+        if nlist is None or self.index_params['ivf_nlist']:
+            return False
+        # Lists trained on a smaller collection keep growing longer, and every probe scans more
+        return default_nlist(num_vectors) >= self.ivf_retrain_factor * nlist
+    
+    def _migrate_to_id_map(self):
+        """Wrap a positional flat index in an IndexIDMap reusing its stored vectors"""
+        vectors = self.index.reconstruct_n(0, self.index.ntotal) if self.index.ntotal else None
+        self.index = build_index('flat', self.index.d)
+        
+        # Vector positions become the chunk IDs
+        if vectors is not None:
+            self.index.add_with_ids(vectors, np.arange(len(vectors), dtype='int64'))
+        
+        print(f"Migrated index to stable chunk IDs ({self.index.ntotal} vectors)")
+        self._save_index()
+    
+    def _indexed_ids(self):
+        return get_index_ids(self.index)
+    
+    def _remove_vectors(self, ids):
+        """
+        Remove chunk IDs from the index, or leave them as tombstones in an HNSW graph
+        
+        Callers run _rebuild_if_stale() once they release the rw lock, so the graph is
+        never rebuilt while searches are blocked.
+        """
+        if supports_remove(self.index):
+            self._ensure_writable()
+            self.index.remove_ids(np.array(ids, dtype='int64'))
+            return
+        
+        # Search skips vectors whose chunk is gone
+        self.stale_vectors += len(ids)
+    
+    def _rebuild_if_stale(self):
+        """Rebuild the HNSW graph once removed vectors pile up in it"""
+        if self.stale_vectors > 0.1 * self.index.ntotal:
+            self.rebuild_index()
+    
+    def _reconcile_index(self):
+        """Add or drop vectors so the index holds exactly the chunks in the chunk store"""
+        # A rebuild interrupted before it was published leaves staged chunks behind
+        self._discard_staged()
+        
+        stored_ids = set(self.chunk_store.all_ids())
+        indexed_ids = set(self._indexed_ids().tolist())
+        
+        stale_ids = sorted(indexed_ids - stored_ids)
+        missing_ids = sorted(stored_ids - indexed_ids)
+        if stale_ids:
+            self._remove_vectors(stale_ids)
+        if missing_ids:
+            vectors = self.embedding_store.get(missing_ids)
+            if vectors is None:
+                # Without vectors these chunks would never be found; drop them
+                print("Embedding store is missing vectors for some chunks, removing them")
+                available = [i for i in missing_ids if i in self.embedding_store.rows_by_id]
+                self.chunk_store.remove_ids([i for i in missing_ids if i not in self.embedding_store.rows_by_id])
+                missing_ids = available
+                vectors = self.embedding_store.get(missing_ids)
+            if missing_ids:
+                self._ensure_writable()
+                self.index.add_with_ids(vectors, np.array(missing_ids, dtype='int64'))
+        if stale_ids:
+            self._rebuild_if_stale()
+        
+        if stale_ids or missing_ids:
+            print(f"Recovered unsaved index changes: +{len(missing_ids)} / -{len(stale_ids)} vectors")
+            self._save_index()
+    
+    def _backfill_embedding_store(self):
+        """Copy into the embedding store any indexed vector it does not hold yet"""
+        if get_index_type(self.index) != 'flat':
+            return
+        
+        indexed_ids = self._indexed_ids()
+        missing = [(pos, int(chunk_id)) for pos, chunk_id in enumerate(indexed_ids)
+                   if int(chunk_id) not in self.embedding_store.rows_by_id]
+        chunks = self.chunk_store.get_many([chunk_id for _, chunk_id in missing]) if missing else {}
+        missing = [(pos, chunk_id) for pos, chunk_id in missing if chunk_id in chunks]
+        if not missing:
+            return
+        
+        # Flat storage can hand back its vectors by position
+        flat_index = faiss.downcast_index(self.index.index)
+        vectors = np.vstack([flat_index.reconstruct(pos) for pos, _ in missing])
+        ids = [chunk_id for _, chunk_id in missing]
+        self.embedding_store.append(ids, [chunks[chunk_id]['text'] for chunk_id in ids], vectors)
+        print(f"Stored {len(ids)} existing vectors in the embedding store")
+    
+    def rebuild_index(self, index_type=None, batch_size=10000):
+        """
+        Rebuild the FAISS index from the embedding store without re-running the model
+        
+        Searches keep using the current index while the new one is built; it is swapped in
+        atomically. Callers hold the write lock (or are loading the index) so no chunk is
+        added in between.
+        """
+        ids = self.chunk_store.all_ids()
+        index = self._build_index(ids, index_type, batch_size)
+        if index is None:
+            return False
+        
+        with self.rw_lock.write_locked():
+            self.index = index
+            self.stale_vectors = 0
+        self._bump_index_version()
+        print(f"Rebuilt {get_index_type(index)} index from stored embeddings ({index.ntotal} vectors)")
+        return True
+    
+    def _build_index(self, ids, index_type=None, batch_size=10000):
+        """A new index of the given chunk IDs' stored vectors, or None if some are missing"""
+        if any(chunk_id not in self.embedding_store.rows_by_id for chunk_id in ids):
+            print("Embedding store is missing vectors, cannot rebuild the index from it")
+            return None
+        
+        index_type = index_type or self._desired_index_type(len(ids))
+        training_vectors = None
+        if index_type in ('ivf_flat', 'ivf_pq'):
+            # Train the coarse quantizer (and PQ codebooks) on a random sample of stored vectors
+            nlist = self.index_params['ivf_nlist'] or default_nlist(len(ids))
+            needed = min_vectors_to_train(index_type, nlist, self.index_params['ivf_pq_nbits'])
+            sample_size = min(len(ids), max(4 * needed, 65536))
+            sample_ids = sorted(np.random.default_rng(0).choice(ids, sample_size, replace=False).tolist())
+            training_vectors = self.embedding_store.get(sample_ids)
+        
+        index = build_index(index_type, self.dimension, num_vectors=len(ids),
+                            training_vectors=training_vectors, params=self.index_params)
+        # Copy in batches so the memory-mapped vectors are never duplicated in full
+        for start in range(0, len(ids), batch_size):
+            batch_ids = ids[start:start + batch_size]
+            index.add_with_ids(self.embedding_store.get(batch_ids), np.array(batch_ids, dtype='int64'))
+        
+        set_search_params(index, self.ef_search, self.nprobe)
+        return index
     
     def _save_index(self):
-        """Save the index and metadata to disk"""
+        """Atomically save a snapshot of the index to disk"""
         try:
-            # Save FAISS index
-            faiss.write_index(self.index, self.index_file)
-            
-            # Save metadata
-            with open(self.metadata_file, 'wb') as f:
-                pickle.dump(self.metadata, f)
+            # Write to a temporary file first so a kill mid-save leaves the old file intact
+            tmp_index_file = self.index_file + '.tmp'
+            faiss.write_index(self.index, tmp_index_file)
+            with open(tmp_index_file, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_index_file, self.index_file)
+            self.pending_writes = 0
             
             print(f"Saved index with {self.index.ntotal} vectors")
         except Exception as e:
             print(f"Error saving index: {e}")
     
-    def add_document(self, file_path):
-        """Process a document and add its chunks to the index"""
-        # Extract chunks with metadata
-        chunks = self.document_service.extract_text_with_metadata(file_path)
+    @_serialized
+    def compact(self):
+        """Write an index snapshot if there are writes since the last one"""
+        if self.pending_writes:
+            self._save_index()
+    
+    def _record_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.snapshot_every:
+            self._save_index()
+    
+    def index_version(self):
+        """Changes whenever the index is rebuilt or the embedding model changes"""
+        return f"{self.embedding_service.model_name}:{self.chunk_store.get_meta('index_version', 0)}"
+    
+    def book_version(self, book):
+        """
+        (version, last_modified) of an indexed book, for HTTP validators
+        
+        The version changes whenever the book's content or the index version changes;
+        last_modified is when the book was last (re)indexed. None if the book is not indexed.
+        
+        Books indexed before the manifest existed have no entry; their chunk IDs stand in for the
+        content hash (they only change when the book is reindexed) and last_modified is None.
+        """
+        self._follow_writer()
+        entry = self.manifest.get(book)
+        if entry is None:
+            ids = self.chunk_store.get_book_ids(book)
+            if not ids:
+                return None
+            digest = hashlib.sha256(','.join(map(str, ids)).encode('utf-8')).hexdigest()
+            return f"{self.index_version()}:{digest}", None
+        if entry.get('partial'):
+            return None
+        return f"{self.index_version()}:{entry['sha256']}", entry.get('indexed', entry['mtime'])
+    
+    def _bump_index_version(self):
+        self.chunk_store.set_meta('index_version', int(self.chunk_store.get_meta('index_version', 0)) + 1)
+    
+    def _invalidate_books(self, books):
+        if self.answer_cache is not None and books:
+            self.answer_cache.invalidate_books(books)
+    
+    def get_chunks(self, chunk_ids):
+        """Return a {chunk_id: chunk} dict for the given IDs"""
+        return self.chunk_store.get_many(chunk_ids)
+    
+    def get_books(self):
+        """Return the indexed book filenames with their chunk counts"""
+        return self.chunk_store.get_books()
+    
+    def get_book_chunks(self, book_name):
+        """Return a book's chunks, matching the filename exactly or by substring"""
+        chunks = self.chunk_store.get_book_chunks(book_name)
+        if chunks:
+            return chunks
+        
+        # Callers sometimes pass the display name without the UUID suffix
+        for book in self.chunk_store.get_books():
+            if book_name in book:
+                chunks.extend(self.chunk_store.get_book_chunks(book))
+        return chunks
+    
+    def get_chunk_vectors(self, chunks):
+        """Normalized embeddings of chunks (in order), from the embedding store or encoded if missing"""
+        with self.rw_lock.read_locked():
+            vectors = self.embedding_store.get([chunk['index'] for chunk in chunks])
+        if vectors is None:
+            vectors = np.array(self.embedding_service.get_embeddings([chunk['text'] for chunk in chunks],
+                                                                     use_cache=False), dtype='float32')
+        return vectors
+    
+    def resolve_book(self, book_name):
+        """The indexed filename for book_name, matching exactly or by substring; None if there is none"""
+        books = self.chunk_store.get_books()
+        if book_name in books:
+            return book_name
+        # Callers sometimes pass the display name without the UUID suffix
+        return next((book for book in books if book_name in book), None)
+    
+    def get_chapters(self, book):
+        """The chapter table of an indexed book (see detect_chapters)"""
+        chapters = self.chunk_store.get_chapters(book)
+        if chapters is None:
+            # Indexed before chapter tables existed: scan it this once
+            chapters = self._scan_chapters(book)
+        return chapters
+    
+    def get_chapter_chunks(self, book, chapter_id):
+        """The chunks of one chapter in text order, or an empty list if the book has no such chapter"""
+        # A lazy scan takes the write lock, so it must not run under the read lock
+        chapters = self.get_chapters(book)
+        with self.rw_lock.read_locked():
+            # The stored table, in case the book was republished since; a replica's scan is not stored
+            stored = self.chunk_store.get_chapters(book)
+            for chapter in (chapters if stored is None else stored):
+                if chapter['chapter_id'] == str(chapter_id):
+                    return self.chunk_store.get_chunk_range(book, chapter['start_chunk'], chapter['end_chunk'])
+        return []
+    
+    def _index_chapters(self, book):
+        chapters = detect_chapters(self.chunk_store.get_book_chunks(book))
+        self.chunk_store.set_chapters(book, chapters)
+        return chapters
+    
+    def _scan_chapters(self, book):
+        """
+        Chapters of a book indexed before chapter tables existed
+        
+        The scan runs unlocked and is stored under the write lock, only if the book is still the
+        version that was scanned. Replicas (and processes another one writes for) do not store it.
+        """
+        version = self.book_version(book)
+        chapters = detect_chapters(self.chunk_store.get_book_chunks(book))
+        if version is None:
+            # Not indexed, or still being ingested (which finds its chapters itself)
+            return chapters
+        
+        with self.write_lock:
+            if not self._claim_writer():
+                return chapters
+            if self.book_version(book) == version and self.chunk_store.get_chapters(book) is None:
+                self.chunk_store.set_chapters(book, chapters)
+        return chapters
+    
+    def _load_manifest(self):
+        """Load the book manifest ({filename: size, mtime, sha256, chunk_ids})"""
+        try:
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading manifest: {e}")
+        return {}
+    
+    def _save_manifest(self):
+        """Write the manifest atomically"""
+        tmp_file = self.manifest_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_file, self.manifest_file)
+        except Exception as e:
+            print(f"Error saving manifest: {e}")
+    
+    def _manifest_entry(self, file_path, chunk_ids, file_hash=None, indexed=None):
+        file_stat = os.stat(file_path)
+        return {
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime,
+            'sha256': file_hash or self.document_service.get_file_hash(file_path),
+            'chunk_ids': [int(chunk_id) for chunk_id in chunk_ids],
+            'indexed': indexed or time.time()
+        }
+    
+    def add_document(self, file_path, progress=None):
+        """
+        Stream a document into the index
+        
+        Chunks are embedded and written in batches of ingest_batch_size while pages are still
+        being extracted, so memory stays bounded and the batches already written survive a
+        crash: the manifest marks the book as partial and reindexing picks it up from there.
+        Only the index writes hold the write lock.
+        
+        Args:
+            file_path: book file
+            progress: optional callable(stage, done, total), stage being 'extracting' (pages),
+                      'embedding' or 'indexing' (chunks; their total is only known at the end)
+        
+        Returns:
+            The number of chunks the book has in the index
+        """
+        filename = os.path.basename(file_path)
+        file_hash = self.document_service.get_file_hash(file_path)
         
-        if not chunks:
+        # Extraction is deterministic, so chunks of an interrupted run over the same
+        # content are the first ones produced again and can be skipped
+        state, chunk_ids = self._start_document(file_path, file_hash)
+        try:
+            if state == 'current':
+                print(f"{filename} is already indexed with this content")
+                return len(self.chunk_store.get_book_ids(filename))
+            if state == 'replace':
+                # Searches keep the indexed version until the new one is complete
+                staged = self._stage_document(file_path, progress)
+                try:
+                    self._publish([staged])
+                finally:
+                    self._discard_staged([filename])
+                return len(staged[2])
+            
+            resume_from = len(chunk_ids)
+            if resume_from:
+                print(f"Resuming {filename} after {resume_from} indexed chunks")
+            
+            self._stream_chunks(file_path, chunk_ids, progress)
+            # Chapters are found once here, not on every chapter request
+            self._index_chapters(filename)
+            self._finish_document(file_path, file_hash, chunk_ids)
+        finally:
+            with self.write_lock:
+                self.ingesting.discard(filename)
+                self._books_released.notify_all()
+        return len(chunk_ids)
+    
+    def _stage_document(self, file_path, progress=None):
+        """
+        Ingest a new version of a book as staged chunks, invisible to searches until _publish
+        
+        Returns a (file_path, file_hash, chunk_ids) tuple for _publish.
+        """
+        file_hash = self.document_service.get_file_hash(file_path)
+        chunk_ids = []
+        self._stream_chunks(file_path, chunk_ids, progress, staged=True)
+        return file_path, file_hash, chunk_ids
+    
+    def _discard_staged(self, books=None):
+        """Drop the staged chunks of a rebuild that failed before being published (of these books only, if given)"""
+        staged_ids = self.chunk_store.clear_staged(books)
+        if staged_ids:
+            self.embedding_store.discard(staged_ids)
+    
+    def _stream_chunks(self, file_path, chunk_ids, progress=None, staged=False):
+        """Embed and write a document's chunks in batches, skipping the len(chunk_ids) already written"""
+        resume_from = len(chunk_ids)
+        extract_progress = (lambda done, total: progress('extracting', done, total)) if progress else None
+        batch = []
+        for position, chunk in enumerate(self.document_service.iter_chunks(file_path, extract_progress)):
+            if position < resume_from:
+                continue
+            batch.append(chunk)
+            if len(batch) >= self.ingest_batch_size:
+                chunk_ids.extend(self._ingest_batch(file_path, batch, len(chunk_ids), progress, staged))
+                batch = []
+        if batch:
+            chunk_ids.extend(self._ingest_batch(file_path, batch, len(chunk_ids), progress, staged))
+        
+        if not chunk_ids:
             print(f"No text extracted from {file_path}")
-            return 0
+    
+    def _ingest_batch(self, file_path, chunks, chunks_before, progress=None, staged=False):
+        """Embed a batch of chunks and write it to the index; returns the new chunk IDs"""
+        embeddings = self._embed_chunks([chunk['text'] for chunk in chunks])
+        if embeddings is None:
+            raise RuntimeError(f"Could not generate embeddings for {file_path}")
+        if progress:
+            progress('embedding', chunks_before + len(chunks), None)
+        
+        ids = self._commit_chunks(chunks, embeddings, staged)
+        if progress:
+            progress('indexing', chunks_before + len(chunks), None)
+        return ids
+    
+    @_serialized
+    def _start_document(self, file_path, file_hash):
+        """
+        Claim a book for add_document; returns a (state, chunk_ids) pair
+        
+        state is 'index' (chunk_ids being what an interrupted run left to resume from), 'current'
+        if the book is already indexed with this content (e.g. a reindex picked up the copied
+        upload first) or 'replace' if another version is indexed and has to be swapped out.
+        """
+        filename = os.path.basename(file_path)
+        # Another upload or a reindex is writing this book; its result decides what is left to do
+        while filename in self.ingesting or filename in self.staging:
+            self._books_released.wait()
+        self.ingesting.add(filename)
+        
+        entry = self.manifest.get(filename)
+        existing_ids = self.chunk_store.get_book_ids(filename)
+        if entry is not None and entry['sha256'] == file_hash:
+            return ('index', existing_ids) if entry.get('partial') else ('current', [])
+        if existing_ids:
+            # Another version is indexed: complete, interrupted, or from before the manifest
+            return 'replace', []
+        
+        self.manifest[filename] = dict(self._manifest_entry(file_path, [], file_hash), partial=True)
+        self._save_manifest()
+        return 'index', []
+    
+    @_serialized
+    def _finish_document(self, file_path, file_hash, chunk_ids):
+        self.manifest[os.path.basename(file_path)] = self._manifest_entry(file_path, chunk_ids, file_hash)
+        self._save_manifest()
+    
+    @_serialized
+    def _publish(self, staged, replaced_books=(), rebuild=False):
+        """
+        Swap staged book versions in for the current ones in a single step for searches
+        
+        Args:
+            staged: (file_path, file_hash, chunk_ids) tuples from _stage_document
+            replaced_books: other books whose chunks go away at the same time
+            rebuild: build a new index of the resulting chunks (while searches keep using the
+                     current one) instead of updating the current index in place
+        """
+        books = [os.path.basename(file_path) for file_path, _, _ in staged]
+        replaced_books = set(replaced_books) | set(books)
+        new_ids = [chunk_id for _, _, chunk_ids in staged for chunk_id in chunk_ids]
+        old_ids = [chunk_id for book in replaced_books for chunk_id in self.chunk_store.get_book_ids(book)]
+        # Chapters are found before the swap so they are published together with the chunks
+        chapters = {book: detect_chapters(self.chunk_store.get_staged_chunks(book)) for book in books}
         
-        # Get embeddings for all chunks
+        index = None
+        if rebuild:
+            old = set(old_ids)
+            index = self._build_index(sorted([i for i in self.chunk_store.all_ids() if i not in old] + new_ids))
+        else:
+            self._ensure_writable()
+        
+        with self.rw_lock.write_locked():
+            self.chunk_store.publish_staged(replaced_books, chapters)
+            if index is not None:
+                self.index = index
+                self.stale_vectors = 0
+            else:
+                if new_ids:
+                    self.index.add_with_ids(self.embedding_store.get(new_ids), np.array(new_ids, dtype='int64'))
+                if old_ids:
+                    self._remove_vectors(old_ids)
+            
+            # Old chunk IDs go away; their vectors stay reusable by content hash
+            self.embedding_store.discard(old_ids)
+        self._compact_embeddings()
+        if old_ids and index is None:
+            self._rebuild_if_stale()
+        
+        # Cached answers and summaries built from the old versions are no longer valid
+        self._invalidate_books(sorted(replaced_books))
+        for book in replaced_books:
+            self.manifest.pop(book, None)
+        for file_path, file_hash, chunk_ids in staged:
+            self.manifest[os.path.basename(file_path)] = self._manifest_entry(file_path, chunk_ids, file_hash)
+        self._save_manifest()
+        
+        if index is not None:
+            self._bump_index_version()
+            self._save_index()
+            return
+        if self._needs_rebuild(self.index.ntotal):
+            if self.rebuild_index():
+                self._save_index()
+        self._record_write()
+    
+    @_serialized
+    def _commit_chunks(self, chunks, embeddings, staged=False):
+        """
+        Write chunks and their embeddings to the stores and the index; returns their IDs
+        
+        Staged chunks only go to the stores: _publish adds them to the index.
+        """
+        self._ensure_writable()
         texts = [chunk['text'] for chunk in chunks]
-        embeddings = self.embedding_service.get_embeddings(texts)
         
-        # Add to FAISS index (embeddings are already normalized by the service)
-        self.index.add(np.array(embeddings).astype('float32'))
+        # Fresh chunk IDs; vectors are stored before the chunks that reference them
+        start_idx = self.next_id
+        ids = np.arange(start_idx, start_idx + len(chunks), dtype='int64')
+        self.embedding_store.append(ids, texts, embeddings)
         
         # Add metadata with exact page tracking
-        start_idx = len(self.metadata)
+        items = []
         for i, chunk in enumerate(chunks):
             chunk_metadata = {
                 'text': chunk['text'],
@@ -96,95 +960,347 @@ class VectorStoreService:
                 'chunk_start': chunk.get('chunk_start', 0),  # Add position tracking
                 'chunk_end': chunk.get('chunk_end', 0)
             }
-            self.metadata.append(chunk_metadata)
+            items.append(chunk_metadata)
         
-        self._save_index()
-        return len(chunks)
+        self.next_id = start_idx + len(chunks)
+        if staged:
+            self.chunk_store.add_chunks(items, next_id=self.next_id, staged=True)
+            return ids.tolist()
+        
+        with self.rw_lock.write_locked():
+            self.chunk_store.add_chunks(items, next_id=self.next_id)
+            # Add to FAISS index (embeddings are already normalized by the service)
+            self.index.add_with_ids(embeddings, ids)
+        
+        # Switch to the approximate index once the collection outgrows exact search (or its IVF lists)
+        if self._needs_rebuild(self.index.ntotal):
+            if self.rebuild_index():
+                self._save_index()
+        
+        self._record_write()
+        return ids.tolist()
+    
+    def _compact_embeddings(self):
+        """
+        Reclaim disk once deleted vectors outnumber the live ones (called with the write lock held)
+        
+        The compacted files are written while searches keep reading the current ones; only
+        the swap takes the write side of the lock.
+        """
+        if self.embedding_store.dead_rows() <= len(self.embedding_store):
+            return
+        compacted = self.embedding_store.prepare_compaction()
+        with self.rw_lock.write_locked():
+            self.embedding_store.swap_compacted(compacted)
+    
+    def _embed_chunks(self, texts):
+        """Embed chunk texts, reusing the vectors already in the embedding store"""
+        embeddings = np.zeros((len(texts), self.dimension), dtype='float32')
+        
+        # A compaction swap renumbers the rows under the write side of the lock
+        with self.rw_lock.read_locked():
+            stored = self.embedding_store.get_by_text(texts)
+        for i, vector in stored.items():
+            embeddings[i] = vector
+        
+        missing = [i for i in range(len(texts)) if i not in stored]
+        if missing:
+            # The embedding store keeps these vectors; the query cache would only hold a second copy
+            new_embeddings = self.embedding_service.get_embeddings([texts[i] for i in missing], use_cache=False)
+            if len(new_embeddings) != len(missing):
+                return None
+            embeddings[missing] = new_embeddings
+        return embeddings
     
-    def search(self, query, top_k=5, similarity_threshold=0.4):
+    def search(self, query, top_k=5, similarity_threshold=0.4, filters=None):
         """Search for relevant chunks using the query"""
-        if not self.metadata or self.index.ntotal == 0:
-            return []
-        
-        # Get query embedding (already normalized by the service)
-        query_embedding = self.embedding_service.get_embedding(query)
-        if query_embedding is None:
-            print("Could not generate embedding for query")
-            return []
-        
-        # Search with normalized query - get more results initially
-        query_embedding = np.array([query_embedding]).astype('float32')
-        k = min(top_k * 2, self.index.ntotal)  # Get more results initially for filtering
-        distances, indices = self.index.search(query_embedding, k)
-        
-        # Get corresponding metadata and filter by similarity threshold
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.metadata):
-                score = float(distances[0][i])
-                if score > similarity_threshold:  # Only keep relevant results
-                    result = self.metadata[idx].copy()
+        return self.search_many([query], top_k, similarity_threshold, filters)[0]
+    
+    def search_many(self, queries, top_k=5, similarity_threshold=0.4, filters=None):
+        """
+        Search several queries at once: one encode call and one index.search call
+        
+        Args:
+            queries: list of query strings
+            top_k: results per query
+            similarity_threshold: minimum inner-product score
+            filters: optional dict with 'books', 'pages' and/or 'chunk_ids' (see _filter_ids)
+        
+        Returns:
+            A list with the results of each query, in the same order as queries
+        """
+        results = [[] for _ in queries]
+        self._follow_writer()
+        if self.index.ntotal == 0 or not queries:
+            return results
+        
+        # get_embeddings drops empty strings, so keep track of which queries were encoded
+        positions = [i for i, q in enumerate(queries) if q and q.strip()]
+        embeddings = self.embedding_service.get_embeddings([queries[i] for i in positions])
+        if len(embeddings) == 0:
+            print("Could not generate embeddings for queries")
+            return results
+        query_embeddings = np.asarray(embeddings, dtype='float32')
+        
+        # The index, the filters and the chunk rows are all read from the same generation
+        with self.rw_lock.read_locked():
+            allowed_ids = None
+            if filters:
+                allowed_ids = self._filter_ids(filters)
+                if len(allowed_ids) == 0:
+                    return results
+            
+            # Search with normalized queries - get more results initially
+            k = min(top_k * 2, self.index.ntotal)  # Get more results initially for filtering
+            if k == 0:
+                return results
+            exact = None
+            if allowed_ids is not None and len(allowed_ids) <= self.exact_filter_max:
+                exact = self._exact_search(query_embeddings, allowed_ids, k)
+            if exact is not None:
+                distances, indices = exact
+            elif allowed_ids is not None:
+                params = search_parameters(self.index, allowed_ids)
+                distances, indices = self.index.search(query_embeddings, k, params=params)
+            else:
+                distances, indices = self.index.search(query_embeddings, k)
+            
+            # Filter by similarity threshold, then load the surviving rows of every query at once
+            hits = [[(int(idx), float(score)) for idx, score in zip(indices[row], distances[row])
+                     if idx != -1 and score > similarity_threshold] for row in range(len(positions))]
+            chunks = self.chunk_store.get_many({idx for row_hits in hits for idx, _ in row_hits})
+        
+        for row, position in enumerate(positions):
+            query_results = []
+            for idx, score in hits[row]:
+                if idx in chunks:
+                    result = dict(chunks[idx])
                     result['score'] = score
-                    results.append(result)
+                    query_results.append(result)
+            
+            # Sort by score and limit to top_k
+            query_results.sort(key=lambda x: x['score'], reverse=True)
+            results[position] = query_results[:top_k]
         
-        # Sort by score and limit to top_k
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
-
+        return results
+    
+    def _filter_ids(self, filters):
+        """
+        Resolve a filters dict to the int64 array of chunk IDs a search may return
+        
+        Supported keys: 'books' (filenames, matched like get_book_chunks),
+        'pages' ([from, to], inclusive) and 'chunk_ids' (e.g. a chapter's chunks)
+        """
+        books = None
+        if filters.get('books'):
+            indexed_books = self.chunk_store.get_books()
+            books = set()
+            for book in filters['books']:
+                # Same matching as get_book_chunks: exact filename, else substring
+                if book in indexed_books:
+                    books.add(book)
+                else:
+                    books.update(b for b in indexed_books if book in b)
+            if not books:
+                return np.array([], dtype='int64')
+        
+        page_from = page_to = None
+        if filters.get('pages'):
+            page_from, page_to = filters['pages']
+        
+        ids = self.chunk_store.filter_ids(
+            books=sorted(books) if books is not None else None,
+            page_from=page_from,
+            page_to=page_to,
+            chunk_ids=filters.get('chunk_ids')
+        )
+        return np.array(ids, dtype='int64')
+    
+    def _exact_search(self, query_embeddings, chunk_ids, k):
+        """
+        Score the queries against only the candidate chunks' stored vectors
+        
+        For a small candidate set (one book, a page range, a chapter) this is exact and
+        cheaper than a selector over the global index. Returns None if a vector is missing.
+        """
+        vectors = self.embedding_store.get(chunk_ids)
+        if vectors is None:
+            return None
+        
+        k = min(k, len(chunk_ids))
+        scores = query_embeddings @ vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return np.take_along_axis(top_scores, order, axis=1), np.asarray(chunk_ids)[top]
+    
+    @_serialized
     def remove_document(self, filename):
         """Remove a document from the index by filename"""
-        if not self.metadata or self.index.ntotal == 0:
-            return 0
+        self._ensure_writable()
+        if self.manifest.pop(filename, None) is not None:
+            self._save_manifest()
         
-        # Find indices to remove
-        indices_to_remove = []
-        remaining_metadata = []
+        # Find chunk IDs to remove
+        ids_to_remove = self.chunk_store.get_book_ids(filename)
         
-        for i, item in enumerate(self.metadata):
-            if item['book'] == filename:
-                indices_to_remove.append(i)
-            else:
-                remaining_metadata.append(item)
+        with self.rw_lock.write_locked():
+            self.chunk_store.remove_chapters(filename)
+            if ids_to_remove:
+                # Drop only this book's vectors; the rest of the index is untouched
+                self.chunk_store.remove_ids(ids_to_remove)
+                self._remove_vectors(ids_to_remove)
+                
+                self.embedding_store.discard(ids_to_remove)
+        if ids_to_remove:
+            self._compact_embeddings()
+            self._rebuild_if_stale()
         
-        if not indices_to_remove:
+        # Cached answers and summaries built from this book are no longer valid
+        self._invalidate_books([filename])
+        if not ids_to_remove:
             return 0
-            
-        # Create a new index without the removed document
-        self._create_empty_index()
         
-        # Get embeddings to add back
-        if remaining_metadata:
-            texts = [item['text'] for item in remaining_metadata]
-            embeddings = self.embedding_service.get_embeddings(texts)
-            
-            # Normalize embeddings
-            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-            normalized_embeddings = embeddings / norms
+        self._record_write()
+        return len(ids_to_remove)
+    
+    def reindex_all_documents(self, full=False, progress=None):
+        """
+        Bring the index in line with the books directory
+        
+        Only new or modified files are extracted and embedded, and only removed
+        files lose their vectors. With full=True every book is processed again.
+        
+        Modified books, and the whole library with full=True, are staged and swapped in
+        when ready: until then searches keep seeing the previous version.
+        
+        One reindex runs at a time, and the write lock is only taken for the index and manifest
+        writes, so uploads keep going meanwhile. Books an upload is writing are skipped; an
+        upload of a book staged here waits until the new version is published.
+        
+        Args:
+            full: process every book again
+            progress: optional callable(books_done, books_total)
+        
+        Returns a dict with the added, updated, removed, resumed and skipped filenames
+        and the total number of chunks in the index.
+        """
+        with self.reindex_lock:
+            with self.write_lock:
+                self._require_writer()
+                # Loading reconciles (and drops leftover staged chunks), so it must not happen mid-run
+                self._ensure_writable()
+                book_paths = {os.path.basename(path): path for path in self.document_service.get_all_books()}
+                indexed_books = set(self.manifest) | set(self.chunk_store.get_books())
             
-            # Add back to index
-            self.index.add(np.array(normalized_embeddings).astype('float32'))
-            self.metadata = remaining_metadata
+            if full:
+                report = self._reindex_full(book_paths, indexed_books, progress)
+            else:
+                report = self._reindex_changed(book_paths, indexed_books, progress)
+            if progress:
+                progress(len(book_paths), len(book_paths))
+            report['total_chunks'] = self.index.ntotal
+            return report
+    
+    def _reindex_full(self, book_paths, indexed_books, progress=None):
+        """Stage every book and publish them all with a new index in one swap"""
+        report = {'added': [], 'updated': [], 'removed': [], 'resumed': [], 'skipped': []}
+        staged = []
+        try:
+            for done, (filename, book_path) in enumerate(sorted(book_paths.items())):
+                if progress:
+                    progress(done, len(book_paths))
+                with self.write_lock:
+                    if filename in self.ingesting:
+                        # An upload is still writing it; it keeps what that upload indexes
+                        report['skipped'].append(filename)
+                        continue
+                    self.staging.add(filename)
+                try:
+                    staged.append(self._stage_document(book_path))
+                    report['updated' if filename in indexed_books else 'added'].append(filename)
+                except Exception as e:
+                    # The book keeps its current version
+                    print(f"Error reindexing {book_path}: {e}")
             
-            # Update index
-            self._save_index()
-        
-        return len(indices_to_remove)
-
-    def reindex_all_documents(self):
-        """Rebuild the index from all documents in the books directory"""
-        # Create empty index
-        self._create_empty_index()
+            with self.write_lock:
+                # Books deleted while they were being staged stay deleted
+                deleted = {os.path.basename(file_path) for file_path, _, _ in staged if not os.path.exists(file_path)}
+                staged = [item for item in staged if os.path.basename(item[0]) not in deleted]
+                report['added'] = [book for book in report['added'] if book not in deleted]
+                report['updated'] = [book for book in report['updated'] if book not in deleted]
+                report['removed'] = sorted(indexed_books - set(book_paths) - self.ingesting)
+                
+                # A new index of the new generation, published in one swap
+                self._publish(staged, replaced_books=report['removed'], rebuild=True)
+        finally:
+            with self.write_lock:
+                self._discard_staged(sorted(self.staging))
+                self.staging.clear()
+                self._books_released.notify_all()
+        return report
+    
+    def _reindex_changed(self, book_paths, indexed_books, progress=None):
+        """Add new books, replace changed ones, resume interrupted ones and drop removed ones"""
+        report = {'added': [], 'updated': [], 'removed': [], 'resumed': [], 'skipped': []}
         
-        # Get all documents
-        document_service = DocumentService()
-        all_books = document_service.get_all_books()
+        # Drop the vectors of files that are gone
+        for filename in sorted(indexed_books - set(book_paths)):
+            with self.write_lock:
+                if filename not in self.ingesting:
+                    self.remove_document(filename)
+                    report['removed'].append(filename)
         
-        count = 0
-        for book_path in all_books:
+        for done, (filename, book_path) in enumerate(sorted(book_paths.items())):
+            if progress:
+                progress(done, len(book_paths))
             try:
-                num_chunks = self.add_document(book_path)
-                count += num_chunks
+                with self.write_lock:
+                    if filename in self.ingesting:
+                        # An upload is still writing it; its 'partial' entry is not a crash
+                        report['skipped'].append(filename)
+                        continue
+                    entry = self.manifest.get(filename)
+                    
+                    if entry is None:
+                        existing_ids = self.chunk_store.get_book_ids(filename)
+                        if existing_ids:
+                            # Indexed before the manifest existed: adopt its chunks as they are
+                            self.manifest[filename] = self._manifest_entry(book_path, existing_ids)
+                            self._save_manifest()
+                            report['skipped'].append(filename)
+                            continue
+                        outcome = 'added'
+                    elif entry.get('partial'):
+                        # Interrupted ingestion: add_document continues it, or replaces it if the file changed since
+                        outcome = 'resumed'
+                    else:
+                        file_stat = os.stat(book_path)
+                        if file_stat.st_size == entry['size'] and file_stat.st_mtime == entry['mtime']:
+                            report['skipped'].append(filename)
+                            continue
+                        outcome = 'updated'
+                
+                if outcome == 'updated':
+                    # Size or mtime changed; only the content hash tells whether it really did
+                    file_hash = self.document_service.get_file_hash(book_path)
+                    with self.write_lock:
+                        entry = self.manifest.get(filename)
+                        if entry is not None and not entry.get('partial') and entry['sha256'] == file_hash:
+                            self.manifest[filename] = self._manifest_entry(book_path, entry['chunk_ids'], file_hash,
+                                                                           indexed=entry.get('indexed'))
+                            self._save_manifest()
+                            report['skipped'].append(filename)
+                            continue
+                
+                # add_document stages a changed book and swaps it in, so the current version
+                # stays searchable until the new one is complete
+                self.add_document(book_path)
+                report[outcome].append(filename)
             except Exception as e:
                 print(f"Error reindexing {book_path}: {e}")
         
-        return count
+        # One snapshot for the whole run instead of one per book
+        self.compact()
+        return report
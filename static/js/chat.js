@@ -74,20 +74,12 @@ document.addEventListener('DOMContentLoaded', function () {
 
         // Handle response
         xhr.onload = function () {
-            if (xhr.status === 200) {
+            if (xhr.status === 202) {
+                // The server processes the file in the background; follow the job
                 const response = JSON.parse(xhr.responseText);
-                uploadStatus.innerText = response.message;
-                showNotification(`¡Archivo "${response.filename}" subido con éxito!`, 'success');
-
-                // Add assistant message about successful upload
-                const messageDiv = document.createElement('div');
-                messageDiv.className = 'assistant-message';
-                messageDiv.innerHTML = `<p>He procesado el documento "<strong>${response.filename}</strong>".</p><p>¡Pregúntame sobre su contenido!</p>`;
-                chatContainer.appendChild(messageDiv);
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-
-                // Update document list
-                updateDocumentList();
+                uploadStatus.innerText = 'Procesando archivo...';
+                progressBar.style.width = '0%';
+                pollUploadJob(response.job_id, response.filename);
             } else {
                 try {
                     const response = JSON.parse(xhr.responseText);
@@ -110,6 +102,64 @@ document.addEventListener('DOMContentLoaded', function () {
         xhr.send(formData);
     }
 
+    // Poll /jobs/<id> until the background ingestion finishes
+    function pollUploadJob(jobId, filename) {
+        fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message);
+                }
+                const job = data.job;
+
+                if (job.status === 'done') {
+                    progressBar.style.width = '100%';
+                    uploadStatus.innerText = job.message;
+                    showNotification(`¡Archivo "${filename}" subido con éxito!`, 'success');
+
+                    // Add assistant message about successful upload
+                    const messageDiv = document.createElement('div');
+                    messageDiv.className = 'assistant-message';
+                    messageDiv.innerHTML = `<p>He procesado el documento "<strong>${filename}</strong>".</p><p>¡Pregúntame sobre su contenido!</p>`;
+                    chatContainer.appendChild(messageDiv);
+                    chatContainer.scrollTop = chatContainer.scrollHeight;
+
+                    // Update document list
+                    updateDocumentList();
+                    return;
+                }
+
+                if (job.status === 'failed') {
+                    uploadStatus.innerText = 'Error: ' + job.message;
+                    showNotification('Error: ' + job.message, 'error');
+                    return;
+                }
+
+                // Pages are extracted, embedded and indexed together, so pages drive the bar
+                const progress = job.progress;
+                let percent = 0;
+                let status = 'En cola...';
+                if (job.stage === 'processing' && progress.pages_total) {
+                    percent = 95 * progress.pages_extracted / progress.pages_total;
+                    status = `Procesando: página ${progress.pages_extracted} de ${progress.pages_total}, ` +
+                        `${progress.chunks_indexed} fragmentos indexados`;
+                } else if (job.stage === 'processing') {
+                    status = 'Procesando...';
+                } else if (job.stage === 'copying') {
+                    status = 'Guardando archivo...';
+                }
+                progressBar.style.width = percent + '%';
+                uploadStatus.innerText = status;
+
+                setTimeout(() => pollUploadJob(jobId, filename), 1000);
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                uploadStatus.innerText = 'Error al consultar el estado del archivo.';
+                showNotification('Error al procesar el archivo', 'error');
+            });
+    }
+
     // Handle query submission
     sendButton.addEventListener('click', function () {
         sendQuery();
@@ -150,8 +200,12 @@ document.addEventListener('DOMContentLoaded', function () {
         // Scroll to bottom
         chatContainer.scrollTop = chatContainer.scrollHeight;
 
-        // Send query to server
-        fetch('/query', {
+        // Send query to server; the answer arrives as Server-Sent Events
+        let assistantMessageDiv = null;
+        let answer = '';
+        let chunks = [];
+
+        fetch('/query/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -168,33 +222,38 @@ document.addEventListener('DOMContentLoaded', function () {
                         throw new Error(`Error ${response.status}: No hay documentos indexados o el servidor no responde correctamente`);
                     });
                 }
-                return response.json();
+                return readEventStream(response, (event, data) => {
+                    if (event === 'sources') {
+                        chunks = data.chunks || [];
+                    } else if (event === 'token') {
+                        if (!assistantMessageDiv) {
+                            // First text: replace the typing indicator with the answer
+                            chatContainer.removeChild(typingIndicator);
+                            assistantMessageDiv = document.createElement('div');
+                            assistantMessageDiv.className = 'assistant-message';
+                            chatContainer.appendChild(assistantMessageDiv);
+                        }
+                        answer += data.text;
+                        assistantMessageDiv.innerHTML = formatAnswer(answer);
+                        chatContainer.scrollTop = chatContainer.scrollHeight;
+                    } else if (event === 'error') {
+                        throw new Error(data.message);
+                    }
+                });
             })
-            .then(data => {
-                // Remove typing indicator
-                chatContainer.removeChild(typingIndicator);
-
-                if (!data || !data.answer) {
+            .then(() => {
+                if (!assistantMessageDiv) {
                     throw new Error('La respuesta del servidor está vacía o en formato incorrecto');
                 }
 
-                // Create assistant message
-                const assistantMessageDiv = document.createElement('div');
-                assistantMessageDiv.className = 'assistant-message';
-                assistantMessageDiv.innerHTML = formatAnswer(data.answer);
-
-                // Add citation click handlers after the message is added to DOM
-                chatContainer.appendChild(assistantMessageDiv);
-
-                if (data.chunks && data.chunks.length > 0) {
+                if (chunks.length > 0) {
                     // Add click handlers for citations
                     const citations = assistantMessageDiv.querySelectorAll('.citation');
                     citations.forEach(citation => {
                         citation.addEventListener('click', function () {
                             const sourceIdx = this.getAttribute('data-source-idx');
-                            if (sourceIdx !== null && data.chunks && data.chunks[sourceIdx]) {
-                                const source = data.chunks[sourceIdx];
-                                showSourcePopup(source);
+                            if (sourceIdx !== null && chunks[sourceIdx]) {
+                                showSourcePopup(chunks[sourceIdx]);
                             }
                         });
                     });
@@ -205,8 +264,13 @@ document.addEventListener('DOMContentLoaded', function () {
             })
             .catch(error => {
                 console.error('Error:', error);
-                // Remove typing indicator
-                chatContainer.removeChild(typingIndicator);
+                // Remove the typing indicator, or the partial answer if the stream broke mid-way
+                if (typingIndicator.parentNode) {
+                    chatContainer.removeChild(typingIndicator);
+                }
+                if (assistantMessageDiv) {
+                    assistantMessageDiv.remove();
+                }
 
                 const errorDiv = document.createElement('div');
                 errorDiv.className = 'assistant-message error';
@@ -234,6 +298,38 @@ document.addEventListener('DOMContentLoaded', function () {
             });
     }
 
+    // Read a text/event-stream response and call onEvent(event, data) for each message
+    function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                if (done) return;
+                buffer += decoder.decode(value, { stream: true });
+
+                // Messages are separated by a blank line
+                let separator;
+                while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                    const message = buffer.slice(0, separator);
+                    buffer = buffer.slice(separator + 2);
+
+                    let event = 'message';
+                    let data = '';
+                    message.split('\n').forEach(line => {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    });
+                    if (data) onEvent(event, JSON.parse(data));
+                }
+                return pump();
+            });
+        }
+
+        return pump();
+    }
+
     // Add new CSS for error messages
     const errorStyles = document.createElement('style');
     errorStyles.innerHTML = `
@@ -293,7 +389,19 @@ document.addEventListener('DOMContentLoaded', function () {
             })
                 .then(response => response.json())
                 .then(data => {
-                    showNotification(data.message, 'success');
+                    if (!data.success) {
+                        throw new Error(data.message);
+                    }
+                    // The server reindexes in the background; follow the job
+                    return waitForReindexJob(data.job_id);
+                })
+                .then(job => {
+                    if (job.status === 'done') {
+                        showNotification(job.message, 'success');
+                        updateDocumentList();
+                    } else {
+                        showNotification('Error: ' + job.message, 'error');
+                    }
                 })
                 .catch(error => {
                     console.error('Error:', error);
@@ -306,6 +414,26 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     });
 
+    // Poll /jobs/<id> until the background reindex finishes; resolves with the finished job
+    function waitForReindexJob(jobId) {
+        return fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message);
+                }
+                const job = data.job;
+                if (job.status === 'done' || job.status === 'failed') {
+                    return job;
+                }
+                if (job.progress.books_total) {
+                    reindexButton.innerHTML = '<i class="fas fa-spinner fa-spin me-2"></i>' +
+                        `Reindexando ${job.progress.books_done}/${job.progress.books_total}...`;
+                }
+                return new Promise(resolve => setTimeout(resolve, 1000)).then(() => waitForReindexJob(jobId));
+            });
+    }
+
     // Crear el contenedor de toasts si no existe
     let toastContainer = document.getElementById('toast-container');
     if (!toastContainer) {